@@ -3,23 +3,27 @@ Notifications API — core endpoints for event evaluation and audit retrieval.
 """
 import uuid
 import asyncio
+from contextlib import nullcontext
 from datetime import datetime
 from typing import List, Optional
 
 import structlog
 from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, tuple_
 
-from app.models.database import get_db
+from app.config import get_settings
+from app.models.database import get_db, AsyncSessionLocal
 from app.models.schemas import (
     NotificationEventIn, BatchNotificationEventIn,
     DecisionResult, BatchDecisionResult, AuditEntry,
+    ReasonStep, DecisionEnum,
 )
 from app.models.tables import NotificationEvent, AuditLog, AIInteractionLog
 from app.services.pipeline import evaluate_notification
 
 log = structlog.get_logger()
+settings = get_settings()
 router = APIRouter(prefix="/v1/notifications", tags=["Notifications"])
 
 
@@ -50,42 +54,48 @@ async def evaluate_single(
 )
 async def evaluate_batch(
     payload: BatchNotificationEventIn,
-    db: AsyncSession = Depends(get_db),
 ):
     batch_id = str(uuid.uuid4())
-    event_ids = [str(uuid.uuid4()) for _ in payload.events]
-
-    # Evaluate all concurrently (bounded concurrency to avoid overwhelming DB)
-    semaphore = asyncio.Semaphore(20)
-
-    async def eval_one(event: NotificationEventIn, eid: str) -> DecisionResult:
-        async with semaphore:
+    now = datetime.utcnow()  # One clock reading for the whole batch
+
+    # Each event gets its own session — an AsyncSession must not be shared
+    # across concurrent tasks. Pool checkout is the backpressure; an explicit
+    # in-flight cap only kicks in for batches far larger than the pool.
+    if len(payload.events) > settings.db_pool_size * 2:
+        limiter = asyncio.Semaphore(settings.batch_max_inflight)
+    else:
+        limiter = nullcontext()
+
+    async def eval_one(event: NotificationEventIn) -> DecisionResult:
+        eid = str(uuid.uuid4())  # Drawn per task, not all up front
+        async with limiter:
             try:
-                return await evaluate_notification(event, db, event_id=eid)
+                async with AsyncSessionLocal() as session:
+                    async with session.begin():
+                        return await evaluate_notification(event, session, event_id=eid, now=now)
             except Exception as e:
                 log.error("api.batch_eval_item_failed", event_id=eid, error=str(e))
-                from app.models.schemas import ReasonStep, DecisionEnum
-                return DecisionResult(
+                return DecisionResult.model_construct(
                     event_id=eid,
                     user_id=event.user_id,
                     decision=DecisionEnum.later,  # Fail safe
-                    reason_chain=[ReasonStep(
+                    reason_chain=[ReasonStep.model_construct(
                         layer="L0-Error", check="pipeline_error",
                         result="LATER", detail=f"Pipeline error: {str(e)} — deferred as safe default"
                     )],
                     ai_used=False,
                     fallback_used=True,
-                    processed_at=datetime.utcnow(),
+                    processed_at=now,
                 )
 
-    tasks = [eval_one(event, eid) for event, eid in zip(payload.events, event_ids)]
+    tasks = [eval_one(event) for event in payload.events]
     results = await asyncio.gather(*tasks)
 
     return BatchDecisionResult(
         batch_id=batch_id,
         total=len(results),
         results=list(results),
-        processed_at=datetime.utcnow(),
+        processed_at=now,
     )
 
 
@@ -106,22 +116,40 @@ async def get_audit(
     if not entry:
         raise HTTPException(status_code=404, detail=f"Audit entry not found for event_id={event_id}")
 
-    from app.models.schemas import ReasonStep
-    return AuditEntry(
+    # Row data was validated on the way in — skip re-validation on the way out
+    return AuditEntry.model_construct(
         event_id=entry.event_id,
         user_id=entry.user_id,
         event_type=entry.event_type,
-        decision=entry.decision,
+        decision=DecisionEnum(entry.decision),
         score=entry.score,
         ai_used=entry.ai_used,
         fallback_used=entry.fallback_used,
         rule_matched=entry.rule_matched,
-        reason_chain=[ReasonStep(**s) for s in (entry.reason_chain or [])],
+        reason_chain=[ReasonStep.model_construct(**s) for s in (entry.reason_chain or [])],
         raw_event=entry.raw_event or {},
         created_at=entry.created_at,
     )
 
 
+def _parse_cursor(cursor: str) -> tuple[datetime, str]:
+    """Decode a keyset cursor of the form '<created_at iso>,<id>'."""
+    try:
+        ts, row_id = cursor.rsplit(",", 1)
+        # Ids are UUIDs; reject anything else before Postgres does
+        return datetime.fromisoformat(ts), str(uuid.UUID(row_id))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="cursor must be '<iso-timestamp>,<id>'")
+
+
+def _next_cursor(rows: list[dict], limit: int, id_key: str) -> Optional[str]:
+    """Cursor for the page after `rows`, or None when this was the last page."""
+    if len(rows) < limit or rows[-1]["created_at"] is None:
+        return None
+    last = rows[-1]
+    return f"{last['created_at'].isoformat()},{last[id_key]}"
+
+
 @router.get(
     "/history/{user_id}",
     summary="Get recent notification decisions for a user",
@@ -129,30 +157,37 @@ async def get_audit(
 async def get_user_history(
     user_id: str,
     limit: int = 20,
+    cursor: Optional[str] = None,
     db: AsyncSession = Depends(get_db),
 ):
-    result = await db.execute(
-        select(NotificationEvent)
+    limit = min(limit, 100)
+    # Project only the columns we return — no ORM hydration per row
+    query = (
+        select(
+            NotificationEvent.id.label("event_id"),
+            NotificationEvent.event_type,
+            NotificationEvent.title,
+            NotificationEvent.decision,
+            NotificationEvent.score,
+            NotificationEvent.ai_used,
+            NotificationEvent.created_at,
+        )
         .where(NotificationEvent.user_id == user_id)
-        .order_by(NotificationEvent.created_at.desc())
-        .limit(min(limit, 100))
+        .order_by(NotificationEvent.created_at.desc(), NotificationEvent.id.desc())
+        .limit(limit)
     )
-    events = result.scalars().all()
+    # Keyset pagination — walks ix_nev_user_created instead of OFFSET scans
+    if cursor:
+        query = query.where(
+            tuple_(NotificationEvent.created_at, NotificationEvent.id) < _parse_cursor(cursor)
+        )
+    result = await db.execute(query)
+    events = [dict(row._mapping) for row in result.all()]
     return {
         "user_id": user_id,
         "count": len(events),
-        "events": [
-            {
-                "event_id": e.id,
-                "event_type": e.event_type,
-                "title": e.title,
-                "decision": e.decision,
-                "score": e.score,
-                "ai_used": e.ai_used,
-                "created_at": e.created_at.isoformat() if e.created_at else None,
-            }
-            for e in events
-        ],
+        "events": events,
+        "next_cursor": _next_cursor(events, limit, "event_id"),
     }
 
 
@@ -164,35 +199,41 @@ async def get_user_history(
 async def get_ai_logs(
     user_id: Optional[str] = None,
     limit: int = 20,
+    cursor: Optional[str] = None,
     db: AsyncSession = Depends(get_db),
 ):
-    query = select(AIInteractionLog).order_by(AIInteractionLog.created_at.desc())
+    limit = min(limit, 100)
+    query = select(
+        AIInteractionLog.id,
+        AIInteractionLog.event_id,
+        AIInteractionLog.user_id,
+        AIInteractionLog.event_type,
+        AIInteractionLog.ai_used,
+        AIInteractionLog.fallback_reason,
+        AIInteractionLog.score,
+        AIInteractionLog.decision,
+        AIInteractionLog.urgency,
+        AIInteractionLog.engagement,
+        AIInteractionLog.fatigue_penalty,
+        AIInteractionLog.recency_bonus,
+        AIInteractionLog.reasoning,
+        AIInteractionLog.prompt,
+        AIInteractionLog.response,
+        AIInteractionLog.created_at,
+    ).order_by(AIInteractionLog.created_at.desc(), AIInteractionLog.id.desc())
     if user_id:
         query = query.where(AIInteractionLog.user_id == user_id)
-    query = query.limit(min(limit, 100))
+    if cursor:
+        # A plain tuple binds each value with its column's type (here $2::UUID);
+        # tuple_() would bind the id as VARCHAR, which uuid cannot compare with
+        query = query.where(
+            tuple_(AIInteractionLog.created_at, AIInteractionLog.id) < _parse_cursor(cursor)
+        )
+    query = query.limit(limit)
     result = await db.execute(query)
-    logs = result.scalars().all()
+    logs = [dict(row._mapping) for row in result.all()]
     return {
         "count": len(logs),
-        "logs": [
-            {
-                "id": l.id,
-                "event_id": l.event_id,
-                "user_id": l.user_id,
-                "event_type": l.event_type,
-                "ai_used": l.ai_used,
-                "fallback_reason": l.fallback_reason,
-                "score": l.score,
-                "decision": l.decision,
-                "urgency": l.urgency,
-                "engagement": l.engagement,
-                "fatigue_penalty": l.fatigue_penalty,
-                "recency_bonus": l.recency_bonus,
-                "reasoning": l.reasoning,
-                "prompt": l.prompt,
-                "response": l.response,
-                "created_at": l.created_at.isoformat() if l.created_at else None,
-            }
-            for l in logs
-        ],
-    }
\ No newline at end of file
+        "logs": logs,
+        "next_cursor": _next_cursor(logs, limit, "id"),
+    }
@@ -4,41 +4,69 @@ Changes take effect within 30 seconds (cache TTL) — no deployment needed.
 """
 from datetime import datetime
 
+import orjson
 import structlog
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update
+from sqlalchemy import select, update, delete
 
 from app.models.database import get_db
 from app.models.schemas import RuleIn, RuleOut
 from app.models.tables import RuleConfig
 from app.services.rules_engine import invalidate_rules_cache
+from app.utils.redis_client import cache_set, get_redis, key_rules_list
 
 log = structlog.get_logger()
 router = APIRouter(prefix="/v1/rules", tags=["Rules"])
 
 
+async def _commit_and_invalidate(db: AsyncSession):
+    """Commit the rule change, then drop cached rules. In the other order a
+    worker could reload the pre-commit rows and cache them for a full TTL."""
+    await db.commit()
+    await invalidate_rules_cache()
+
+
 @router.get("", response_model=list[RuleOut], summary="List all rules")
 async def list_rules(
     active_only: bool = False,
     db: AsyncSession = Depends(get_db),
 ):
+    # Serve from Redis; invalidate_rules_cache() drops these keys on every write
+    r = await get_redis()
+    cache_key = key_rules_list(active_only)
+    try:
+        cached = await r.get(cache_key)
+        if cached:
+            return orjson.loads(cached)
+    except Exception as e:
+        log.warning("rules.list_cache_read_failed", error=str(e))
+
     query = select(RuleConfig).order_by(RuleConfig.priority_order)
     if active_only:
         query = query.where(RuleConfig.is_active == True)
     result = await db.execute(query)
-    rules = result.scalars().all()
-    return [RuleOut(
-        id=r.id,
-        rule_name=r.rule_name,
-        rule_type=r.rule_type,
-        conditions=r.conditions,
-        action_params=r.action_params or {},
-        priority_order=r.priority_order,
-        is_active=r.is_active,
-        created_at=r.created_at,
-        updated_at=r.updated_at,
-    ) for r in rules]
+    rules = [RuleOut(
+        id=rec.id,
+        rule_name=rec.rule_name,
+        rule_type=rec.rule_type,
+        conditions=rec.conditions,
+        action_params=rec.action_params or {},
+        priority_order=rec.priority_order,
+        is_active=rec.is_active,
+        created_at=rec.created_at,
+        updated_at=rec.updated_at,
+    ) for rec in result.scalars().all()]
+
+    try:
+        await cache_set(
+            r,
+            cache_key,
+            orjson.dumps([rule.model_dump(mode="json") for rule in rules]),
+        )
+    except Exception as e:
+        log.warning("rules.list_cache_write_failed", error=str(e))
+    return rules
 
 
 @router.post("", response_model=RuleOut, summary="Create a new rule")
@@ -46,11 +74,11 @@ async def create_rule(
     rule: RuleIn,
     db: AsyncSession = Depends(get_db),
 ):
-    # Check for name collision
+    # Check for name collision (id only — no need to hydrate the row)
     existing = await db.execute(
-        select(RuleConfig).where(RuleConfig.rule_name == rule.rule_name)
+        select(RuleConfig.id).where(RuleConfig.rule_name == rule.rule_name).limit(1)
     )
-    if existing.scalar_one_or_none():
+    if existing.scalar() is not None:
         raise HTTPException(status_code=409, detail=f"Rule '{rule.rule_name}' already exists")
 
     record = RuleConfig(
@@ -63,7 +91,7 @@ async def create_rule(
     )
     db.add(record)
     await db.flush()
-    await invalidate_rules_cache()
+    await _commit_and_invalidate(db)
     log.info("rules.created", rule_name=rule.rule_name, rule_id=record.id)
     return RuleOut(
         id=record.id, rule_name=record.rule_name, rule_type=record.rule_type,
@@ -79,21 +107,26 @@ async def update_rule(
     rule: RuleIn,
     db: AsyncSession = Depends(get_db),
 ):
-    result = await db.execute(select(RuleConfig).where(RuleConfig.id == rule_id))
+    # Single round-trip: UPDATE ... RETURNING instead of SELECT then flush
+    result = await db.execute(
+        update(RuleConfig)
+        .where(RuleConfig.id == rule_id)
+        .values(
+            rule_name=rule.rule_name,
+            rule_type=rule.rule_type.value,
+            conditions=rule.conditions,
+            action_params=rule.action_params,
+            priority_order=rule.priority_order,
+            is_active=rule.is_active,
+            updated_at=datetime.utcnow(),
+        )
+        .returning(RuleConfig)
+    )
     record = result.scalar_one_or_none()
     if not record:
         raise HTTPException(status_code=404, detail="Rule not found")
 
-    record.rule_name = rule.rule_name
-    record.rule_type = rule.rule_type.value
-    record.conditions = rule.conditions
-    record.action_params = rule.action_params
-    record.priority_order = rule.priority_order
-    record.is_active = rule.is_active
-    record.updated_at = datetime.utcnow()
-
-    await db.flush()
-    await invalidate_rules_cache()
+    await _commit_and_invalidate(db)
     log.info("rules.updated", rule_id=rule_id, rule_name=rule.rule_name)
     return RuleOut(
         id=record.id, rule_name=record.rule_name, rule_type=record.rule_type,
@@ -108,16 +141,19 @@ async def toggle_rule(
     rule_id: str,
     db: AsyncSession = Depends(get_db),
 ):
-    result = await db.execute(select(RuleConfig).where(RuleConfig.id == rule_id))
-    record = result.scalar_one_or_none()
-    if not record:
+    # Atomic server-side flip — no read-modify-write window between requests
+    result = await db.execute(
+        update(RuleConfig)
+        .where(RuleConfig.id == rule_id)
+        .values(is_active=~RuleConfig.is_active, updated_at=datetime.utcnow())
+        .returning(RuleConfig.is_active)
+    )
+    new_state = result.scalar_one_or_none()
+    if new_state is None:
         raise HTTPException(status_code=404, detail="Rule not found")
 
-    record.is_active = not record.is_active
-    record.updated_at = datetime.utcnow()
-    await db.flush()
-    await invalidate_rules_cache()
-    return {"rule_id": rule_id, "is_active": record.is_active, "message": "Rule toggled"}
+    await _commit_and_invalidate(db)
+    return {"rule_id": rule_id, "is_active": new_state, "message": "Rule toggled"}
 
 
 @router.delete("/{rule_id}", summary="Delete a rule")
@@ -125,12 +161,12 @@ async def delete_rule(
     rule_id: str,
     db: AsyncSession = Depends(get_db),
 ):
-    result = await db.execute(select(RuleConfig).where(RuleConfig.id == rule_id))
-    record = result.scalar_one_or_none()
-    if not record:
+    result = await db.execute(
+        delete(RuleConfig).where(RuleConfig.id == rule_id).returning(RuleConfig.id)
+    )
+    if result.scalar_one_or_none() is None:
         raise HTTPException(status_code=404, detail="Rule not found")
 
-    await db.delete(record)
-    await invalidate_rules_cache()
+    await _commit_and_invalidate(db)
     log.info("rules.deleted", rule_id=rule_id)
     return {"message": f"Rule {rule_id} deleted"}
@@ -1,6 +1,8 @@
 """
 Users API — notification profile, preferences, and fatigue state.
 """
+import asyncio
+import heapq
 import json
 from datetime import datetime
 
@@ -10,15 +12,30 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 
 from app.config import get_settings
-from app.models.database import get_db
+from app.models.database import get_db, AsyncSessionLocal
 from app.models.schemas import UserNotificationProfile, UserPreferenceUpdate
 from app.models.tables import UserProfile, NotificationEvent
-from app.utils.redis_client import get_redis, key_count_1h, key_count_24h, key_user_profile_cache
+from app.services.context_enricher import (
+    _dnd_bits, _load_user_profile, _local_hour, profile_to_cache_dict, cache_user_profile,
+    bust_profile_cache,
+)
+from app.utils.redis_client import get_redis, key_count_1h, key_count_24h
 
 log = structlog.get_logger()
 settings = get_settings()
 router = APIRouter(prefix="/v1/users", tags=["Users"])
 
+# Settings are immutable after startup — resolve hot-path values once
+DEFAULT_HOURLY_CAP = settings.default_hourly_cap
+DEFAULT_DAILY_CAP = settings.default_daily_cap
+
+
+async def _commit_and_bust(db: AsyncSession, user_id: str):
+    """Commit the profile write, then drop cached copies. In the other order a
+    concurrent read could re-cache the pre-commit row for a full TTL."""
+    await db.commit()
+    await bust_profile_cache(user_id)
+
 
 async def _get_or_create_profile(user_id: str, db: AsyncSession) -> UserProfile:
     result = await db.execute(select(UserProfile).where(UserProfile.user_id == user_id))
@@ -30,6 +47,41 @@ async def _get_or_create_profile(user_id: str, db: AsyncSession) -> UserProfile:
     return profile
 
 
+async def _get_profile_cached(user_id: str, db: AsyncSession) -> dict:
+    """
+    Read-through profile for read-only endpoints.
+    Serves the Redis blob written by the context enricher; only on a miss
+    does it hit Postgres (creating the row on first sight) and refill the cache.
+    Skips the per-process cache, whose copies in other workers outlive a bust,
+    so a write is visible on the next read. Write endpoints must keep using
+    _get_or_create_profile + _commit_and_bust.
+    """
+    profile = await _load_user_profile(user_id, db)
+    if profile is None:
+        profile = profile_to_cache_dict(await _get_or_create_profile(user_id, db))
+        await cache_user_profile(user_id, profile)
+    return profile
+
+
+async def _recent_decisions(user_id: str, limit: int = 10) -> list[dict]:
+    """Last N decisions for a user, on a dedicated read-only session so it can
+    run concurrently with the request session's profile lookup."""
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(
+                NotificationEvent.id.label("event_id"),
+                NotificationEvent.event_type,
+                NotificationEvent.decision,
+                NotificationEvent.score,
+                NotificationEvent.created_at,
+            )
+            .where(NotificationEvent.user_id == user_id)
+            .order_by(NotificationEvent.created_at.desc())
+            .limit(limit)
+        )
+        return [dict(row._mapping) for row in result.all()]
+
+
 @router.get(
     "/{user_id}/notification-profile",
     response_model=UserNotificationProfile,
@@ -39,64 +91,49 @@ async def get_notification_profile(
     user_id: str,
     db: AsyncSession = Depends(get_db),
 ):
-    profile = await _get_or_create_profile(user_id, db)
     r = await get_redis()
 
-    count_1h = int(await r.get(key_count_1h(user_id)) or 0)
-    count_24h = int(await r.get(key_count_24h(user_id)) or 0)
+    # Profile (Redis → Postgres), fatigue counters (one MGET) and recent
+    # decisions are independent — overlap them. The profile upsert owns the
+    # request session; the recent-decisions read uses its own.
+    profile, (count_1h_raw, count_24h_raw), recent = await asyncio.gather(
+        _get_profile_cached(user_id, db),
+        r.mget(key_count_1h(user_id), key_count_24h(user_id)),
+        _recent_decisions(user_id),
+    )
+    count_1h = int(count_1h_raw or 0)
+    count_24h = int(count_24h_raw or 0)
+
+    # DND as a 24-bit mask (bit h set = hour h is quiet)
+    dnd_mask = _dnd_bits(profile["dnd_start_hour"], profile["dnd_end_hour"])
 
     # DND active check
-    from app.services.context_enricher import _is_dnd_active
-    import pytz
     try:
-        tz = pytz.timezone(profile.timezone or "UTC")
-        current_hour = datetime.now(tz).hour
+        current_hour = _local_hour(profile["timezone"] or "UTC")
     except Exception:
         current_hour = datetime.utcnow().hour
-    dnd_active = _is_dnd_active(profile.dnd_start_hour, profile.dnd_end_hour, current_hour)
+    dnd_active = bool((dnd_mask >> current_hour) & 1)
 
     # Optimal send hours (top 5 from heatmap, excluding DND)
-    heatmap = profile.engagement_heatmap or [1.0] * 24
-    scored_hours = sorted(
-        [(h, heatmap[h]) for h in range(24)],
-        key=lambda x: -x[1]
-    )
-    # Filter DND hours
-    optimal = [h for h, _ in scored_hours if not _is_dnd_active(
-        profile.dnd_start_hour, profile.dnd_end_hour, h
-    )][:5]
-
-    # Recent decisions
-    recent_result = await db.execute(
-        select(NotificationEvent)
-        .where(NotificationEvent.user_id == user_id)
-        .order_by(NotificationEvent.created_at.desc())
-        .limit(10)
-    )
-    recent = recent_result.scalars().all()
+    heatmap = profile["engagement_heatmap"] or [1.0] * 24
+    # Single pass: skip DND hours, keep the 5 best by score (ties → earlier hour)
+    optimal = [h for _, h in heapq.nsmallest(5, (
+        (-heatmap[h], h) for h in range(24) if not (dnd_mask >> h) & 1
+    ))]
 
     return UserNotificationProfile(
         user_id=user_id,
         notifications_last_1h=count_1h,
         notifications_last_24h=count_24h,
         dnd_active=dnd_active,
-        dnd_start_hour=profile.dnd_start_hour,
-        dnd_end_hour=profile.dnd_end_hour,
-        timezone=profile.timezone or "UTC",
-        hourly_cap=profile.hourly_cap_override or settings.default_hourly_cap,
-        daily_cap=profile.daily_cap_override or settings.default_daily_cap,
-        opted_out_topics=profile.opted_out_topics or [],
+        dnd_start_hour=profile["dnd_start_hour"],
+        dnd_end_hour=profile["dnd_end_hour"],
+        timezone=profile["timezone"] or "UTC",
+        hourly_cap=profile["hourly_cap_override"] or DEFAULT_HOURLY_CAP,
+        daily_cap=profile["daily_cap_override"] or DEFAULT_DAILY_CAP,
+        opted_out_topics=profile["opted_out_topics"] or [],
         optimal_send_hours=optimal,
-        recent_decisions=[
-            {
-                "event_id": e.id,
-                "event_type": e.event_type,
-                "decision": e.decision,
-                "score": e.score,
-                "created_at": e.created_at.isoformat() if e.created_at else None,
-            }
-            for e in recent
-        ],
+        recent_decisions=recent,
     )
 
 
@@ -128,9 +165,7 @@ async def update_preferences(
 
     profile.updated_at = datetime.utcnow()
 
-    # Bust the Redis profile cache
-    r = await get_redis()
-    await r.delete(key_user_profile_cache(user_id))
+    await _commit_and_bust(db, user_id)
 
     return {"message": "Preferences updated", "user_id": user_id}
 
@@ -151,8 +186,8 @@ async def opt_out_topic(
         profile.opted_out_topics = topics
         profile.updated_at = datetime.utcnow()
 
-    r = await get_redis()
-    await r.delete(key_user_profile_cache(user_id))
+        # Only bust the cache when something actually changed
+        await _commit_and_bust(db, user_id)
     return {"message": f"User {user_id} opted out of '{topic}'", "all_opt_outs": topics}
 
 
@@ -166,12 +201,14 @@ async def opt_in_topic(
     db: AsyncSession = Depends(get_db),
 ):
     profile = await _get_or_create_profile(user_id, db)
-    topics = [t for t in (profile.opted_out_topics or []) if t != topic]
-    profile.opted_out_topics = topics
-    profile.updated_at = datetime.utcnow()
+    topics = list(profile.opted_out_topics or [])
+    if topic in topics:
+        topics = [t for t in topics if t != topic]
+        profile.opted_out_topics = topics
+        profile.updated_at = datetime.utcnow()
 
-    r = await get_redis()
-    await r.delete(key_user_profile_cache(user_id))
+        # Only bust the cache when something actually changed
+        await _commit_and_bust(db, user_id)
     return {"message": f"User {user_id} re-subscribed to '{topic}'", "all_opt_outs": topics}
 
 
@@ -195,7 +232,8 @@ async def record_feedback(
 
     profile = await _get_or_create_profile(user_id, db)
     heatmap = list(profile.engagement_heatmap or [1.0] * 24)
-    current_hour = datetime.utcnow().hour
+    now = datetime.utcnow()
+    current_hour = now.hour
 
     # Update engagement heatmap with exponential moving average
     delta = 0.1  # Learning rate
@@ -205,9 +243,8 @@ async def record_feedback(
         heatmap[current_hour] = max(0.0, heatmap[current_hour] - delta)
 
     profile.engagement_heatmap = heatmap
-    profile.updated_at = datetime.utcnow()
+    profile.updated_at = now
 
-    r = await get_redis()
-    await r.delete(key_user_profile_cache(user_id))
+    await _commit_and_bust(db, user_id)
 
     return {"message": "Feedback recorded", "user_id": user_id, "action": action}
@@ -1,21 +1,89 @@
 """
 Notification Prioritization Engine — Main Application
 """
+import asyncio
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+import orjson
 import structlog
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 from prometheus_fastapi_instrumentator import Instrumentator
 
 from app.config import get_settings
 from app.models.database import create_tables
-from app.utils.redis_client import get_redis, close_redis
+from app.utils.redis_client import get_redis, close_redis, warm_redis_pool
 from app.api.notifications import router as notifications_router
 from app.api.rules import router as rules_router
 from app.api.users import router as users_router
+from app.services.rules_engine import listen_for_rule_invalidations
 
 settings = get_settings()
+
+
+# Every log line goes through a bounded queue drained by a background thread,
+# so request handlers never block on stderr/file I/O.
+_log_queue: queue.Queue = queue.Queue(maxsize=10000)
+
+
+class _RawFormatter(logging.Formatter):
+    """Pass pre-rendered structlog bytes through; format stdlib records normally."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        if isinstance(record.msg, bytes):
+            return record.msg.decode("utf-8", "replace").rstrip("\n")
+        return super().format(record)
+
+
+class _QueueSink:
+    """File-like target for structlog's BytesLogger — enqueues instead of writing."""
+
+    def write(self, data: bytes):
+        try:
+            # Level filtering already happened in structlog
+            _log_queue.put_nowait(logging.makeLogRecord({"msg": data, "levelno": logging.INFO}))
+        except queue.Full:
+            pass  # Shed log lines rather than stall the event loop
+
+    def flush(self):
+        pass
+
+
+def _configure_logging() -> QueueListener:
+    """
+    Render structlog events straight to bytes with orjson, bypassing the stdlib
+    logging dispatcher, and hand them to the log queue. Must run before the
+    first log call — loggers are cached on first use.
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(_RawFormatter())
+    listener = QueueListener(_log_queue, handler, respect_handler_level=True)
+
+    # Stdlib loggers (uvicorn, sqlalchemy, aiokafka) share the same queue
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(_log_queue)]
+
+    structlog.configure(
+        cache_logger_on_first_use=True,
+        wrapper_class=structlog.make_filtering_bound_logger(
+            logging.getLevelName(settings.log_level.upper())
+        ),
+        processors=[
+            structlog.processors.add_log_level,
+            structlog.processors.TimeStamper(fmt="iso", utc=True),
+            structlog.processors.JSONRenderer(serializer=orjson.dumps),
+        ],
+        logger_factory=structlog.BytesLoggerFactory(file=_QueueSink()),
+    )
+    listener.start()
+    return listener
+
+
+_log_listener = _configure_logging()
 log = structlog.get_logger()
 
 
@@ -34,6 +102,7 @@ async def lifespan(app: FastAPI):
     try:
         r = await get_redis()
         await r.ping()
+        await warm_redis_pool()
         log.info("app.redis_ready")
     except Exception as e:
         log.warning("app.redis_unavailable", error=str(e))
@@ -41,12 +110,17 @@ async def lifespan(app: FastAPI):
     # Seed default rules if none exist
     await _seed_default_rules()
 
+    # Drop cached rules whenever any worker changes them
+    rules_listener = asyncio.create_task(listen_for_rule_invalidations())
+
     log.info("app.ready")
     yield
 
     # Cleanup
+    rules_listener.cancel()
     await close_redis()
     log.info("app.shutdown")
+    _log_listener.stop()  # Drains anything still queued
 
 
 async def _seed_default_rules():
@@ -114,6 +188,7 @@ app = FastAPI(
     docs_url="/docs",
     redoc_url="/redoc",
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 # ── Middleware ─────────────────────────────────────────────────────────────────
@@ -1,7 +1,11 @@
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+from datetime import datetime
+
+from sqlalchemy import Uuid, inspect, text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.pool import NullPool
 from app.config import get_settings
-from app.models.tables import Base
+from app.models.tables import Base, DigestBatch, NotificationEvent, PARTITIONED_LOG_TABLES, SuppressionRecord
+import orjson
 import structlog
 
 log = structlog.get_logger()
@@ -11,8 +15,16 @@ engine = create_async_engine(
     settings.database_url,
     echo=False,
     pool_pre_ping=True,
-    pool_size=10,
-    max_overflow=20,
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    # JSONB columns (audit raw_event, AI responses) go through orjson
+    json_serializer=lambda obj: orjson.dumps(obj).decode(),
+    json_deserializer=orjson.loads,
+    # Keep prepared plans for the hot INSERT/SELECT shapes on each connection
+    connect_args={
+        "statement_cache_size": settings.db_statement_cache_size,
+        "prepared_statement_cache_size": settings.db_statement_cache_size,
+    },
 )
 
 AsyncSessionLocal = async_sessionmaker(
@@ -24,13 +36,264 @@ AsyncSessionLocal = async_sessionmaker(
 )
 
 
+# Channel the scheduler LISTENs on; fired for each newly inserted digest batch
+DIGEST_NOTIFY_CHANNEL = "digest_new"
+
+
+async def _create_digest_notify_trigger(conn: AsyncConnection):
+    # Upserts that land on an existing batch only push scheduled_at later,
+    # so AFTER INSERT is the only event the scheduler needs to hear about
+    await conn.execute(text(
+        "CREATE OR REPLACE FUNCTION notify_digest_new() RETURNS trigger AS $$ "
+        f"BEGIN PERFORM pg_notify('{DIGEST_NOTIFY_CHANNEL}', NEW.id::text); RETURN NEW; END; "
+        "$$ LANGUAGE plpgsql"
+    ))
+    await conn.execute(text(
+        f"CREATE OR REPLACE TRIGGER {DigestBatch.__tablename__}_notify "
+        f"AFTER INSERT ON {DigestBatch.__tablename__} "
+        "FOR EACH ROW EXECUTE FUNCTION notify_digest_new()"
+    ))
+
+
+async def _migrate_uuid_ids(conn: AsyncConnection):
+    """
+    Convert the VARCHAR(36) ids of tables created before Postgres generated
+    them to uuid with a gen_random_uuid() default. Inserts no longer supply
+    an id, so an unconverted table rejects every row. Idempotent.
+    """
+    for table in (DigestBatch.__tablename__, SuppressionRecord.__tablename__):
+        id_type = (await conn.execute(text(
+            "SELECT data_type FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name = :t AND column_name = 'id'"
+        ), {"t": table})).scalar()
+        if id_type == "uuid":
+            continue
+        await conn.execute(text(
+            f"ALTER TABLE {table} ALTER COLUMN id TYPE uuid USING id::uuid, "
+            "ALTER COLUMN id SET DEFAULT gen_random_uuid()"
+        ))
+        log.info("database.id_column_converted", table=table)
+
+
+# Folds pending batches that share (user_id, channel, bucket_ts) into the
+# oldest one: events in batch order, the latest scheduled_at (as the upsert
+# does). The old read-then-insert path could open such twins concurrently.
+_MERGE_PENDING_DIGEST_TWINS = f"""
+WITH dup AS (
+    SELECT (array_agg(id ORDER BY created_at, id))[1] AS keep_id, array_agg(id) AS ids
+    FROM {DigestBatch.__tablename__}
+    WHERE status = 'pending'
+    GROUP BY user_id, channel, bucket_ts
+    HAVING count(*) > 1
+), merged AS (
+    SELECT dup.keep_id,
+           jsonb_agg(e.value ORDER BY b.created_at, b.id, e.n) AS event_ids,
+           max(b.scheduled_at) AS scheduled_at
+    FROM dup
+    JOIN {DigestBatch.__tablename__} b ON b.id = ANY(dup.ids)
+    CROSS JOIN LATERAL jsonb_array_elements(b.event_ids) WITH ORDINALITY AS e(value, n)
+    GROUP BY dup.keep_id
+), kept AS (
+    UPDATE {DigestBatch.__tablename__} d
+    SET event_ids = merged.event_ids, scheduled_at = merged.scheduled_at
+    FROM merged WHERE d.id = merged.keep_id
+)
+DELETE FROM {DigestBatch.__tablename__} d
+USING dup WHERE d.id = ANY(dup.ids) AND d.id <> dup.keep_id
+"""
+
+
+async def _migrate_digest_buckets(conn: AsyncConnection):
+    """
+    Bring a digest_batches table created before bucket_ts existed up to the
+    model: create_all never alters an existing table, and the dispatcher's
+    upsert needs both the column and its partial unique index. Idempotent;
+    a failure aborts startup rather than leaving LATER decisions unpersistable.
+    """
+    table = DigestBatch.__tablename__
+    columns = await conn.run_sync(lambda c: {col["name"] for col in inspect(c).get_columns(table)})
+    if "bucket_ts" not in columns:
+        await conn.execute(text(f"ALTER TABLE {table} ADD COLUMN bucket_ts TIMESTAMP"))
+        # Pre-existing batches are keyed on their own scheduled_at; twins that
+        # would collide in the unique index are merged below
+        await conn.execute(text(f"UPDATE {table} SET bucket_ts = scheduled_at"))
+        await conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN bucket_ts SET NOT NULL"))
+        log.info("database.digest_bucket_column_added")
+
+    unique = (await conn.execute(text("SELECT to_regclass(:i)"), {"i": "uq_digest_pending_bucket"})).scalar()
+    if unique is None:
+        merged = await conn.execute(text(_MERGE_PENDING_DIGEST_TWINS))
+        if merged.rowcount:
+            log.warning("database.digest_twins_merged", removed=merged.rowcount)
+
+    def _create_indexes(sync_conn):
+        for index in DigestBatch.__table__.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+    await conn.run_sync(_create_indexes)
+
+
+async def _set_aside_unpartitioned_logs(conn: AsyncConnection):
+    """
+    Rename log tables created before partitioning (plain tables keyed on id
+    alone) out of the way, so create_all builds the partitioned ones in their
+    place. Index names share the table namespace, so those move too. The rows
+    are copied over by _drain_unpartitioned_logs once partitions exist.
+    """
+    for table in PARTITIONED_LOG_TABLES:
+        kind = (await conn.execute(text(
+            "SELECT relkind::text FROM pg_class WHERE oid = to_regclass(:t)"
+        ), {"t": table})).scalar()
+        if kind != "r":  # Missing, or already partitioned ('p')
+            continue
+        legacy = f"{table}_unpartitioned"
+        await conn.execute(text(f"ALTER TABLE {table} RENAME TO {legacy}"))
+        indexes = (await conn.execute(text(
+            "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = :t"
+        ), {"t": legacy})).scalars().all()
+        for name in indexes:
+            await conn.execute(text(f'ALTER INDEX "{name}" RENAME TO "{name[:50]}_unpartitioned"'))
+        log.warning("database.log_table_set_aside", table=table, renamed_to=legacy)
+
+
+def _legacy_copy_sql(table: str, legacy: str, legacy_types: dict) -> str:
+    """
+    INSERT ... SELECT moving rows from a set-aside log table into `table`.
+    `legacy_types` maps the old table's column names to their SQLAlchemy types.
+    """
+    columns, selected = [], []
+    for column in Base.metadata.tables[table].columns:
+        name = column.name
+        if name not in legacy_types:
+            continue
+        expr = name
+        # Postgres only turns varchar into uuid with an explicit cast
+        if isinstance(column.type, Uuid) and not isinstance(legacy_types[name], Uuid):
+            expr = f"{name}::uuid"
+        elif name == "created_at":
+            # Now part of the primary key, so it cannot stay NULL
+            expr = "COALESCE(created_at, now() AT TIME ZONE 'utc')"
+        columns.append(name)
+        selected.append(expr)
+    return f"INSERT INTO {table} ({', '.join(columns)}) SELECT {', '.join(selected)} FROM {legacy}"
+
+
+async def _drain_unpartitioned_logs():
+    """Copy rows from set-aside pre-partitioning log tables, then drop them."""
+    for table in PARTITIONED_LOG_TABLES:
+        legacy = f"{table}_unpartitioned"
+        async with engine.begin() as conn:
+            if (await conn.execute(text("SELECT to_regclass(:t)"), {"t": legacy})).scalar() is None:
+                continue
+            legacy_types = await conn.run_sync(
+                lambda c: {col["name"]: col["type"] for col in inspect(c).get_columns(legacy)}
+            )
+            await conn.execute(text(_legacy_copy_sql(table, legacy, legacy_types)))
+            await conn.execute(text(f"DROP TABLE {legacy}"))
+            log.info("database.log_table_migrated", table=table)
+
+
+_HISTORY_INDEX = "ix_nev_user_created"
+_RETIRED_HISTORY_INDEX = "ix_nev_user_decision"
+
+
+async def _ensure_history_index():
+    """
+    Build the covering per-user history index on tables that predate it, and
+    drop the one it replaced. create_all skips indexes on existing tables.
+    Runs in autocommit, since CREATE/DROP INDEX CONCURRENTLY cannot run in a
+    transaction. An index that exists but is invalid (an interrupted
+    concurrent build) or lacks the INCLUDE columns is rebuilt.
+    """
+    table = NotificationEvent.__table__
+    index = next(ix for ix in table.indexes if ix.name == _HISTORY_INDEX)
+    columns = ", ".join(c.name for c in index.columns)
+    include = ", ".join(index.dialect_options["postgresql"]["include"])
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        state = (await conn.execute(text(
+            "SELECT indisvalid AND indnatts > indnkeyatts FROM pg_index WHERE indexrelid = to_regclass(:i)"
+        ), {"i": _HISTORY_INDEX})).scalar()
+        if state is False:
+            await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {_HISTORY_INDEX}"))
+        if not state:
+            await conn.execute(text(
+                f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {_HISTORY_INDEX} "
+                f"ON {table.name} ({columns}) INCLUDE ({include})"
+            ))
+            log.info("database.history_index_built")
+        await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {_RETIRED_HISTORY_INDEX}"))
+
+
 async def create_tables():
     """Create all tables on startup."""
     async with engine.begin() as conn:
+        await _set_aside_unpartitioned_logs(conn)
         await conn.run_sync(Base.metadata.create_all)
+        await _migrate_uuid_ids(conn)
+        await _migrate_digest_buckets(conn)
+        await _create_digest_notify_trigger(conn)
+    await _ensure_history_index()
+    await ensure_log_partitions()
+    await _drain_unpartitioned_logs()
     log.info("database.tables_created")
 
 
+def _month_start(year: int, month: int) -> datetime:
+    # Normalise month overflow (e.g. month 13 → January next year)
+    return datetime(year + (month - 1) // 12, (month - 1) % 12 + 1, 1)
+
+
+async def _create_month_partition(table: str, lo: datetime, hi: datetime):
+    """
+    Create the [lo, hi) partition of `table` in its own transaction. Postgres
+    refuses to add a partition while the DEFAULT partition holds rows in its
+    range, so any such rows are moved into the new partition first.
+    """
+    name = f"{table}_{lo:%Y%m}"
+    bounds = f"FOR VALUES FROM ('{lo:%Y-%m-%d}') TO ('{hi:%Y-%m-%d}')"
+    in_range = f"created_at >= '{lo:%Y-%m-%d}' AND created_at < '{hi:%Y-%m-%d}'"
+    async with engine.begin() as conn:
+        # API workers and the scheduler may all roll the window at once
+        await conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:t))"), {"t": name})
+        if (await conn.execute(text("SELECT to_regclass(:t)"), {"t": name})).scalar() is not None:
+            return
+        stranded = (await conn.execute(text(
+            f"SELECT EXISTS (SELECT 1 FROM {table}_default WHERE {in_range})"
+        ))).scalar()
+        if not stranded:
+            await conn.execute(text(f"CREATE TABLE {name} PARTITION OF {table} {bounds}"))
+            return
+        await conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {table}_default"))
+        await conn.execute(text(f"CREATE TABLE {name} PARTITION OF {table} {bounds}"))
+        await conn.execute(text(f"INSERT INTO {name} SELECT * FROM {table}_default WHERE {in_range}"))
+        await conn.execute(text(f"DELETE FROM {table}_default WHERE {in_range}"))
+        await conn.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {table}_default DEFAULT"))
+        log.warning("database.partition_rows_moved", partition=name)
+
+
+async def ensure_log_partitions(months_ahead: int = 2):
+    """
+    Create monthly partitions (current month + `months_ahead`) for the
+    append-only log tables, plus a DEFAULT partition as a safety net.
+    Idempotent; runs at startup and periodically from the scheduler so the
+    window keeps rolling forward. Each month commits on its own, and any
+    failure propagates. Retention is a DROP TABLE of an old month, not a DELETE.
+    """
+    now = datetime.utcnow()
+    for table in PARTITIONED_LOG_TABLES:
+        async with engine.begin() as conn:
+            await conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"
+            ))
+        for i in range(months_ahead + 1):
+            await _create_month_partition(
+                table,
+                _month_start(now.year, now.month + i),
+                _month_start(now.year, now.month + i + 1),
+            )
+
+
 async def get_db() -> AsyncSession:
     """FastAPI dependency for DB session."""
     async with AsyncSessionLocal() as session:
@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field, field_validator
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 from typing import Optional, Any, List
 from datetime import datetime
 from enum import Enum
@@ -55,7 +55,8 @@ class NotificationEventIn(BaseModel):
             raise ValueError("expires_at must be in the future")
         return v
 
-    model_config = {"json_schema_extra": {
+    # Frozen: an event is never changed once validated (use model_copy for variants)
+    model_config = ConfigDict(frozen=True, extra="ignore", json_schema_extra={
         "example": {
             "user_id": "user_123",
             "event_type": "payment_failed",
@@ -66,10 +67,12 @@ class NotificationEventIn(BaseModel):
             "priority_hint": "critical",
             "metadata": {"amount": 49.99, "currency": "USD"}
         }
-    }}
+    })
 
 
 class BatchNotificationEventIn(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     events: List[NotificationEventIn] = Field(..., min_length=1, max_length=500)
 
 
@@ -82,6 +85,8 @@ class ReasonStep(BaseModel):
     detail: Optional[str] = None
 
 class DecisionResult(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     event_id: str
     user_id: str
     decision: DecisionEnum
@@ -109,7 +114,7 @@ class RuleIn(BaseModel):
     priority_order: int = Field(default=100, ge=1, le=1000)
     is_active: bool = True
 
-    model_config = {"json_schema_extra": {
+    model_config = ConfigDict(json_schema_extra={
         "example": {
             "rule_name": "Force critical payment alerts",
             "rule_type": "force_now",
@@ -118,14 +123,14 @@ class RuleIn(BaseModel):
             "priority_order": 1,
             "is_active": True
         }
-    }}
+    })
 
 class RuleOut(RuleIn):
     id: str
     created_at: datetime
     updated_at: datetime
 
-    model_config = {"from_attributes": True}
+    model_config = ConfigDict(from_attributes=True)
 
 
 # ── User Profile ──────────────────────────────────────────────────────────────
@@ -1,6 +1,6 @@
 from sqlalchemy import (
     Column, String, Text, Float, Boolean, Integer,
-    DateTime, JSON, Enum as SAEnum, ForeignKey, Index
+    DateTime, JSON, Enum as SAEnum, ForeignKey, Index, text
 )
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.dialects.postgresql import UUID, JSONB
@@ -24,6 +24,8 @@ class NotificationEvent(Base):
     channel = Column(String(20), nullable=False, default="push")
     priority_hint = Column(String(20), nullable=True)
     dedupe_key = Column(String(256), nullable=True)
+    # Same value as the Redis exact-dedup key (dedup._compute_fingerprint).
+    # It is needed before the row exists, so it stays application-computed.
     computed_fingerprint = Column(String(64), nullable=False, index=True)
     expires_at = Column(DateTime, nullable=True)
     event_timestamp = Column(DateTime, nullable=False, default=datetime.utcnow)
@@ -42,8 +44,14 @@ class NotificationEvent(Base):
     processed_at = Column(DateTime, nullable=True)
 
     __table_args__ = (
-        Index("ix_nev_user_decision", "user_id", "decision"),
         Index("ix_nev_user_type", "user_id", "event_type"),
+        # Keyset pagination for per-user history: (created_at, id) DESC.
+        # INCLUDE makes the recent-decisions read and time-window counts
+        # index-only scans.
+        Index(
+            "ix_nev_user_created", "user_id", "created_at", "id",
+            postgresql_include=["decision", "event_type", "score"],
+        ),
     )
 
 
@@ -86,7 +94,7 @@ class UserProfile(Base):
 class AuditLog(Base):
     __tablename__ = "audit_log"
 
-    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = Column(UUID(as_uuid=False), primary_key=True, server_default=text("gen_random_uuid()"))
     event_id = Column(String(36), nullable=False, index=True)
     user_id = Column(String(64), nullable=False, index=True)
     event_type = Column(String(128), nullable=False)
@@ -97,13 +105,18 @@ class AuditLog(Base):
     rule_matched = Column(String(128), nullable=True)
     reason_chain = Column(JSONB, default=list)
     raw_event = Column(JSONB, nullable=False)
-    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    # Partition key, so it is part of the primary key
+    created_at = Column(DateTime, primary_key=True, default=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
 
 
 class SuppressionRecord(Base):
     __tablename__ = "suppression_records"
 
-    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = Column(UUID(as_uuid=False), primary_key=True, server_default=text("gen_random_uuid()"))
     user_id = Column(String(64), nullable=False, index=True)
     fingerprint = Column(String(64), nullable=False)
     reason = Column(String(128), nullable=False)
@@ -118,7 +131,7 @@ class SuppressionRecord(Base):
 class AIInteractionLog(Base):
     __tablename__ = "ai_interaction_logs"
 
-    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = Column(UUID(as_uuid=False), primary_key=True, server_default=text("gen_random_uuid()"))
     event_id = Column(String(36), nullable=False, index=True)
     user_id = Column(String(64), nullable=False, index=True)
     event_type = Column(String(128), nullable=False)
@@ -140,21 +153,38 @@ class AIInteractionLog(Base):
     recency_bonus = Column(Float, nullable=True)
     reasoning = Column(Text, nullable=True)
 
-    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    # Partition key, so it is part of the primary key
+    created_at = Column(DateTime, primary_key=True, default=datetime.utcnow, index=True)
 
     __table_args__ = (
-        Index("ix_ai_log_user", "user_id", "created_at"),
+        Index("ix_ai_log_user", "user_id", "created_at", "id"),
+        {"postgresql_partition_by": "RANGE (created_at)"},
     )
 
 
 class DigestBatch(Base):
     __tablename__ = "digest_batches"
 
-    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = Column(UUID(as_uuid=False), primary_key=True, server_default=text("gen_random_uuid()"))
     user_id = Column(String(64), nullable=False, index=True)
     channel = Column(String(20), nullable=False)
     event_ids = Column(JSONB, default=list)
     scheduled_at = Column(DateTime, nullable=False, index=True)
+    # Start of the digest window this batch collects (dispatcher._digest_bucket)
+    bucket_ts = Column(DateTime, nullable=False)
     sent_at = Column(DateTime, nullable=True)
     status = Column(String(20), default="pending")  # pending / sent / cancelled
-    created_at = Column(DateTime, default=datetime.utcnow)
\ No newline at end of file
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # At most one open batch per user, channel and window; upsert target
+        Index(
+            "uq_digest_pending_bucket", "user_id", "channel", "bucket_ts",
+            unique=True, postgresql_where=text("status = 'pending'"),
+        ),
+    )
+
+
+# Append-only logs, range-partitioned by month on created_at.
+# Partitions are created by database.ensure_log_partitions().
+PARTITIONED_LOG_TABLES = (AuditLog.__tablename__, AIInteractionLog.__tablename__)
@@ -2,18 +2,24 @@
 AI Scorer — uses Groq (llama-3.1-8b-instant) for low-latency scoring.
 Falls back to heuristic scorer automatically via circuit breaker.
 """
-import json
 import asyncio
-import uuid
+import hashlib
+import random
+import re
+import time
+from collections import OrderedDict
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Optional
 
+import orjson
 import structlog
 from circuitbreaker import circuit, CircuitBreakerError
+from sqlalchemy import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.config import get_settings
-from app.models.schemas import NotificationEventIn, ReasonStep
+from app.models.schemas import NotificationEventIn, PriorityHintEnum, ReasonStep
 from app.services.context_enricher import UserContext
 
 log = structlog.get_logger()
@@ -27,14 +33,22 @@ def _get_groq():
     global _groq_client
     if _groq_client is None and settings.groq_api_key:
         try:
-            from groq import Groq
-            _groq_client = Groq(api_key=settings.groq_api_key)
+            import httpx
+            from groq import AsyncGroq
+            _groq_client = AsyncGroq(
+                api_key=settings.groq_api_key,
+                max_retries=0,
+                timeout=httpx.Timeout(settings.groq_timeout_seconds),
+                http_client=httpx.AsyncClient(
+                    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+                ),
+            )
         except ImportError:
             log.warning("groq.not_installed")
     return _groq_client
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class ScoringResult:
     score: float
     decision_hint: str       # "now" | "later" | "never"
@@ -47,31 +61,16 @@ class ScoringResult:
     fallback_used: bool = False
 
 
-def _build_prompt(event: NotificationEventIn, ctx: UserContext) -> str:
-    return f"""You are a notification prioritization engine. Analyze this notification and return ONLY valid JSON — no explanation, no markdown.
+_PROMPT_HEADER = """You are a notification prioritization engine. Analyze this notification and return ONLY valid JSON — no explanation, no markdown.
 
 NOTIFICATION EVENT:
-- event_type: {event.event_type}
-- title: {event.title}
-- message: {event.message[:300]}
-- source: {event.source}
-- channel: {event.channel.value}
-- priority_hint: {event.priority_hint.value if event.priority_hint else "none"}
-
-USER CONTEXT:
-- notifications_sent_last_1h: {ctx.notifications_last_1h} (cap: {ctx.hourly_cap})
-- notifications_sent_last_24h: {ctx.notifications_last_24h} (cap: {ctx.daily_cap})
-- seconds_since_last_same_type: {ctx.seconds_since_last_same_type or "never_sent"}
-- dnd_active: {ctx.dnd_active}
-- current_local_hour: {ctx.current_local_hour}
-- user_segment: {ctx.segment}
-- engagement_at_current_hour: {ctx.engagement_score_for_current_hour:.2f}
-- opted_out_topics: {ctx.opted_out_topics}
+"""
 
+_PROMPT_FOOTER = """
 SCORING FORMULA: score = (0.35 * urgency) + (0.25 * engagement) - (0.25 * fatigue_penalty) + (0.15 * recency_bonus)
 
 Return this exact JSON structure:
-{{
+{
   "score": <float 0.0-1.0>,
   "decision": "<now|later|never>",
   "urgency": <float 0.0-1.0>,
@@ -79,7 +78,66 @@ Return this exact JSON structure:
   "fatigue_penalty": <float 0.0-1.0>,
   "recency_bonus": <float 0.0-1.0>,
   "reasoning": "<one sentence explanation>"
-}}"""
+}"""
+
+
+@lru_cache(maxsize=2048)
+def _context_block(
+    last_1h: int,
+    hourly_cap: int,
+    last_24h: int,
+    daily_cap: int,
+    dnd_active: bool,
+    local_hour: int,
+    segment: str,
+    engagement: float,
+    opted_out: tuple,
+) -> tuple[str, str]:
+    """
+    Render the USER CONTEXT lines around the recency line, which is too
+    high-cardinality to cache. Keyed on exact values so the prompt text is
+    unchanged — only the formatting work is skipped on repeats.
+    """
+    before = (
+        f"- notifications_sent_last_1h: {last_1h} (cap: {hourly_cap})\n"
+        f"- notifications_sent_last_24h: {last_24h} (cap: {daily_cap})\n"
+    )
+    after = (
+        f"- dnd_active: {dnd_active}\n"
+        f"- current_local_hour: {local_hour}\n"
+        f"- user_segment: {segment}\n"
+        f"- engagement_at_current_hour: {engagement:.2f}\n"
+        f"- opted_out_topics: {list(opted_out)}\n"
+    )
+    return before, after
+
+
+def _build_prompt(event: NotificationEventIn, ctx: UserContext) -> str:
+    before, after = _context_block(
+        ctx.notifications_last_1h,
+        ctx.hourly_cap,
+        ctx.notifications_last_24h,
+        ctx.daily_cap,
+        ctx.dnd_active,
+        ctx.current_local_hour,
+        ctx.segment,
+        round(ctx.engagement_score_for_current_hour, 2),
+        tuple(ctx.opted_out_topics),
+    )
+    return (
+        f"{_PROMPT_HEADER}"
+        f"- event_type: {event.event_type}\n"
+        f"- title: {event.title}\n"
+        f"- message: {event.message[:300]}\n"
+        f"- source: {event.source}\n"
+        f"- channel: {event.channel.value}\n"
+        f"- priority_hint: {event.priority_hint.value if event.priority_hint else 'none'}\n"
+        f"\nUSER CONTEXT:\n"
+        f"{before}"
+        f"- seconds_since_last_same_type: {ctx.seconds_since_last_same_type or 'never_sent'}\n"
+        f"{after}"
+        f"{_PROMPT_FOOTER}"
+    )
 
 
 @circuit(
@@ -88,30 +146,238 @@ Return this exact JSON structure:
     expected_exception=Exception,
     name="groq_scorer",
 )
-async def _call_groq(prompt: str) -> dict:
+async def _call_groq(
+    prompt: str,
+    system: Optional[str] = None,
+    max_tokens: int = 256,
+    timeout: Optional[float] = None,
+) -> dict:
     """Call Groq API with circuit breaker protection."""
     client = _get_groq()
     if not client:
         raise RuntimeError("Groq client not available — API key missing")
 
-    # Run sync Groq call in thread pool to not block event loop
-    loop = asyncio.get_event_loop()
+    messages = [{"role": "user", "content": prompt}]
+    if system:
+        messages.insert(0, {"role": "system", "content": system})
+    timeout = timeout or settings.groq_timeout_seconds
+
     response = await asyncio.wait_for(
-        loop.run_in_executor(
-            None,
-            lambda: client.chat.completions.create(
-                model=settings.groq_model,
-                messages=[{"role": "user", "content": prompt}],
-                response_format={"type": "json_object"},
-                temperature=0.1,
-                max_tokens=256,
-            ),
+        client.chat.completions.create(
+            model=settings.groq_model,
+            messages=messages,
+            response_format={"type": "json_object"},
+            temperature=0.1,
+            max_tokens=max_tokens,
+            timeout=timeout,
         ),
-        timeout=settings.groq_timeout_seconds,
+        timeout=timeout,
     )
 
     raw = response.choices[0].message.content
-    return json.loads(raw)
+    return orjson.loads(raw)
+
+
+# ── Batched scoring ───────────────────────────────────────────────────────────
+
+_BATCH_SYSTEM_PROMPT = """You are a notification prioritization engine. The user message holds one notification per line as JSON with an "id", the "event" and the user "context". Score every line and return ONLY valid JSON — no explanation, no markdown.
+
+SCORING FORMULA: score = (0.35 * urgency) + (0.25 * engagement) - (0.25 * fatigue_penalty) + (0.15 * recency_bonus)
+
+Return this exact JSON structure, one entry per input line, echoing its "id":
+{
+  "items": [
+    {
+      "id": <int>,
+      "score": <float 0.0-1.0>,
+      "decision": "<now|later|never>",
+      "urgency": <float 0.0-1.0>,
+      "engagement": <float 0.0-1.0>,
+      "fatigue_penalty": <float 0.0-1.0>,
+      "recency_bonus": <float 0.0-1.0>,
+      "reasoning": "<one sentence explanation>"
+    }
+  ]
+}"""
+
+
+def _prompt_item(event: NotificationEventIn, ctx: UserContext) -> dict:
+    """The same fields as `_build_prompt`, as one compact batch line."""
+    return {
+        "event": {
+            "event_type": event.event_type,
+            "title": event.title,
+            "message": event.message[:300],
+            "source": event.source,
+            "channel": event.channel.value,
+            "priority_hint": event.priority_hint.value if event.priority_hint else "none",
+        },
+        "context": {
+            "notifications_sent_last_1h": ctx.notifications_last_1h,
+            "hourly_cap": ctx.hourly_cap,
+            "notifications_sent_last_24h": ctx.notifications_last_24h,
+            "daily_cap": ctx.daily_cap,
+            "seconds_since_last_same_type": ctx.seconds_since_last_same_type or "never_sent",
+            "dnd_active": ctx.dnd_active,
+            "current_local_hour": ctx.current_local_hour,
+            "user_segment": ctx.segment,
+            "engagement_at_current_hour": round(ctx.engagement_score_for_current_hour, 2),
+            "opted_out_topics": ctx.opted_out_topics,
+        },
+    }
+
+
+def _batch_payload_text(lines: str) -> str:
+    """The batched request as it is logged: system prompt, then the user lines."""
+    return f"{_BATCH_SYSTEM_PROMPT}\n\n{lines}"
+
+
+async def _call_groq_batch(items: list[dict]) -> tuple[str, dict[int, dict]]:
+    """
+    Score several events in one Groq round-trip, under the same timeout as a
+    single call. Returns (the payload sent, {line id: scores}).
+    """
+    lines = "\n".join(
+        orjson.dumps({"id": i, **item}).decode() for i, item in enumerate(items)
+    )
+    data = await _call_groq(lines, system=_BATCH_SYSTEM_PROMPT, max_tokens=128 * len(items))
+    return _batch_payload_text(lines), {int(row["id"]): row for row in data.get("items", []) if "id" in row}
+
+
+class _GroqBatcher:
+    """
+    Coalesces concurrent score requests (e.g. from /batch-evaluate) into
+    Groq calls of up to `ai_batch_max_events` events. Requests arriving
+    within `ai_batch_window_ms` of each other share a call; full chunks go
+    out immediately and run in parallel. A lone request is sent with the
+    regular single-event prompt. Futures resolve to (payload sent, scores),
+    so callers log what Groq actually received.
+    """
+
+    def __init__(self):
+        self._pending: list[tuple[str, dict, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def submit(self, prompt: str, item: dict) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending.append((prompt, item, fut))
+        if len(self._pending) >= settings.ai_batch_max_events:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(settings.ai_batch_window_ms / 1000, self._flush)
+        return fut
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: list[tuple[str, dict, asyncio.Future]]):
+        try:
+            if len(batch) == 1:
+                sent, results = batch[0][0], {0: await _call_groq(batch[0][0])}
+            else:
+                sent, results = await _call_groq_batch([item for _, item, _ in batch])
+                log.info("ai_scorer.batch_scored", size=len(batch), returned=len(results))
+        except Exception as e:
+            # Each caller falls back on its own, exactly as for a single call
+            for _, _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        for i, (_, _, fut) in enumerate(batch):
+            if fut.done():
+                continue
+            if i in results:
+                fut.set_result((sent, results[i]))
+            else:
+                fut.set_exception(ValueError("Groq batch response missing item"))
+
+
+_batcher = _GroqBatcher()
+
+
+def _parse_scores(data: dict) -> ScoringResult:
+    """Coerce a Groq JSON object into a ScoringResult, defaulting missing fields."""
+    get = data.get
+    return ScoringResult(
+        score=float(get("score", 0.5)),
+        decision_hint=str(get("decision", "later")),
+        urgency=float(get("urgency", 0.5)),
+        engagement=float(get("engagement", 0.5)),
+        fatigue_penalty=float(get("fatigue_penalty", 0.0)),
+        recency_bonus=float(get("recency_bonus", 0.5)),
+        reasoning=str(get("reasoning", "AI scored this event")),
+        ai_used=True,
+        fallback_used=False,
+    )
+
+
+# ── Response cache ────────────────────────────────────────────────────────────
+# Identical prompts (same event text + same user-context values) get the
+# same answer for a short while. Keys are full 128-bit digests, so distinct
+# prompts never share an entry. A hit is dropped with small probability so a
+# hot entry is re-asked now and then instead of living for its whole TTL.
+
+_response_cache: "OrderedDict[bytes, tuple[float, str, dict, ScoringResult]]" = OrderedDict()
+_inflight: dict[bytes, asyncio.Future] = {}
+_FORGET_PROBABILITY = 0.1
+
+
+def _cache_get(key: bytes) -> Optional[tuple[str, dict, ScoringResult]]:
+    entry = _response_cache.get(key)
+    if entry is None:
+        return None
+    expires, sent, data, result = entry
+    if expires < time.monotonic():
+        del _response_cache[key]
+        return None
+    if random.random() < _FORGET_PROBABILITY:
+        del _response_cache[key]
+    else:
+        _response_cache.move_to_end(key)
+    return sent, data, result
+
+
+def _cache_put(key: bytes, sent: str, data: dict, result: ScoringResult):
+    _response_cache[key] = (time.monotonic() + settings.ai_response_cache_ttl_seconds, sent, data, result)
+    _response_cache.move_to_end(key)
+    while len(_response_cache) > settings.ai_response_cache_size:
+        _response_cache.popitem(last=False)
+
+
+async def _score_cached(prompt: str, item: dict) -> tuple[str, dict, ScoringResult]:
+    """
+    The payload sent to Groq, and the raw and parsed scores for `prompt`, from
+    cache, a matching in-flight call, or a new one. Cache hits skip parsing too.
+    """
+    key = hashlib.blake2b(prompt.encode(), digest_size=16).digest()
+    hit = _cache_get(key)
+    if hit is not None:
+        return hit
+
+    pending = _inflight.get(key)
+    if pending is not None:
+        sent, data = await asyncio.shield(pending)
+        return sent, data, _parse_scores(data)
+
+    pending = _batcher.submit(prompt, item)
+    _inflight[key] = pending
+    try:
+        sent, data = await asyncio.shield(pending)
+    finally:
+        _inflight.pop(key, None)
+    result = _parse_scores(data)
+    _cache_put(key, sent, data, result)
+    return sent, data, result
 
 
 async def _save_ai_log(
@@ -126,9 +392,8 @@ async def _save_ai_log(
     """Persist the full AI prompt + response to the database."""
     try:
         from app.models.tables import AIInteractionLog
-        from datetime import datetime
-        entry = AIInteractionLog(
-            id=str(uuid.uuid4()),
+        # Append-only row: a Core INSERT skips the identity map and flush
+        await db.execute(insert(AIInteractionLog).values(
             event_id=event_id,
             user_id=event.user_id,
             event_type=event.event_type,
@@ -143,9 +408,7 @@ async def _save_ai_log(
             fatigue_penalty=result.fatigue_penalty,
             recency_bonus=result.recency_bonus,
             reasoning=result.reasoning,
-        )
-        db.add(entry)
-        await db.flush()
+        ))
         log.info("ai_scorer.log_saved", event_id=event_id, decision=result.decision_hint, score=result.score)
     except Exception as e:
         log.warning("ai_scorer.log_save_failed", error=str(e))
@@ -166,25 +429,17 @@ async def score_with_ai(
     log.info("ai_scorer.prompt_sent", user_id=event.user_id, event_type=event.event_type)
 
     try:
-        data = await _call_groq(prompt)
+        if _get_groq():
+            sent, data, result = await _score_cached(prompt, _prompt_item(event, ctx))
+        else:
+            sent, data = prompt, await _call_groq(prompt)  # Fails fast; no point queueing
+            result = _parse_scores(data)
 
         log.info("ai_scorer.response_received", user_id=event.user_id, response=data)
-
-        result = ScoringResult(
-            score=float(data.get("score", 0.5)),
-            decision_hint=str(data.get("decision", "later")),
-            urgency=float(data.get("urgency", 0.5)),
-            engagement=float(data.get("engagement", 0.5)),
-            fatigue_penalty=float(data.get("fatigue_penalty", 0.0)),
-            recency_bonus=float(data.get("recency_bonus", 0.5)),
-            reasoning=str(data.get("reasoning", "AI scored this event")),
-            ai_used=True,
-            fallback_used=False,
-        )
         log.info("ai_scorer.groq_success", score=result.score, decision=result.decision_hint)
 
         if db and event_id:
-            await _save_ai_log(db, event_id, event, prompt, result, raw_response=data)
+            await _save_ai_log(db, event_id, event, sent, result, raw_response=data)
 
         return result
 
@@ -235,20 +490,29 @@ _URGENCY_MAP = {
     "newsletter": 0.1,
 }
 
+# Keyed by the enum member itself — no .value lookup per event
 _PRIORITY_HINT_URGENCY = {
-    "critical": 1.0,
-    "high": 0.8,
-    "medium": 0.5,
-    "low": 0.2,
+    PriorityHintEnum.critical: 1.0,
+    PriorityHintEnum.high: 0.8,
+    PriorityHintEnum.medium: 0.5,
+    PriorityHintEnum.low: 0.2,
 }
 
 
+# One-pass keyword matcher: a zero-width lookahead reports every keyword at
+# every position (overlaps included), longest alternative first.
+_URGENCY_RE = re.compile(
+    "(?=(" + "|".join(re.escape(k) for k in sorted(_URGENCY_MAP, key=len, reverse=True)) + "))"
+)
+
+
+@lru_cache(maxsize=4096)  # event_type cardinality is low — one dict hit once warm
 def _event_type_urgency(event_type: str) -> float:
-    et = event_type.lower()
-    for keyword, urgency in _URGENCY_MAP.items():
-        if keyword in et:
-            return urgency
-    return 0.4  # Unknown = medium
+    """Highest urgency among all keywords found in event_type; 0.4 if none."""
+    matches = _URGENCY_RE.findall(event_type.lower())
+    if not matches:
+        return 0.4  # Unknown = medium
+    return max(_URGENCY_MAP[kw] for kw in matches)
 
 
 def _heuristic_score(
@@ -261,7 +525,7 @@ def _heuristic_score(
 
     # Override with priority_hint if present
     if event.priority_hint:
-        hint_urgency = _PRIORITY_HINT_URGENCY.get(event.priority_hint.value, 0.4)
+        hint_urgency = _PRIORITY_HINT_URGENCY.get(event.priority_hint, 0.4)
         urgency = max(urgency, hint_urgency)
 
     engagement = ctx.engagement_score_for_current_hour
@@ -3,48 +3,55 @@ Decision Arbiter — merges rule results, AI scores, and context
 into the final Now / Later / Never decision with full reason chain.
 """
 from datetime import datetime, timedelta
+from functools import lru_cache
 from typing import Optional, Tuple
 
 import structlog
 
 from app.config import get_settings
-from app.models.schemas import NotificationEventIn, ReasonStep, DecisionEnum
+from app.models.schemas import NotificationEventIn, ReasonStep, DecisionEnum, PriorityHintEnum
 from app.services.context_enricher import UserContext
 from app.services.ai_scorer import ScoringResult
 
 log = structlog.get_logger()
 settings = get_settings()
 
+# Thresholds are fixed at startup
+_NOW_THRESHOLD = settings.ai_score_now_threshold
+_LATER_THRESHOLD = settings.ai_score_later_threshold
 
-def _compute_optimal_send_time(ctx: UserContext, expires_at: Optional[datetime]) -> datetime:
+_NOW, _LATER, _NEVER = DecisionEnum.now, DecisionEnum.later, DecisionEnum.never
+
+
+@lru_cache(maxsize=1024)
+def _peak_hours(heatmap: tuple, dnd_bits: int) -> tuple[int, ...]:
+    """
+    Non-DND hours sharing the highest engagement score. Depends only on the
+    user's heatmap and DND window, so it is computed once per profile shape
+    instead of rescanning all 24 hours for every deferred event.
+    """
+    open_hours = [h for h in range(24) if not (dnd_bits >> h) & 1]
+    scores = [heatmap[h] for h in open_hours if heatmap[h] > -1.0]
+    if not scores:
+        return ()
+    best = max(scores)
+    return tuple(h for h in open_hours if heatmap[h] == best)
+
+
+def _compute_optimal_send_time(
+    ctx: UserContext, expires_at: Optional[datetime], now: Optional[datetime] = None,
+) -> datetime:
     """Find the best hour to send a deferred notification."""
-    now = datetime.utcnow()
+    now = now or datetime.utcnow()
 
-    # Find highest engagement hour in the next 24h that is NOT in DND
+    # Find highest engagement hour in the next 24h that is NOT in DND;
+    # ties go to the soonest one
     heatmap = ctx.engagement_heatmap if len(ctx.engagement_heatmap) == 24 else [1.0] * 24
-    best_hour = None
-    best_score = -1.0
-
-    for offset in range(1, 25):  # Look up to 24h ahead
-        candidate = now + timedelta(hours=offset)
-        hour = candidate.hour
-
-        # Skip DND hours
-        start, end = ctx.dnd_start_hour, ctx.dnd_end_hour
-        if start > end:
-            in_dnd = hour >= start or hour < end
-        else:
-            in_dnd = start <= hour < end
-        if in_dnd:
-            continue
-
-        score = heatmap[hour]
-        if score > best_score:
-            best_score = score
-            best_hour = candidate
-
-    if best_hour is None:
-        best_hour = now + timedelta(hours=1)
+    peaks = _peak_hours(tuple(heatmap), ctx.dnd_bits)
+    base_hour = now.hour
+    best_offset = min(((h - base_hour - 1) % 24) + 1 for h in peaks) if peaks else 1
+
+    best_hour = now + timedelta(hours=best_offset)
 
     # Never schedule past expires_at
     if expires_at and best_hour > expires_at:
@@ -58,6 +65,46 @@ def _compute_optimal_send_time(ctx: UserContext, expires_at: Optional[datetime])
     return best_hour
 
 
+# Steps whose text depends only on a rule name or event type are built once
+# and shared; they are never mutated after construction.
+
+@lru_cache(maxsize=256)
+def _rule_override_step(rule_name: str, result: str) -> ReasonStep:
+    if result == "NOW":
+        detail = f"Hard force-now rule '{rule_name}' wins — immediate delivery"
+    else:
+        detail = f"Hard suppress rule '{rule_name}' wins — event suppressed"
+    return ReasonStep.model_construct(
+        layer="L5-Arbiter", check="rule_override", result=result, detail=detail,
+    )
+
+
+@lru_cache(maxsize=1024)
+def _opt_out_step(event_type: str) -> ReasonStep:
+    return ReasonStep.model_construct(
+        layer="L5-Arbiter",
+        check="topic_opt_out",
+        result="NEVER",
+        detail=f"User has opted out of '{event_type}' notifications",
+    )
+
+
+def score_can_change_decision(event: NotificationEventIn, ctx: UserContext) -> bool:
+    """
+    False when arbitrate() will reach the same decision whatever the score,
+    so the caller can skip the AI call. Mirrors steps 2, 4 and 5 below:
+    opt-outs always suppress; for non-critical events a daily cap suppresses
+    (unless the hourly cap's score bypass comes first) and DND always defers.
+    """
+    if event.event_type in ctx.opted_out_topics:
+        return False
+    if event.priority_hint is PriorityHintEnum.critical:
+        return True
+    if ctx.daily_cap_hit:
+        return ctx.hourly_cap_hit
+    return not ctx.dnd_active
+
+
 def arbitrate(
     event: NotificationEventIn,
     rule_decision: Optional[str],
@@ -67,118 +114,102 @@ def arbitrate(
     rule_steps: list[ReasonStep],
     dedup_steps: list[ReasonStep],
     ai_step: ReasonStep,
+    now: Optional[datetime] = None,
 ) -> Tuple[DecisionEnum, Optional[datetime], list[ReasonStep], Optional[str]]:
     """
     Final decision merge.
+    `now` is the caller's clock reading for this event (read once if omitted).
     Returns: (decision, scheduled_at, reason_chain, override_note)
     """
     reason_chain = dedup_steps + rule_steps
 
     # ── Step 1: Hard rule wins ────────────────────────────────────
     if rule_decision == "now":
-        reason_chain.append(ReasonStep(
-            layer="L5-Arbiter",
-            check="rule_override",
-            result="NOW",
-            detail=f"Hard force-now rule '{rule_name}' wins — immediate delivery",
-        ))
-        return DecisionEnum.now, None, reason_chain, f"rule:{rule_name}"
+        reason_chain.append(_rule_override_step(rule_name, "NOW"))
+        return _NOW, None, reason_chain, f"rule:{rule_name}"
 
     if rule_decision == "never":
-        reason_chain.append(ReasonStep(
-            layer="L5-Arbiter",
-            check="rule_override",
-            result="NEVER",
-            detail=f"Hard suppress rule '{rule_name}' wins — event suppressed",
-        ))
-        return DecisionEnum.never, None, reason_chain, f"rule:{rule_name}"
+        reason_chain.append(_rule_override_step(rule_name, "NEVER"))
+        return _NEVER, None, reason_chain, f"rule:{rule_name}"
 
     # ── Step 2: Opted-out topic check ────────────────────────────
     if event.event_type in ctx.opted_out_topics:
-        reason_chain.append(ReasonStep(
-            layer="L5-Arbiter",
-            check="topic_opt_out",
-            result="NEVER",
-            detail=f"User has opted out of '{event.event_type}' notifications",
-        ))
-        return DecisionEnum.never, None, reason_chain, "user_opt_out"
+        reason_chain.append(_opt_out_step(event.event_type))
+        return _NEVER, None, reason_chain, "user_opt_out"
 
     # ── Step 3: AI/heuristic score ────────────────────────────────
     reason_chain.append(ai_step)
     score = ai_result.score
-    is_critical = event.priority_hint and event.priority_hint.value == "critical"
+    is_critical = event.priority_hint is PriorityHintEnum.critical
 
     # ── Step 4: Fatigue cap enforcement ──────────────────────────
     if ctx.hourly_cap_hit and not is_critical:
         if score < 0.8:  # Very-high-score events still get through even at cap
-            if rule_decision == "later":
-                scheduled_at = _compute_optimal_send_time(ctx, event.expires_at)
-            else:
-                scheduled_at = _compute_optimal_send_time(ctx, event.expires_at)
-            reason_chain.append(ReasonStep(
+            scheduled_at = _compute_optimal_send_time(ctx, event.expires_at, now)
+            reason_chain.append(ReasonStep.model_construct(
                 layer="L5-Arbiter",
                 check="hourly_cap",
                 result="LATER",
                 detail=f"Hourly cap hit ({ctx.notifications_last_1h}/{ctx.hourly_cap}) — deferred to {scheduled_at.isoformat()}",
             ))
-            return DecisionEnum.later, scheduled_at, reason_chain, "fatigue_hourly_cap"
+            return _LATER, scheduled_at, reason_chain, "fatigue_hourly_cap"
 
     if ctx.daily_cap_hit and not is_critical:
-        reason_chain.append(ReasonStep(
+        reason_chain.append(ReasonStep.model_construct(
             layer="L5-Arbiter",
             check="daily_cap",
             result="NEVER",
             detail=f"Daily cap hit ({ctx.notifications_last_24h}/{ctx.daily_cap}) — suppressed",
         ))
-        return DecisionEnum.never, None, reason_chain, "fatigue_daily_cap"
+        return _NEVER, None, reason_chain, "fatigue_daily_cap"
 
     # ── Step 5: DND enforcement ───────────────────────────────────
     if ctx.dnd_active and not is_critical:
-        scheduled_at = _compute_optimal_send_time(ctx, event.expires_at)
-        reason_chain.append(ReasonStep(
+        scheduled_at = _compute_optimal_send_time(ctx, event.expires_at, now)
+        reason_chain.append(ReasonStep.model_construct(
             layer="L5-Arbiter",
             check="dnd_active",
             result="LATER",
             detail=f"DND active ({ctx.dnd_start_hour}–{ctx.dnd_end_hour}) — deferred to {scheduled_at.isoformat()}",
         ))
-        return DecisionEnum.later, scheduled_at, reason_chain, "dnd_active"
+        return _LATER, scheduled_at, reason_chain, "dnd_active"
 
     # ── Step 6: Rule deferred ─────────────────────────────────────
     if rule_decision == "later":
-        scheduled_at = _compute_optimal_send_time(ctx, event.expires_at)
-        reason_chain.append(ReasonStep(
+        scheduled_at = _compute_optimal_send_time(ctx, event.expires_at, now)
+        reason_chain.append(ReasonStep.model_construct(
             layer="L5-Arbiter",
             check="rule_defer",
             result="LATER",
             detail=f"Rule '{rule_name}' defers — scheduled for {scheduled_at.isoformat()}",
         ))
-        return DecisionEnum.later, scheduled_at, reason_chain, f"rule:{rule_name}"
+        return _LATER, scheduled_at, reason_chain, f"rule:{rule_name}"
 
     # ── Step 7: Score thresholds ──────────────────────────────────
-    if score >= settings.ai_score_now_threshold or is_critical:
-        reason_chain.append(ReasonStep(
+    if score >= _NOW_THRESHOLD or is_critical:
+        reason_chain.append(ReasonStep.model_construct(
             layer="L5-Arbiter",
             check="score_threshold",
             result="NOW",
-            detail=f"Score {score:.3f} >= threshold {settings.ai_score_now_threshold} → send now",
+            detail=f"Score {score:.3f} >= threshold {_NOW_THRESHOLD} → send now",
         ))
-        return DecisionEnum.now, None, reason_chain, None
+        return _NOW, None, reason_chain, None
 
-    elif score >= settings.ai_score_later_threshold:
-        scheduled_at = _compute_optimal_send_time(ctx, event.expires_at)
-        reason_chain.append(ReasonStep(
+    elif score >= _LATER_THRESHOLD:
+        scheduled_at = _compute_optimal_send_time(ctx, event.expires_at, now)
+        reason_chain.append(ReasonStep.model_construct(
             layer="L5-Arbiter",
             check="score_threshold",
             result="LATER",
-            detail=f"Score {score:.3f} in [{settings.ai_score_later_threshold}, {settings.ai_score_now_threshold}) → deferred to {scheduled_at.isoformat()}",
+            detail=f"Score {score:.3f} in [{_LATER_THRESHOLD}, {_NOW_THRESHOLD}) → deferred to {scheduled_at.isoformat()}",
         ))
-        return DecisionEnum.later, scheduled_at, reason_chain, None
+        return _LATER, scheduled_at, reason_chain, None
 
     else:
-        reason_chain.append(ReasonStep(
+        reason_chain.append(ReasonStep.model_construct(
             layer="L5-Arbiter",
             check="score_threshold",
             result="NEVER",
-            detail=f"Score {score:.3f} < threshold {settings.ai_score_later_threshold} → suppressed",
+            detail=f"Score {score:.3f} < threshold {_LATER_THRESHOLD} → suppressed",
         ))
-        return DecisionEnum.never, None, reason_chain, None
+        return _NEVER, None, reason_chain, None
@@ -5,9 +5,12 @@ Fails safely: returns defaults if any source is unavailable.
 """
 import asyncio
 import json
+import time
 import pytz
+from collections import OrderedDict
 from datetime import datetime
 from dataclasses import dataclass, field
+from functools import lru_cache
 from typing import Optional
 
 import structlog
@@ -18,6 +21,7 @@ from app.config import get_settings
 from app.models.schemas import NotificationEventIn
 from app.models.tables import UserProfile
 from app.utils.redis_client import (
+    cache_set,
     get_redis,
     key_count_1h,
     key_count_24h,
@@ -55,6 +59,11 @@ class UserContext:
     # Flags
     profile_found: bool = False
 
+    @property
+    def dnd_bits(self) -> int:
+        """24-bit DND mask: bit h is set when local hour h is quiet."""
+        return _dnd_bits(self.dnd_start_hour, self.dnd_end_hour)
+
     @property
     def hourly_cap_hit(self) -> bool:
         return self.notifications_last_1h >= self.hourly_cap
@@ -84,41 +93,147 @@ class UserContext:
         return min(self.seconds_since_last_same_type / cooldown, 1.0)
 
 
+@lru_cache(maxsize=576)
+def _dnd_bits(start: int, end: int) -> int:
+    if start > end:  # Overnight: everything except [end, start)
+        return ((1 << 24) - 1) ^ ((1 << start) - (1 << end))
+    return (1 << end) - (1 << start)
+
+
 def _is_dnd_active(start: int, end: int, current_hour: int) -> bool:
-    if start > end:  # Overnight
-        return current_hour >= start or current_hour < end
-    return start <= current_hour < end
+    return bool((_dnd_bits(start, end) >> current_hour) & 1)
+
+
+@lru_cache(maxsize=1024)
+def _tz(name: str):
+    return pytz.timezone(name)
+
+
+# (tz name, UTC minute) -> local hour. Every real UTC offset is a whole number
+# of minutes, so the local hour cannot change within a UTC minute.
+_local_hour_cache: dict[tuple[str, int], int] = {}
+_LOCAL_HOUR_CACHE_SIZE = 4096
+
 
+def _local_hour(tz_name: str) -> int:
+    """Current hour in `tz_name`; raises for unknown zones."""
+    minute = int(time.time() // 60)
+    key = (tz_name, minute)
+    hour = _local_hour_cache.get(key)
+    if hour is None:
+        if len(_local_hour_cache) >= _LOCAL_HOUR_CACHE_SIZE:
+            _local_hour_cache.clear()
+        hour = _tz(tz_name).fromutc(datetime.utcfromtimestamp(minute * 60)).hour
+        _local_hour_cache[key] = hour
+    return hour
 
-async def _fetch_redis_counters(user_id: str) -> tuple[int, int, dict]:
-    """Return (count_1h, count_24h, {event_type: last_timestamp})."""
+
+async def _fetch_redis_context(user_id: str, event_type: str) -> tuple[int, int, Optional[float]]:
+    """Return (count_1h, count_24h, seconds since last send of event_type or None) in one MGET."""
     r = await get_redis()
     try:
-        count_1h = int(await r.get(key_count_1h(user_id)) or 0)
-        count_24h = int(await r.get(key_count_24h(user_id)) or 0)
-        return count_1h, count_24h, {}
+        raw_1h, raw_24h, raw_last = await r.mget(
+            key_count_1h(user_id),
+            key_count_24h(user_id),
+            key_last_send(user_id, event_type),
+        )
     except Exception as e:
         log.warning("context_enricher.redis_counter_failed", error=str(e))
-        return 0, 0, {}
+        return 0, 0, None
+
+    try:
+        count_1h = int(raw_1h or 0)
+        count_24h = int(raw_24h or 0)
+    except ValueError:
+        count_1h = count_24h = 0
+
+    since_last = None
+    if raw_last:
+        try:
+            since_last = max(0.0, time.time() - float(raw_last))
+        except ValueError:
+            pass
+    return count_1h, count_24h, since_last
+
+
+def profile_to_cache_dict(profile: UserProfile) -> dict:
+    """Serializable view of a UserProfile — the shape stored under key_user_profile_cache."""
+    return {
+        "timezone": profile.timezone,
+        "dnd_start_hour": profile.dnd_start_hour,
+        "dnd_end_hour": profile.dnd_end_hour,
+        "channel_preferences": profile.channel_preferences or {},
+        "opted_out_topics": profile.opted_out_topics or [],
+        "hourly_cap_override": profile.hourly_cap_override,
+        "daily_cap_override": profile.daily_cap_override,
+        "segment": profile.segment,
+        "engagement_heatmap": profile.engagement_heatmap or [1.0] * 24,
+    }
 
 
-async def _fetch_last_send(user_id: str, event_type: str) -> Optional[float]:
-    """Return seconds since last send of this event_type, or None."""
+# Process-local front for the Redis profile cache: hot users skip the Redis
+# round-trip entirely. Entries live for profile_cache_ttl_seconds, so other
+# workers may serve a stale profile for that long after a write.
+_profile_cache: "OrderedDict[str, tuple[float, dict]]" = OrderedDict()
+_profile_locks: dict[str, asyncio.Lock] = {}
+
+
+def _profile_cache_get(user_id: str) -> Optional[dict]:
+    entry = _profile_cache.get(user_id)
+    if entry is None:
+        return None
+    expires, data = entry
+    if expires < time.monotonic():
+        del _profile_cache[user_id]
+        return None
+    _profile_cache.move_to_end(user_id)
+    return data
+
+
+def _profile_cache_put(user_id: str, data: dict):
+    _profile_cache[user_id] = (time.monotonic() + settings.profile_cache_ttl_seconds, data)
+    _profile_cache.move_to_end(user_id)
+    while len(_profile_cache) > settings.profile_cache_size:
+        _profile_cache.popitem(last=False)
+
+
+async def bust_profile_cache(user_id: str):
+    """Drop a user's cached profile, locally and in Redis. Call after any profile write."""
+    _profile_cache.pop(user_id, None)
     r = await get_redis()
+    await r.delete(key_user_profile_cache(user_id))
+
+
+async def cache_user_profile(user_id: str, data: dict):
+    """Cache a profile dict in-process and in Redis. Best-effort."""
+    _profile_cache_put(user_id, data)
     try:
-        key = key_last_send(user_id, event_type)
-        ts_str = await r.get(key)
-        if ts_str:
-            last_ts = float(ts_str)
-            now_ts = datetime.utcnow().timestamp()
-            return max(0.0, now_ts - last_ts)
-        return None
+        r = await get_redis()
+        await cache_set(r, key_user_profile_cache(user_id), json.dumps(data))
     except Exception:
-        return None
+        pass
 
 
 async def _fetch_user_profile(user_id: str, db: AsyncSession | None) -> Optional[dict]:
-    """Try Redis cache first, then Postgres."""
+    """Try the in-process cache, then Redis, then Postgres."""
+    data = _profile_cache_get(user_id)
+    if data is not None:
+        return data
+
+    # One loader per user; concurrent events for the same user wait for it
+    lock = _profile_locks.setdefault(user_id, asyncio.Lock())
+    try:
+        async with lock:
+            data = _profile_cache_get(user_id)
+            if data is None:
+                data = await _load_user_profile(user_id, db)
+            return data
+    finally:
+        if not lock.locked() and _profile_locks.get(user_id) is lock:
+            del _profile_locks[user_id]
+
+
+async def _load_user_profile(user_id: str, db: AsyncSession | None) -> Optional[dict]:
     r = await get_redis()
     cache_key = key_user_profile_cache(user_id)
 
@@ -126,7 +241,9 @@ async def _fetch_user_profile(user_id: str, db: AsyncSession | None) -> Optional
     try:
         cached = await r.get(cache_key)
         if cached:
-            return json.loads(cached)
+            data = json.loads(cached)
+            _profile_cache_put(user_id, data)
+            return data
     except Exception:
         pass
 
@@ -138,22 +255,8 @@ async def _fetch_user_profile(user_id: str, db: AsyncSession | None) -> Optional
             )
             profile = result.scalar_one_or_none()
             if profile:
-                data = {
-                    "timezone": profile.timezone,
-                    "dnd_start_hour": profile.dnd_start_hour,
-                    "dnd_end_hour": profile.dnd_end_hour,
-                    "channel_preferences": profile.channel_preferences or {},
-                    "opted_out_topics": profile.opted_out_topics or [],
-                    "hourly_cap_override": profile.hourly_cap_override,
-                    "daily_cap_override": profile.daily_cap_override,
-                    "segment": profile.segment,
-                    "engagement_heatmap": profile.engagement_heatmap or [1.0] * 24,
-                }
-                # Cache in Redis for 5 minutes
-                try:
-                    await r.set(cache_key, json.dumps(data), ex=300)
-                except Exception:
-                    pass
+                data = profile_to_cache_dict(profile)
+                await cache_user_profile(user_id, data)
                 return data
         except Exception as e:
             log.warning("context_enricher.db_profile_failed", error=str(e))
@@ -168,14 +271,13 @@ async def enrich_context(
     """Build full user context for scoring. Never raises — returns safe defaults."""
     ctx = UserContext(user_id=event.user_id)
 
-    # Run all fetches in parallel
-    counters_task = asyncio.create_task(_fetch_redis_counters(event.user_id))
-    last_send_task = asyncio.create_task(_fetch_last_send(event.user_id, event.event_type))
+    # Counters and profile overlap; the profile may need a DB round-trip
+    redis_task = asyncio.create_task(_fetch_redis_context(event.user_id, event.event_type))
     profile_task = asyncio.create_task(_fetch_user_profile(event.user_id, db))
 
     try:
-        (count_1h, count_24h, _), last_send_seconds, profile = await asyncio.gather(
-            counters_task, last_send_task, profile_task,
+        counters, profile = await asyncio.gather(
+            redis_task, profile_task,
             return_exceptions=True,
         )
     except Exception as e:
@@ -183,12 +285,8 @@ async def enrich_context(
         return ctx  # Return safe defaults
 
     # Apply counters
-    if isinstance(count_1h, int):
-        ctx.notifications_last_1h = count_1h
-    if isinstance(count_24h, int):
-        ctx.notifications_last_24h = count_24h
-    if isinstance(last_send_seconds, float):
-        ctx.seconds_since_last_same_type = last_send_seconds
+    if isinstance(counters, tuple):
+        ctx.notifications_last_1h, ctx.notifications_last_24h, ctx.seconds_since_last_same_type = counters
 
     # Apply profile
     if profile and isinstance(profile, dict):
@@ -208,13 +306,11 @@ async def enrich_context(
 
     # Determine local hour in user's timezone
     try:
-        tz = pytz.timezone(ctx.timezone)
-        local_now = datetime.now(tz)
-        ctx.current_local_hour = local_now.hour
+        ctx.current_local_hour = _local_hour(ctx.timezone)
     except Exception:
         ctx.current_local_hour = datetime.utcnow().hour
 
-    ctx.dnd_active = _is_dnd_active(ctx.dnd_start_hour, ctx.dnd_end_hour, ctx.current_local_hour)
+    ctx.dnd_active = bool((ctx.dnd_bits >> ctx.current_local_hour) & 1)
 
     log.debug(
         "context_enricher.done",
@@ -1,17 +1,18 @@
 """
 Deduplication Guard — Three-tier strategy:
-  Tier 1: Exact match via SHA-256 fingerprint in Redis
+  Tier 1: Exact match via BLAKE2b fingerprint in Redis
   Tier 2: Near-duplicate via MinHash LSH (Jaccard similarity)
   Tier 3: Topic cooldown (same user + event_type within window)
 """
 import hashlib
-import json
 import re
+import time
 from datetime import datetime
+from functools import lru_cache
 from typing import Tuple
 
 import structlog
-from datasketch import MinHash
+import numpy as np
 
 from app.config import get_settings
 from app.models.schemas import NotificationEventIn, ReasonStep
@@ -19,160 +20,185 @@ from app.utils.redis_client import (
     get_redis,
     key_exact_dedup,
     key_near_dedup_minhash,
+    key_lsh_band,
     key_cooldown,
 )
 
 log = structlog.get_logger()
 settings = get_settings()
 
+# Read once: settings are fixed after startup and these are used per event
+_EXACT_DEDUP_TTL = settings.exact_dedup_ttl_seconds
+_NEAR_DEDUP_TTL = settings.near_dedup_ttl_seconds
+_JACCARD_THRESHOLD = settings.lsh_jaccard_threshold
+_NUM_PERM = settings.lsh_num_perm
+_NUM_BANDS = settings.lsh_bands
+
+
+_NON_WORD_RE = re.compile(r"[^\w\s]")
+# ASCII characters the regex above would drop, as a translate() table
+_ASCII_DROP_TABLE = str.maketrans("", "", "".join(
+    c for c in map(chr, range(128)) if _NON_WORD_RE.match(c)
+))
+
 
 def _normalize_text(text: str) -> str:
     """Lowercase, remove punctuation, collapse whitespace."""
-    text = text.lower()
-    text = re.sub(r"[^\w\s]", "", text)
-    text = re.sub(r"\s+", " ", text).strip()
-    return text
+    text = text.lower().translate(_ASCII_DROP_TABLE)
+    if not text.isascii():
+        text = _NON_WORD_RE.sub("", text)
+    return " ".join(text.split())
 
 
 def _compute_fingerprint(event: NotificationEventIn) -> str:
-    """SHA-256 of canonical event identity."""
-    key_parts = [
+    """128-bit BLAKE2b of canonical event identity (32 hex chars)."""
+    # hashlib's BLAKE2b beats SIMD hashes (blake3, xxh3) on inputs this short:
+    # per-call overhead dominates. The hash must also be identical on every
+    # worker, so it is not swapped for an optional faster dependency.
+    raw = "|".join((
         event.user_id,
         event.event_type,
         event.dedupe_key or _normalize_text(event.title),
         event.source,
-    ]
-    raw = "|".join(key_parts)
-    return hashlib.sha256(raw.encode()).hexdigest()
+    ))
+    return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
 
 
-def _compute_minhash(text: str, num_perm: int = 128) -> MinHash:
-    """Generate MinHash signature from 3-grams of text."""
-    m = MinHash(num_perm=num_perm)
-    normalized = _normalize_text(text)
-    # Shingle into character 3-grams
-    for i in range(len(normalized) - 2):
-        m.update(normalized[i : i + 3].encode("utf-8"))
-    return m
+# MinHash parameters (same scheme as datasketch: 32-bit shingle hashes,
+# universal hashing mod the Mersenne prime 2^61 - 1)
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_SHINGLE_BLOCK = 2048  # Shingles per vectorized block; bounds peak memory
 
 
-def _minhash_to_list(m: MinHash) -> list:
-    return m.hashvalues.tolist()
+@lru_cache(maxsize=4)
+def _permutations(num_perm: int) -> tuple[np.ndarray, np.ndarray]:
+    """Fixed-seed (a, b) coefficients, shaped for broadcasting over shingles."""
+    gen = np.random.RandomState(1)
+    a = gen.randint(1, _MERSENNE_PRIME, num_perm, dtype=np.uint64)
+    b = gen.randint(0, _MERSENNE_PRIME, num_perm, dtype=np.uint64)
+    return a[:, None], b[:, None]
 
 
-def _jaccard_from_lists(a: list, b: list) -> float:
-    """Estimate Jaccard similarity from two MinHash signature lists."""
-    matches = sum(1 for x, y in zip(a, b) if x == y)
-    return matches / len(a)
+def _shingle_hashes(normalized: str) -> np.ndarray:
+    """32-bit hashes of every character 3-gram, computed without a Python loop."""
+    cp = np.frombuffer(normalized.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    if cp.size < 3:
+        return np.empty(0, dtype=np.uint64)
+    h = (cp[:-2] << np.uint64(42)) ^ (cp[1:-1] << np.uint64(21)) ^ cp[2:]
+    # splitmix64 finalizer to spread the packed code points over all bits
+    h ^= h >> np.uint64(30)
+    h *= np.uint64(0xBF58476D1CE4E5B9)
+    h ^= h >> np.uint64(27)
+    h *= np.uint64(0x94D049BB133111EB)
+    h ^= h >> np.uint64(31)
+    return np.unique(h & _MAX_HASH)
 
 
-async def check_exact_duplicate(fingerprint: str) -> Tuple[bool, ReasonStep]:
-    """Return (is_duplicate, reason_step)."""
-    r = await get_redis()
-    redis_key = key_exact_dedup(fingerprint)
-    existing = await r.get(redis_key)
+def _mod_mersenne(y: np.ndarray) -> np.ndarray:
+    """`y % (2^61 - 1)` for a uint64 array, by folding instead of dividing."""
+    v = (y & _MERSENNE_PRIME) + (y >> np.uint64(61))
+    np.subtract(v, _MERSENNE_PRIME, out=v, where=v >= _MERSENNE_PRIME)
+    return v
 
-    if existing:
-        return True, ReasonStep(
-            layer="L1-Dedup",
-            check="exact_duplicate",
-            result="SUPPRESS",
-            detail=f"Fingerprint {fingerprint[:12]}... seen within TTL window",
-        )
 
-    # Register fingerprint
-    await r.set(redis_key, "1", ex=settings.exact_dedup_ttl_seconds)
-    return False, ReasonStep(
-        layer="L1-Dedup",
-        check="exact_duplicate",
-        result="PASS",
-        detail="No exact duplicate found",
-    )
+def _compute_minhash(text: str, num_perm: int = 128) -> np.ndarray:
+    """MinHash signature (uint64 array of `num_perm` values) from 3-grams of text."""
+    hashes = _shingle_hashes(_normalize_text(text))
+    if hashes.size == 0:
+        return np.full(num_perm, _MAX_HASH, dtype=np.uint64)
+    a, b = _permutations(num_perm)
+    with np.errstate(over="ignore"):
+        # Typical messages fit one block, so this is a single (num_perm x shingles) pass
+        block_mins = [
+            (_mod_mersenne(a * hashes[start : start + _SHINGLE_BLOCK] + b) & _MAX_HASH).min(axis=1)
+            for start in range(0, hashes.size, _SHINGLE_BLOCK)
+        ]
+    return np.minimum.reduce(block_mins)
 
 
-async def check_near_duplicate(
-    event: NotificationEventIn, fingerprint: str
-) -> Tuple[bool, ReasonStep]:
-    """Return (is_near_duplicate, reason_step)."""
-    r = await get_redis()
-    text = f"{event.title} {event.message}"
-    current_mh = _compute_minhash(text, settings.lsh_num_perm)
-    current_sig = _minhash_to_list(current_mh)
-
-    # Scan recent minhash signatures for this user
-    pattern = f"dedup:lsh:{event.user_id}:*"
-    async for key in r.scan_iter(pattern, count=100):
-        stored_raw = await r.get(key)
-        if not stored_raw:
-            continue
-        try:
-            stored_sig = json.loads(stored_raw)
-            similarity = _jaccard_from_lists(current_sig, stored_sig)
-            if similarity >= settings.lsh_jaccard_threshold:
-                return True, ReasonStep(
-                    layer="L1-Dedup",
-                    check="near_duplicate_lsh",
-                    result="SUPPRESS",
-                    detail=f"Jaccard similarity {similarity:.2f} >= threshold {settings.lsh_jaccard_threshold}",
-                )
-        except Exception:
-            continue
+def _minhash_to_list(sig: np.ndarray) -> list:
+    return sig.tolist()
 
-    # Store current signature
-    store_key = key_near_dedup_minhash(event.user_id, fingerprint)
-    await r.set(
-        store_key,
-        json.dumps(current_sig),
-        ex=settings.near_dedup_ttl_seconds,
-    )
 
-    return False, ReasonStep(
-        layer="L1-Dedup",
-        check="near_duplicate_lsh",
-        result="PASS",
-        detail="No near-duplicate found above threshold",
-    )
+# Stored signatures: num_perm little-endian uint32s (every value is < 2^32)
+_SIG_DTYPE = np.dtype("<u4")
 
 
-async def check_topic_cooldown(event: NotificationEventIn) -> Tuple[bool, ReasonStep]:
-    """Check if this event_type is in cooldown for this user."""
-    # Critical events bypass cooldown
-    if event.priority_hint == "critical":
-        return False, ReasonStep(
-            layer="L1-Dedup",
-            check="topic_cooldown",
-            result="BYPASS",
-            detail="Critical priority bypasses cooldown",
-        )
+def _sig_to_bytes(sig: np.ndarray) -> bytes:
+    return sig.astype(_SIG_DTYPE).tobytes()
 
-    r = await get_redis()
-    cooldown_key = key_cooldown(event.user_id, event.event_type)
-    existing = await r.get(cooldown_key)
 
-    if existing:
-        ttl = await r.ttl(cooldown_key)
-        return True, ReasonStep(
-            layer="L1-Dedup",
-            check="topic_cooldown",
-            result="DEFER",
-            detail=f"Topic {event.event_type} in cooldown — {ttl}s remaining",
-        )
+def _sig_from_bytes(raw: bytes) -> np.ndarray:
+    """Zero-copy view of a stored signature; raises ValueError on a malformed blob."""
+    return np.frombuffer(raw, dtype=_SIG_DTYPE)
 
-    return False, ReasonStep(
-        layer="L1-Dedup",
-        check="topic_cooldown",
-        result="PASS",
-        detail="No active cooldown for this topic",
-    )
+
+def _lsh_bands(sig: np.ndarray, bands: int) -> list[str]:
+    """
+    Split a signature into `bands` equal rows and hash each one. Two
+    signatures sharing any band hash are near-duplicate candidates.
+    """
+    return [
+        hashlib.blake2b(band.tobytes(), digest_size=8).hexdigest()
+        for band in sig.reshape(bands, -1)
+    ]
 
 
-async def register_cooldown(event: NotificationEventIn, ttl_seconds: int):
-    """Set a cooldown after a successful send."""
+def _jaccard_from_lists(a, b) -> float:
+    """Estimate Jaccard similarity from two MinHash signatures (lists or arrays)."""
+    return np.count_nonzero(np.asarray(a) == np.asarray(b)) / len(a)
+
+
+async def _dedup_probe(
+    r, fingerprint: str, band_keys: list[str], cooldown_key: str | None, now: float,
+) -> Tuple[bool, set, int]:
+    """
+    All dedup reads in one round-trip.
+    Returns: (exact_hit, band_candidates, cooldown_ttl); cooldown_ttl is -2
+    when there is no cooldown (or it was not checked).
+    """
+    pipe = r.pipeline(transaction=False)
+    pipe.exists(key_exact_dedup(fingerprint))
+    # Band members older than the signature TTL have no signature left to compare
+    window_start = now - _NEAR_DEDUP_TTL
+    for band_key in band_keys:
+        pipe.zrangebyscore(band_key, window_start, "+inf")
+    if cooldown_key:
+        pipe.ttl(cooldown_key)
+    results = await pipe.execute()
+    exact_hit = bool(results[0])
+    candidates = set().union(*results[1:1 + len(band_keys)])
+    cooldown_ttl = results[-1] if cooldown_key else -2
+    return exact_hit, candidates, cooldown_ttl
+
+
+async def _best_similarity(r, user_id: str, current_sig: np.ndarray, candidates: set) -> float:
+    """Highest Jaccard similarity between `current_sig` and the candidate signatures."""
+    if not candidates:
+        return 0.0
+    stored = await r.mget([key_near_dedup_minhash(user_id, fp.decode()) for fp in candidates])
+    best = 0.0
+    for stored_raw in stored:
+        if not stored_raw:
+            continue
+        try:
+            stored_sig = _sig_from_bytes(stored_raw)
+            if stored_sig.size != current_sig.size:
+                continue  # Written with a different num_perm or format
+            best = max(best, _jaccard_from_lists(current_sig, stored_sig))
+        except Exception:
+            continue
+        if best >= _JACCARD_THRESHOLD:
+            break
+    return best
+
+
+def queue_cooldown(pipe, event: NotificationEventIn, ttl_seconds: int):
+    """Queue the post-send cooldown SET on an existing pipeline."""
     if event.priority_hint == "critical":
         return  # Critical events don't set cooldowns
-    r = await get_redis()
-    cooldown_key = key_cooldown(event.user_id, event.event_type)
-    await r.set(cooldown_key, "1", ex=ttl_seconds)
+    pipe.set(key_cooldown(event.user_id, event.event_type), "1", ex=ttl_seconds)
 
 
 async def run_dedup_pipeline(
@@ -185,24 +211,95 @@ async def run_dedup_pipeline(
     """
     fingerprint = _compute_fingerprint(event)
     steps: list[ReasonStep] = []
+    r = await get_redis()
+
+    # Near-duplicate check is skipped for very short messages
+    check_near = len(event.message) > 20
+    band_keys: list[str] = []
+    if check_near:
+        current_mh = _compute_minhash(f"{event.title} {event.message}", _NUM_PERM)
+        band_keys = [
+            key_lsh_band(event.user_id, i, h)
+            for i, h in enumerate(_lsh_bands(current_mh, _NUM_BANDS))
+        ]
+    # Critical events bypass cooldown
+    is_critical = event.priority_hint == "critical"
+    cooldown_key = None if is_critical else key_cooldown(event.user_id, event.event_type)
+
+    now = time.time()
+    exact_hit, candidates, cooldown_ttl = await _dedup_probe(r, fingerprint, band_keys, cooldown_key, now)
 
     # Tier 1: Exact duplicate
-    is_dup, step = await check_exact_duplicate(fingerprint)
-    steps.append(step)
-    if is_dup:
+    if exact_hit:
+        steps.append(ReasonStep(
+            layer="L1-Dedup",
+            check="exact_duplicate",
+            result="SUPPRESS",
+            detail=f"Fingerprint {fingerprint[:12]}... seen within TTL window",
+        ))
         return "exact_duplicate", fingerprint, steps
-
-    # Tier 2: Near-duplicate (skip for very short messages)
-    if len(event.message) > 20:
-        is_near_dup, step = await check_near_duplicate(event, fingerprint)
-        steps.append(step)
-        if is_near_dup:
+    steps.append(ReasonStep(
+        layer="L1-Dedup",
+        check="exact_duplicate",
+        result="PASS",
+        detail="No exact duplicate found",
+    ))
+
+    # Registration writes go out together once the checks are decided
+    writes = r.pipeline(transaction=False)
+    writes.set(key_exact_dedup(fingerprint), "1", ex=_EXACT_DEDUP_TTL)
+
+    # Tier 2: Near-duplicate — full Jaccard only for band-sharing candidates
+    if check_near:
+        similarity = await _best_similarity(r, event.user_id, current_mh, candidates)
+        if similarity >= _JACCARD_THRESHOLD:
+            await writes.execute()
+            steps.append(ReasonStep(
+                layer="L1-Dedup",
+                check="near_duplicate_lsh",
+                result="SUPPRESS",
+                detail=f"Jaccard similarity {similarity:.2f} >= threshold {_JACCARD_THRESHOLD}",
+            ))
             return "near_duplicate", fingerprint, steps
 
+        # Store current signature and index it under each of its bands; the
+        # trim keeps a band that is hit all day from growing without bound
+        ttl = _NEAR_DEDUP_TTL
+        writes.set(key_near_dedup_minhash(event.user_id, fingerprint), _sig_to_bytes(current_mh), ex=ttl)
+        for band_key in band_keys:
+            writes.zadd(band_key, {fingerprint: now})
+            writes.zremrangebyscore(band_key, "-inf", now - ttl)
+            writes.expire(band_key, ttl)
+        steps.append(ReasonStep(
+            layer="L1-Dedup",
+            check="near_duplicate_lsh",
+            result="PASS",
+            detail="No near-duplicate found above threshold",
+        ))
+    await writes.execute()
+
     # Tier 3: Topic cooldown
-    is_cooling, step = await check_topic_cooldown(event)
-    steps.append(step)
-    if is_cooling:
+    if is_critical:
+        steps.append(ReasonStep(
+            layer="L1-Dedup",
+            check="topic_cooldown",
+            result="BYPASS",
+            detail="Critical priority bypasses cooldown",
+        ))
+    elif cooldown_ttl != -2:
+        steps.append(ReasonStep(
+            layer="L1-Dedup",
+            check="topic_cooldown",
+            result="DEFER",
+            detail=f"Topic {event.event_type} in cooldown — {cooldown_ttl}s remaining",
+        ))
         return "topic_cooldown", fingerprint, steps
+    else:
+        steps.append(ReasonStep(
+            layer="L1-Dedup",
+            check="topic_cooldown",
+            result="PASS",
+            detail="No active cooldown for this topic",
+        ))
 
     return None, fingerprint, steps
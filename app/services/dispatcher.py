@@ -5,51 +5,103 @@ Dispatcher — final routing layer.
   NEVER  → Audit log only
 All decisions are written to audit_log and notification_events.
 """
+import asyncio
 import json
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 from typing import Optional
 
 import structlog
+from pydantic import TypeAdapter
+from sqlalchemy.dialects.postgresql import JSONB, insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import Text, cast, func, insert, literal, text
 
 from app.config import get_settings
 from app.models.schemas import DecisionEnum, NotificationEventIn, ReasonStep, DecisionResult
 from app.models.tables import NotificationEvent, AuditLog, DigestBatch
 from app.services.context_enricher import UserContext
 from app.services.ai_scorer import ScoringResult
-from app.services.dedup import register_cooldown
+from app.services.dedup import queue_cooldown
 from app.utils.redis_client import get_redis, key_count_1h, key_count_24h, key_last_send
 from app.utils.kafka_client import publish
 
 log = structlog.get_logger()
 settings = get_settings()
 
+_dump_reason_chain = TypeAdapter(list[ReasonStep]).dump_json
+
+
+def _jsonb(raw: str):
+    """Bind already-serialized JSON as text and cast it server-side, so the
+    engine's json_serializer does not walk it a second time."""
+    return cast(literal(raw, Text), JSONB)
+
+
 # Rolling window helpers (sliding window via INCR + EXPIRE on first increment)
 _1H_SECONDS = 3600
 _24H_SECONDS = 86400
 
+# Per-event settings, bound once
+_COOLDOWN_SECONDS = settings.default_cooldown_seconds
+_DIGEST_WINDOW = timedelta(minutes=settings.digest_batch_window_minutes)
+_TOPIC_SEND_NOW = settings.kafka_topic_send_now
+_TOPIC_DEFER = settings.kafka_topic_defer
+
 
-async def _increment_fatigue_counters(user_id: str, event_type: str):
-    """Increment sliding-window send counters in Redis."""
+async def _increment_fatigue_counters(event: NotificationEventIn):
+    """Increment sliding-window send counters and start the cooldown, in one round-trip."""
     r = await get_redis()
     try:
-        pipe = r.pipeline()
-        k1h = key_count_1h(user_id)
-        k24h = key_count_24h(user_id)
-
-        await pipe.incr(k1h)
-        await pipe.expire(k1h, _1H_SECONDS, nx=True)
-        await pipe.incr(k24h)
-        await pipe.expire(k24h, _24H_SECONDS, nx=True)
+        pipe = r.pipeline(transaction=False)
+        k1h = key_count_1h(event.user_id)
+        k24h = key_count_24h(event.user_id)
+
+        pipe.incr(k1h)
+        pipe.expire(k1h, _1H_SECONDS, nx=True)
+        pipe.incr(k24h)
+        pipe.expire(k24h, _24H_SECONDS, nx=True)
         # Record last send timestamp for recency scoring
-        await pipe.set(key_last_send(user_id, event_type), datetime.utcnow().timestamp(), ex=_24H_SECONDS)
+        pipe.set(key_last_send(event.user_id, event.event_type), time.time(), ex=_24H_SECONDS)
+        queue_cooldown(pipe, event, ttl_seconds=_COOLDOWN_SECONDS)
         await pipe.execute()
     except Exception as e:
         log.warning("dispatcher.counter_update_failed", error=str(e))
 
 
-async def _persist_event(
+def _digest_bucket(scheduled_at: datetime) -> datetime:
+    """Start of the digest window containing `scheduled_at`."""
+    midnight = scheduled_at.replace(hour=0, minute=0, second=0, microsecond=0)
+    return scheduled_at - (scheduled_at - midnight) % _DIGEST_WINDOW
+
+
+def _digest_upsert(event_id: str, event: NotificationEventIn, scheduled_at: datetime):
+    """
+    Append the event to the pending batch for its user, channel and window,
+    creating the batch if needed: one atomic statement, so concurrent events
+    cannot open duplicate batches. The batch goes out at its latest member's
+    scheduled time, so nothing is delivered before it was scheduled.
+    """
+    stmt = pg_insert(DigestBatch).values(
+        user_id=event.user_id,
+        channel=event.channel.value,
+        event_ids=[event_id],
+        scheduled_at=scheduled_at,
+        bucket_ts=_digest_bucket(scheduled_at),
+        status="pending",
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=[DigestBatch.user_id, DigestBatch.channel, DigestBatch.bucket_ts],
+        # Literal predicate: a bound parameter cannot be matched to the partial index
+        index_where=text("status = 'pending'"),
+        set_={
+            "event_ids": DigestBatch.event_ids.op("||")(stmt.excluded.event_ids),
+            "scheduled_at": func.greatest(DigestBatch.scheduled_at, stmt.excluded.scheduled_at),
+        },
+    )
+
+
+async def _persist_all(
     db: AsyncSession,
     event_id: str,
     event: NotificationEventIn,
@@ -60,10 +112,19 @@ async def _persist_event(
     reason_chain: list[ReasonStep],
     ai_result: ScoringResult,
     rule_matched: Optional[str],
+    now: datetime,
 ):
-    """Write event record to Postgres."""
+    """
+    Write the event row, its audit row and (for LATER) its digest batch.
+    The event row is autoflushed ahead of the audit INSERT; the other two are
+    Core statements. A failed statement aborts the whole transaction, so the
+    error is logged and re-raised: dispatch must not publish or count a
+    decision that was never persisted.
+    """
+    # Each payload is serialized once by pydantic-core and shared by both rows
+    steps = _jsonb(_dump_reason_chain(reason_chain).decode())
     try:
-        record = NotificationEvent(
+        db.add(NotificationEvent(
             id=event_id,
             user_id=event.user_id,
             event_type=event.event_type,
@@ -75,34 +136,20 @@ async def _persist_event(
             dedupe_key=event.dedupe_key,
             computed_fingerprint=fingerprint,
             expires_at=event.expires_at,
-            event_timestamp=event.timestamp or datetime.utcnow(),
+            event_timestamp=event.timestamp or now,
             metadata_=event.metadata or {},
             decision=decision.value,
             score=score,
             scheduled_at=scheduled_at,
-            decision_reason=[s.model_dump() for s in reason_chain],
+            decision_reason=steps,
             ai_used=ai_result.ai_used,
             fallback_used=ai_result.fallback_used,
             rule_matched=rule_matched,
-            processed_at=datetime.utcnow(),
-        )
-        db.add(record)
-    except Exception as e:
-        log.error("dispatcher.persist_event_failed", error=str(e))
-
+            processed_at=now,
+        ))
 
-async def _write_audit_log(
-    db: AsyncSession,
-    event_id: str,
-    event: NotificationEventIn,
-    decision: DecisionEnum,
-    score: Optional[float],
-    ai_result: ScoringResult,
-    rule_matched: Optional[str],
-    reason_chain: list[ReasonStep],
-):
-    try:
-        entry = AuditLog(
+        # Append-only row: a Core INSERT skips the identity map
+        await db.execute(insert(AuditLog).values(
             event_id=event_id,
             user_id=event.user_id,
             event_type=event.event_type,
@@ -111,52 +158,15 @@ async def _write_audit_log(
             ai_used=ai_result.ai_used,
             fallback_used=ai_result.fallback_used,
             rule_matched=rule_matched,
-            reason_chain=[s.model_dump() for s in reason_chain],
-            raw_event=event.model_dump(mode="json"),
-        )
-        db.add(entry)
-    except Exception as e:
-        log.error("dispatcher.audit_log_failed", error=str(e))
-
+            reason_chain=steps,
+            raw_event=_jsonb(event.model_dump_json()),
+        ))
 
-async def _ensure_digest_batch(
-    db: AsyncSession,
-    event_id: str,
-    event: NotificationEventIn,
-    scheduled_at: datetime,
-):
-    """Add event to an existing digest batch or create a new one."""
-    try:
-        # Find an open batch for this user+channel within the batch window
-        window_start = scheduled_at
-        window_end = scheduled_at.replace(
-            minute=((scheduled_at.minute // 30) + 1) * 30 % 60,
-            second=0, microsecond=0,
-        )
-        result = await db.execute(
-            select(DigestBatch).where(
-                DigestBatch.user_id == event.user_id,
-                DigestBatch.channel == event.channel.value,
-                DigestBatch.status == "pending",
-                DigestBatch.scheduled_at >= window_start,
-            ).limit(1)
-        )
-        batch = result.scalar_one_or_none()
-
-        if batch:
-            ids = batch.event_ids or []
-            ids.append(event_id)
-            batch.event_ids = ids
-        else:
-            batch = DigestBatch(
-                user_id=event.user_id,
-                channel=event.channel.value,
-                event_ids=[event_id],
-                scheduled_at=scheduled_at,
-            )
-            db.add(batch)
+        if decision == DecisionEnum.later and scheduled_at:
+            await db.execute(_digest_upsert(event_id, event, scheduled_at))
     except Exception as e:
-        log.warning("dispatcher.digest_batch_failed", error=str(e))
+        log.error("dispatcher.persist_failed", event_id=event_id, error=str(e))
+        raise
 
 
 async def dispatch(
@@ -171,48 +181,48 @@ async def dispatch(
     rule_matched: Optional[str],
     ctx: UserContext,
     db: AsyncSession,
+    now: Optional[datetime] = None,
 ) -> DecisionResult:
     """
     Route the decision and persist all records.
+    `now` is the pipeline's clock reading for this event (read here if omitted).
     Returns the final DecisionResult.
     """
-    now = datetime.utcnow()
+    now = now or datetime.utcnow()
 
-    # ── Persist event + audit log ─────────────────────────────────
-    await _persist_event(
+    # ── Persist event + audit log (+ digest batch) ───────────────
+    await _persist_all(
         db, event_id, event, fingerprint, decision, score,
-        scheduled_at, reason_chain, ai_result, rule_matched
-    )
-    await _write_audit_log(
-        db, event_id, event, decision, score,
-        ai_result, rule_matched, reason_chain
+        scheduled_at, reason_chain, ai_result, rule_matched, now
     )
 
     if decision == DecisionEnum.now:
         # ── NOW: Publish to send queue + update counters ──────────
-        await publish(
-            settings.kafka_topic_send_now,
-            {
-                "event_id": event_id,
-                "user_id": event.user_id,
-                "event_type": event.event_type,
-                "title": event.title,
-                "message": event.message,
-                "channel": event.channel.value,
-                "source": event.source,
-                "metadata": event.metadata,
-                "dispatched_at": now.isoformat(),
-            },
-            key=event.user_id,
+        # Kafka publish and the Redis writes are independent; overlap them
+        await asyncio.gather(
+            publish(
+                _TOPIC_SEND_NOW,
+                {
+                    "event_id": event_id,
+                    "user_id": event.user_id,
+                    "event_type": event.event_type,
+                    "title": event.title,
+                    "message": event.message,
+                    "channel": event.channel.value,
+                    "source": event.source,
+                    "metadata": event.metadata,
+                    "dispatched_at": now.isoformat(),
+                },
+                key=event.user_id,
+            ),
+            _increment_fatigue_counters(event),
         )
-        await _increment_fatigue_counters(event.user_id, event.event_type)
-        await register_cooldown(event, ttl_seconds=settings.default_cooldown_seconds)
         log.info("dispatcher.sent_now", event_id=event_id, user_id=event.user_id, event_type=event.event_type)
 
     elif decision == DecisionEnum.later:
         # ── LATER: Publish to defer queue + digest batch ──────────
         await publish(
-            settings.kafka_topic_defer,
+            _TOPIC_DEFER,
             {
                 "event_id": event_id,
                 "user_id": event.user_id,
@@ -221,8 +231,6 @@ async def dispatch(
             },
             key=event.user_id,
         )
-        if scheduled_at:
-            await _ensure_digest_batch(db, event_id, event, scheduled_at)
         log.info("dispatcher.deferred", event_id=event_id, scheduled_at=scheduled_at)
 
     else:
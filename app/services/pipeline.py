@@ -8,25 +8,61 @@ Pipeline — orchestrates the full evaluation pipeline for a single event.
   L5: Decision arbiter
   L6: Dispatcher
 """
+import asyncio
+import time
 import uuid
-from datetime import datetime
+from datetime import datetime, timezone
+from functools import lru_cache
 from typing import Optional
 
 import structlog
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.config import get_settings
 from app.models.schemas import NotificationEventIn, DecisionResult, ReasonStep, DecisionEnum
 from app.services.dedup import run_dedup_pipeline
 from app.services.rules_engine import evaluate_rules
-from app.services.context_enricher import enrich_context
+from app.services.context_enricher import UserContext, enrich_context
 from app.services.ai_scorer import score_with_ai, score_reason_step, ScoringResult, _heuristic_score
-from app.services.arbiter import arbitrate
+from app.services.arbiter import arbitrate, score_can_change_decision
 from app.services.dispatcher import dispatch
 
 log = structlog.get_logger()
+settings = get_settings()
+
+# Events scoring with Groq at once; past this, events use the heuristic
+# rather than queueing behind a throttled provider.
+_AI_SEM = asyncio.Semaphore(settings.ai_max_concurrency)
+
+# Static step shared by every hard-rule short-circuit
+_AI_SKIPPED_STEP = ReasonStep(
+    layer="L4-AIScorer", check="skipped", result="SKIPPED",
+    detail="AI scoring skipped — hard rule already decided"
+)
+
+
+@lru_cache(maxsize=256)
+def _forced_score(rule_decision: str, rule_name: str) -> ScoringResult:
+    """Placeholder score for a hard-rule decision; frozen, so shared across events."""
+    forced_now = rule_decision == "now"
+    return ScoringResult(
+        score=1.0 if forced_now else 0.0,
+        decision_hint=rule_decision,
+        urgency=1.0 if forced_now else 0.0,
+        engagement=0.5, fatigue_penalty=0.0, recency_bonus=0.5,
+        reasoning=f"Hard rule '{rule_name}' applied",
+        ai_used=False, fallback_used=False,
+    )
+
 
+def _gated_ai_step(result: ScoringResult) -> ReasonStep:
+    return ReasonStep(
+        layer="L4-AIScorer", check="skipped_due_to_gating", result="SKIPPED",
+        detail=f"AI scoring skipped — opt-out, cap or DND decides regardless of score (heuristic score={result.score:.3f})",
+    )
 
-def _expired_result(event_id: str, event: NotificationEventIn) -> DecisionResult:
+
+def _expired_result(event_id: str, event: NotificationEventIn, now: datetime) -> DecisionResult:
     """Return a NEVER decision for expired events."""
     return DecisionResult(
         event_id=event_id,
@@ -41,13 +77,13 @@ def _expired_result(event_id: str, event: NotificationEventIn) -> DecisionResult
         )],
         ai_used=False,
         fallback_used=False,
-        processed_at=datetime.utcnow(),
+        processed_at=now,
     )
 
 
 def _dedup_suppressed_result(
     event_id: str, event: NotificationEventIn,
-    reason: str, steps: list[ReasonStep]
+    reason: str, steps: list[ReasonStep], now: datetime,
 ) -> DecisionResult:
     return DecisionResult(
         event_id=event_id,
@@ -57,7 +93,7 @@ def _dedup_suppressed_result(
         reason_chain=steps,
         ai_used=False,
         fallback_used=False,
-        processed_at=datetime.utcnow(),
+        processed_at=now,
     )
 
 
@@ -65,12 +101,15 @@ async def evaluate_notification(
     event: NotificationEventIn,
     db: AsyncSession,
     event_id: Optional[str] = None,
+    now: Optional[datetime] = None,
 ) -> DecisionResult:
     """
     Full evaluation pipeline. Returns DecisionResult with complete reason chain.
+    `now` (naive UTC) lets batch callers share one clock reading.
     """
     event_id = event_id or str(uuid.uuid4())
-    start_time = datetime.utcnow()
+    now = now or datetime.utcnow()
+    start = time.perf_counter()
 
     log.info(
         "pipeline.start",
@@ -82,72 +121,73 @@ async def evaluate_notification(
 
     # ── L0: Expiry check ─────────────────────────────────────────
     if event.expires_at:
-        now = datetime.utcnow()
         exp = event.expires_at
         # Normalise timezone
-        if exp.tzinfo is not None:
-            from datetime import timezone
-            now = datetime.now(timezone.utc)
-        if exp < now:
+        cutoff = now.replace(tzinfo=timezone.utc) if exp.tzinfo is not None else now
+        if exp < cutoff:
             log.info("pipeline.expired_on_arrival", event_id=event_id)
-            result = _expired_result(event_id, event)
+            result = _expired_result(event_id, event, now)
             return result
 
+    # ── L1 + L2 run concurrently ─────────────────────────────────
+    # Dedup never touches Postgres, so only the rules engine uses the session
+    (suppress_reason, fingerprint, dedup_steps), (rule_decision, rule_name, rule_steps) = (
+        await asyncio.gather(run_dedup_pipeline(event), evaluate_rules(event, db))
+    )
+
     # ── L1: Deduplication ─────────────────────────────────────────
-    suppress_reason, fingerprint, dedup_steps = await run_dedup_pipeline(event)
     if suppress_reason:
         log.info("pipeline.dedup_suppressed", event_id=event_id, reason=suppress_reason)
-        return _dedup_suppressed_result(event_id, event, suppress_reason, dedup_steps)
+        return _dedup_suppressed_result(event_id, event, suppress_reason, dedup_steps, now)
 
     # ── L2: Rules engine ──────────────────────────────────────────
-    rule_decision, rule_name, rule_steps = await evaluate_rules(event, db)
-
     # Short-circuit on hard rules (before expensive context + AI)
     if rule_decision in ("now", "never"):
         # Still need a minimal ScoringResult for dispatcher signature
-        dummy_score = ScoringResult(
-            score=1.0 if rule_decision == "now" else 0.0,
-            decision_hint=rule_decision,
-            urgency=1.0 if rule_decision == "now" else 0.0,
-            engagement=0.5, fatigue_penalty=0.0, recency_bonus=0.5,
-            reasoning=f"Hard rule '{rule_name}' applied",
-            ai_used=False, fallback_used=False,
-        )
-        ai_step = ReasonStep(
-            layer="L4-AIScorer", check="skipped", result="SKIPPED",
-            detail="AI scoring skipped — hard rule already decided"
-        )
-        from app.services.context_enricher import UserContext
+        dummy_score = _forced_score(rule_decision, rule_name)
         dummy_ctx = UserContext(user_id=event.user_id)
         decision, scheduled_at, full_chain, override = arbitrate(
             event, rule_decision, rule_name, dummy_score, dummy_ctx,
-            rule_steps, dedup_steps, ai_step
+            rule_steps, dedup_steps, _AI_SKIPPED_STEP, now,
         )
         return await dispatch(
             event_id, event, fingerprint, decision, dummy_score.score,
-            scheduled_at, full_chain, dummy_score, override, dummy_ctx, db
+            scheduled_at, full_chain, dummy_score, override, dummy_ctx, db, now,
         )
 
     # ── L3: Context enrichment ─────────────────────────────────────
+    # Only for events still undecided, on the request session: no second
+    # pooled connection per event
     ctx = await enrich_context(event, db)
 
     # ── L4: AI scoring ────────────────────────────────────────────
-    ai_result = await score_with_ai(event, ctx, db=db, event_id=event_id)
-    ai_step = score_reason_step(ai_result)
+    if not score_can_change_decision(event, ctx):
+        # Opt-out, cap or DND decides regardless of score: skip the Groq call
+        ai_result = _heuristic_score(event, ctx, fallback_reason="skipped_due_to_gating")
+        ai_step = _gated_ai_step(ai_result)
+    elif _AI_SEM.locked():
+        log.warning("pipeline.ai_saturated", event_id=event_id)
+        ai_result = _heuristic_score(event, ctx, fallback_reason="ai_concurrency_limit")
+        ai_step = score_reason_step(ai_result)
+    else:
+        # score_with_ai is already bounded by the Groq timeout
+        async with _AI_SEM:
+            ai_result = await score_with_ai(event, ctx, db=db, event_id=event_id)
+        ai_step = score_reason_step(ai_result)
 
     # ── L5: Decision arbitration ──────────────────────────────────
     decision, scheduled_at, full_chain, override = arbitrate(
         event, rule_decision, rule_name, ai_result, ctx,
-        rule_steps, dedup_steps, ai_step
+        rule_steps, dedup_steps, ai_step, now,
     )
 
     # ── L6: Dispatch ──────────────────────────────────────────────
     result = await dispatch(
         event_id, event, fingerprint, decision, ai_result.score,
-        scheduled_at, full_chain, ai_result, override, ctx, db
+        scheduled_at, full_chain, ai_result, override, ctx, db, now,
     )
 
-    elapsed_ms = (datetime.utcnow() - start_time).total_seconds() * 1000
+    elapsed_ms = (time.perf_counter() - start) * 1000
     log.info(
         "pipeline.complete",
         event_id=event_id,
@@ -1,13 +1,17 @@
 """
 Rules Engine — evaluates human-configurable rules from Redis cache.
-Rules are stored in Postgres and hot-reloaded into Redis on change.
+Rules are stored in Postgres, shared between workers through Redis and
+dropped from it on every change.
 No code deployment required to update rules.
 """
-import json
+import random
 import asyncio
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional, Tuple
+from functools import lru_cache
+from typing import Any, Callable, Optional, Tuple
 
+import orjson
 import structlog
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
@@ -15,15 +19,36 @@ from sqlalchemy import select
 from app.config import get_settings
 from app.models.schemas import NotificationEventIn, ReasonStep
 from app.models.tables import RuleConfig
-from app.utils.redis_client import get_redis, key_rules_cache
+from app.services.context_enricher import _dnd_bits
+from app.utils.redis_client import cache_set, get_redis, key_rules_cache, key_rules_invalidate, key_rules_list
 
 log = structlog.get_logger()
 settings = get_settings()
 
+
+@dataclass(slots=True, frozen=True)
+class CompiledRule:
+    id: str
+    rule_name: str
+    rule_type: str
+    action_params: dict
+    matcher: Callable[[dict], bool]
+    always_match: bool                       # nothing left for matcher to test
+    event_types: Optional[frozenset] = None  # pinned event types, if any
+    quiet_mask: int = 0                      # quiet_hours only
+
+
 # In-memory rule cache (reloaded periodically)
-_rules_cache: list[dict] = []
+_rules_cache: tuple[CompiledRule, ...] = ()
 _rules_loaded_at: datetime | None = None
 _CACHE_TTL_SECONDS = 30
+# Each load draws its own TTL in [30, 35)s so workers don't all hit Postgres together
+_CACHE_TTL_JITTER_SECONDS = 5
+_rules_ttl: float = _CACHE_TTL_SECONDS
+_refresh_lock = asyncio.Lock()
+# event_type -> candidate rules in priority order, plus the candidates for
+# any other event type (rules that do not pin event_type); swapped as one
+_rules_index: tuple[dict[str, tuple[CompiledRule, ...]], tuple[CompiledRule, ...]] = ({}, ())
 
 
 async def _load_rules_from_db(db: AsyncSession) -> list[dict]:
@@ -46,36 +71,141 @@ async def _load_rules_from_db(db: AsyncSession) -> list[dict]:
     ]
 
 
-async def get_active_rules(db: AsyncSession | None = None) -> list[dict]:
-    """Get rules from in-memory cache, refresh if stale."""
-    global _rules_cache, _rules_loaded_at
+async def _load_rules(db: AsyncSession) -> list[dict]:
+    """
+    Rules from the shared Redis copy; on a miss, from Postgres, writing the
+    copy back so other workers skip the query. Matchers are not stored —
+    they are compiled locally by _compile_rule.
+    """
+    r = None
+    try:
+        r = await get_redis()
+        blob = await r.get(key_rules_cache())
+        if blob:
+            return orjson.loads(blob)
+    except Exception as e:
+        log.warning("rules_engine.redis_read_failed", error=str(e))
+
+    rules = await _load_rules_from_db(db)
+    if r is not None:
+        try:
+            await cache_set(r, key_rules_cache(), orjson.dumps(rules))
+        except Exception as e:
+            log.warning("rules_engine.redis_write_failed", error=str(e))
+    return rules
+
 
-    now = datetime.utcnow()
-    cache_age = (now - _rules_loaded_at).total_seconds() if _rules_loaded_at else 999
+def _pinned_event_types(conditions: dict) -> Optional[frozenset]:
+    """Event types a rule is limited to, or None if it does not pin event_type."""
+    cond = conditions.get("event_type")
+    if cond is None or isinstance(cond, dict):
+        return None
+    try:
+        return frozenset(cond) if isinstance(cond, list) else frozenset((cond,))
+    except TypeError:
+        return None
 
-    if cache_age > _CACHE_TTL_SECONDS and db:
-        _rules_cache = await _load_rules_from_db(db)
-        _rules_loaded_at = now
-        log.info("rules_engine.cache_refreshed", count=len(_rules_cache))
+
+def _compile_rule(rule: dict) -> CompiledRule:
+    """
+    Compile one loaded rule. A rule that pins event_type gets a matcher for
+    its remaining conditions only, since it is only ever tried for those types.
+    """
+    conditions = rule["conditions"] or {}
+    action_params = rule["action_params"] or {}
+    event_types = _pinned_event_types(conditions)
+    residual = conditions
+    if event_types is not None:
+        residual = {k: v for k, v in conditions.items() if k != "event_type"}
+    return CompiledRule(
+        id=rule["id"],
+        rule_name=rule["rule_name"],
+        rule_type=rule["rule_type"],
+        action_params=action_params,
+        matcher=_matcher_for(residual),
+        always_match=not residual,
+        event_types=event_types,
+        quiet_mask=_quiet_mask(action_params) if rule["rule_type"] == "quiet_hours" else 0,
+    )
+
+
+def _build_rules_index(
+    rules: tuple[CompiledRule, ...],
+) -> tuple[dict[str, tuple[CompiledRule, ...]], tuple[CompiledRule, ...]]:
+    """Bucket rules by the event types they pin. Buckets keep the original rule order."""
+    all_types = set().union(*(r.event_types for r in rules if r.event_types))
+    by_type = {
+        et: tuple(r for r in rules if r.event_types is None or et in r.event_types)
+        for et in all_types
+    }
+    unpinned = tuple(r for r in rules if r.event_types is None)
+    return by_type, unpinned
+
+
+def _rules_stale(now: datetime) -> bool:
+    if _rules_loaded_at is None:
+        return True
+    return (now - _rules_loaded_at).total_seconds() > _rules_ttl
+
+
+async def get_active_rules(db: AsyncSession | None = None) -> tuple[CompiledRule, ...]:
+    """Get rules from in-memory cache, refresh if stale."""
+    global _rules_cache, _rules_loaded_at, _rules_index, _rules_ttl
+
+    if db and _rules_stale(datetime.utcnow()):
+        async with _refresh_lock:
+            # Whoever held the lock before us may have just refreshed
+            if _rules_stale(datetime.utcnow()):
+                compiled = tuple(_compile_rule(r) for r in await _load_rules(db))
+                _rules_index = _build_rules_index(compiled)
+                _rules_cache = compiled
+                _rules_ttl = _CACHE_TTL_SECONDS + random.uniform(0, _CACHE_TTL_JITTER_SECONDS)
+                _rules_loaded_at = datetime.utcnow()
+                log.info("rules_engine.cache_refreshed", count=len(_rules_cache))
 
     return _rules_cache
 
 
 async def invalidate_rules_cache():
-    """Called after rule CRUD operations."""
+    """Called after rule CRUD operations; every worker drops its cache."""
     global _rules_loaded_at
     _rules_loaded_at = None
+    try:
+        r = await get_redis()
+        async with r.pipeline(transaction=False) as pipe:
+            pipe.delete(key_rules_cache(), key_rules_list(True), key_rules_list(False))
+            pipe.publish(key_rules_invalidate(), "1")
+            await pipe.execute()
+    except Exception as e:
+        log.warning("rules_engine.list_cache_invalidate_failed", error=str(e))
     log.info("rules_engine.cache_invalidated")
 
 
-def _matches_conditions(event: NotificationEventIn, conditions: dict) -> bool:
+async def listen_for_rule_invalidations():
     """
-    Evaluate conditions against event fields.
-    Condition keys map to event fields; values can be:
-      - A list (event field must be IN the list)
-      - A single value (exact match)
-      - A dict with operators: {"gte": 5}, {"contains": "fail"}
+    Background task: mark the local rule cache stale whenever any worker
+    publishes on the invalidation channel. Resubscribes after Redis errors.
     """
+    global _rules_loaded_at
+    while True:
+        try:
+            r = await get_redis()
+            async with r.pubsub() as pubsub:
+                await pubsub.subscribe(key_rules_invalidate())
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        _rules_loaded_at = None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("rules_engine.invalidation_listener_failed", error=str(e))
+            # Anything published while we were away is lost; reload to be safe
+            _rules_loaded_at = None
+            await asyncio.sleep(1)
+
+
+def _event_fields(event: NotificationEventIn) -> dict:
+    """The event fields conditions can test; built once per event."""
     event_dict = {
         "event_type": event.event_type,
         "source": event.source,
@@ -86,123 +216,253 @@ def _matches_conditions(event: NotificationEventIn, conditions: dict) -> bool:
     # Merge metadata into checkable fields
     if event.metadata:
         event_dict.update({f"meta.{k}": v for k, v in event.metadata.items()})
+    return event_dict
 
-    for cond_key, cond_val in conditions.items():
-        event_val = event_dict.get(cond_key)
 
-        if isinstance(cond_val, list):
-            if event_val not in cond_val:
+def _membership(values: list) -> Callable[[Any], bool]:
+    """`v in values`, via a frozenset when the values are hashable."""
+    try:
+        members = frozenset(values)
+    except TypeError:
+        return values.__contains__
+
+    def contains(v: Any) -> bool:
+        try:
+            return v in members
+        except TypeError:  # Unhashable event value (e.g. a metadata list)
+            return v in values
+    return contains
+
+
+def _op_contains(operand: str) -> Callable[[Any], bool]:
+    needle = operand.lower()
+    return lambda v: bool(v) and needle in str(v).lower()
+
+
+def _op_not_in(operand: list) -> Callable[[Any], bool]:
+    is_member = _membership(operand)
+    return lambda v: not is_member(v)
+
+
+# Operator name -> factory that bakes the operand into a check
+_OPERATORS: dict[str, Callable[[Any], Callable[[Any], bool]]] = {
+    "gte": lambda o: lambda v: v is not None and v >= o,
+    "lte": lambda o: lambda v: v is not None and v <= o,
+    "contains": _op_contains,
+    "not_in": _op_not_in,
+}
+
+
+def _compile_operators(ops: dict) -> Callable[[Any], bool]:
+    # Unknown operators are ignored
+    checks = [_OPERATORS[op](operand) for op, operand in ops.items() if op in _OPERATORS]
+    if len(checks) == 1:
+        return checks[0]
+
+    def match(v: Any) -> bool:
+        for check in checks:
+            if not check(v):
                 return False
+        return True
+    return match
+
+
+def _compile_conditions(conditions: dict) -> Callable[[dict], bool]:
+    """
+    Compile rule conditions once into a matcher over _event_fields().
+    Condition keys map to event fields; values can be:
+      - A list (event field must be IN the list)
+      - A single value (exact match)
+      - A dict with operators: {"gte": 5}, {"contains": "fail"}
+    """
+    checks: list[tuple[str, Callable[[Any], bool]]] = []
+    for cond_key, cond_val in conditions.items():
+        if isinstance(cond_val, list):
+            checks.append((cond_key, _membership(cond_val)))
         elif isinstance(cond_val, dict):
-            # Operator-based conditions
-            for op, operand in cond_val.items():
-                if op == "gte" and not (event_val is not None and event_val >= operand):
-                    return False
-                elif op == "lte" and not (event_val is not None and event_val <= operand):
-                    return False
-                elif op == "contains" and not (
-                    event_val and operand.lower() in str(event_val).lower()
-                ):
-                    return False
-                elif op == "not_in" and event_val in operand:
-                    return False
+            checks.append((cond_key, _compile_operators(cond_val)))
         else:
-            if event_val != cond_val:
+            checks.append((cond_key, lambda v, c=cond_val: v == c))
+
+    if len(checks) == 1:
+        # Most rules test one field; skip the loop
+        (key, check), = checks
+        return lambda fields: check(fields.get(key))
+
+    def matcher(fields: dict) -> bool:
+        for key, check in checks:
+            if not check(fields.get(key)):
                 return False
+        return True
+    return matcher
 
-    return True
 
+@lru_cache(maxsize=1024)
+def _compile_conditions_json(key: bytes) -> Callable[[dict], bool]:
+    return _compile_conditions(orjson.loads(key))
 
-def _is_quiet_hours(action_params: dict) -> bool:
-    """Check if current UTC hour falls in defined quiet hours."""
-    now_hour = datetime.utcnow().hour
+
+def _matcher_for(conditions: dict) -> Callable[[dict], bool]:
+    """
+    _compile_conditions, cached by content (not id(), which is reused after
+    GC), so identical conditions share one matcher across rule reloads.
+    """
+    try:
+        key = orjson.dumps(conditions, option=orjson.OPT_SORT_KEYS)
+    except TypeError:  # Not JSON (only possible for hand-built conditions)
+        return _compile_conditions(conditions)
+    return _compile_conditions_json(key)
+
+
+def _matches_conditions(event: NotificationEventIn, conditions: dict) -> bool:
+    """Evaluate conditions against event fields (see _compile_conditions)."""
+    return _matcher_for(conditions)(_event_fields(event))
+
+
+def _quiet_mask(action_params: dict) -> int:
+    """24-bit mask with one bit set per quiet UTC hour."""
     start = action_params.get("start_hour", 22)
     end = action_params.get("end_hour", 8)
-    if start > end:  # Overnight (e.g. 22 → 8)
-        return now_hour >= start or now_hour < end
-    return start <= now_hour < end
+    return _dnd_bits(start, end)
 
 
-async def evaluate_rules(
-    event: NotificationEventIn,
-    db: AsyncSession | None = None,
-) -> Tuple[Optional[str], Optional[str], list[ReasonStep]]:
-    """
-    Evaluate all active rules against event.
-    Returns: (decision | None, rule_name | None, reason_steps)
-    decision is None if no rule fires a hard outcome.
-    """
-    rules = await get_active_rules(db)
-    steps: list[ReasonStep] = []
+def _is_quiet_hours(action_params: dict, now: datetime | None = None) -> bool:
+    """Check if the UTC hour of `now` (default: current time) falls in defined quiet hours."""
+    now = now or datetime.utcnow()
+    return bool((_quiet_mask(action_params) >> now.hour) & 1)
 
-    for rule in rules:
-        rule_type = rule["rule_type"]
-        conditions = rule["conditions"]
-        action_params = rule.get("action_params", {})
-        rule_name = rule["rule_name"]
 
-        if not _matches_conditions(event, conditions):
-            continue
+def _rule_outcome(rule: CompiledRule, channel: str, now_hour: int) -> Tuple[Optional[str], ReasonStep]:
+    """Outcome of a rule that matched: (decision | None, reason step)."""
+    rule_type = rule.rule_type
+    action_params = rule.action_params
+    rule_name = rule.rule_name
+
+    # ── Force NOW ──────────────────────────────────────────────
+    if rule_type == "force_now":
+        return "now", ReasonStep(
+            layer="L2-Rules",
+            check=f"rule:{rule_name}",
+            result="FORCE_NOW",
+            detail=f"Rule '{rule_name}' forces immediate delivery",
+        )
+
+    # ── Force NEVER ────────────────────────────────────────────
+    elif rule_type == "force_never":
+        return "never", ReasonStep(
+            layer="L2-Rules",
+            check=f"rule:{rule_name}",
+            result="FORCE_NEVER",
+            detail=f"Rule '{rule_name}' suppresses this notification",
+        )
 
-        # ── Force NOW ──────────────────────────────────────────────
-        if rule_type == "force_now":
-            step = ReasonStep(
+    # ── Quiet Hours ────────────────────────────────────────────
+    elif rule_type == "quiet_hours":
+        if (rule.quiet_mask >> now_hour) & 1:
+            return "later", ReasonStep(
                 layer="L2-Rules",
                 check=f"rule:{rule_name}",
-                result="FORCE_NOW",
-                detail=f"Rule '{rule_name}' forces immediate delivery",
+                result="DEFER",
+                detail=f"Quiet hours active ({action_params.get('start_hour')}–{action_params.get('end_hour')} UTC)",
             )
-            steps.append(step)
-            return "now", rule_name, steps
 
-        # ── Force NEVER ────────────────────────────────────────────
-        elif rule_type == "force_never":
-            step = ReasonStep(
+    # ── Channel Override ───────────────────────────────────────
+    elif rule_type == "channel_override":
+        allowed_channels = action_params.get("allowed_channels", [])
+        if channel not in allowed_channels:
+            return "never", ReasonStep(
                 layer="L2-Rules",
                 check=f"rule:{rule_name}",
                 result="FORCE_NEVER",
-                detail=f"Rule '{rule_name}' suppresses this notification",
+                detail=f"Channel '{channel}' not in allowed: {allowed_channels}",
             )
-            steps.append(step)
-            return "never", rule_name, steps
-
-        # ── Quiet Hours ────────────────────────────────────────────
-        elif rule_type == "quiet_hours":
-            if _is_quiet_hours(action_params):
-                step = ReasonStep(
-                    layer="L2-Rules",
-                    check=f"rule:{rule_name}",
-                    result="DEFER",
-                    detail=f"Quiet hours active ({action_params.get('start_hour')}–{action_params.get('end_hour')} UTC)",
-                )
-                steps.append(step)
-                return "later", rule_name, steps
-
-        # ── Channel Override ───────────────────────────────────────
-        elif rule_type == "channel_override":
-            allowed_channels = action_params.get("allowed_channels", [])
-            if event.channel.value not in allowed_channels:
-                step = ReasonStep(
-                    layer="L2-Rules",
-                    check=f"rule:{rule_name}",
-                    result="FORCE_NEVER",
-                    detail=f"Channel '{event.channel.value}' not in allowed: {allowed_channels}",
-                )
-                steps.append(step)
-                return "never", rule_name, steps
-
-        # Log matching rule that didn't force a decision (e.g. cooldown hint)
-        steps.append(ReasonStep(
-            layer="L2-Rules",
-            check=f"rule:{rule_name}",
-            result="MATCHED_NO_FORCE",
-            detail=f"Rule '{rule_name}' matched but did not force decision",
-        ))
 
-    steps.append(ReasonStep(
+    # Log matching rule that didn't force a decision (e.g. cooldown hint)
+    return None, ReasonStep(
+        layer="L2-Rules",
+        check=f"rule:{rule_name}",
+        result="MATCHED_NO_FORCE",
+        detail=f"Rule '{rule_name}' matched but did not force decision",
+    )
+
+
+def _no_match_step(rule_count: int) -> ReasonStep:
+    return ReasonStep(
         layer="L2-Rules",
         check="rules_evaluation",
         result="NO_MATCH",
-        detail=f"Evaluated {len(rules)} rules — no hard outcome",
-    ))
+        detail=f"Evaluated {rule_count} rules — no hard outcome",
+    )
+
+
+async def evaluate_rules(
+    event: NotificationEventIn,
+    db: AsyncSession | None = None,
+) -> Tuple[Optional[str], Optional[str], list[ReasonStep]]:
+    """
+    Evaluate all active rules against event.
+    Returns: (decision | None, rule_name | None, reason_steps)
+    decision is None if no rule fires a hard outcome.
+    """
+    await get_active_rules(db)
+    by_type, unpinned = _rules_index
+    rules = by_type.get(event.event_type, unpinned)
+    steps: list[ReasonStep] = []
+    fields = _event_fields(event)
+    channel = fields["channel"]
+    now_hour = datetime.utcnow().hour
+
+    for rule in rules:
+        if not rule.always_match and not rule.matcher(fields):
+            continue
+        decision, step = _rule_outcome(rule, channel, now_hour)
+        steps.append(step)
+        if decision is not None:
+            return decision, rule.rule_name, steps
+
+    steps.append(_no_match_step(len(rules)))
     return None, None, steps
+
+
+async def evaluate_rules_batch(
+    events: list[NotificationEventIn],
+    db: AsyncSession | None = None,
+) -> list[Tuple[Optional[str], Optional[str], list[ReasonStep]]]:
+    """
+    evaluate_rules for many events at once, results in input order.
+    Events are grouped by event_type and each candidate rule runs over all
+    still-undecided events of the group before the next rule; events drop
+    out of the pool as soon as a rule decides them.
+    """
+    await get_active_rules(db)
+    by_type, unpinned = _rules_index
+    now_hour = datetime.utcnow().hour
+
+    fields = [_event_fields(e) for e in events]
+    steps: list[list[ReasonStep]] = [[] for _ in events]
+    results: list = [None] * len(events)
+    groups: dict[str, list[int]] = {}
+    for i, event in enumerate(events):
+        groups.setdefault(event.event_type, []).append(i)
+
+    for event_type, pool in groups.items():
+        rules = by_type.get(event_type, unpinned)
+        for rule in rules:
+            if not pool:
+                break
+            undecided = []
+            for i in pool:
+                f = fields[i]
+                if rule.always_match or rule.matcher(f):
+                    decision, step = _rule_outcome(rule, f["channel"], now_hour)
+                    steps[i].append(step)
+                    if decision is not None:
+                        results[i] = (decision, rule.rule_name, steps[i])
+                        continue
+                undecided.append(i)
+            pool = undecided
+        for i in pool:
+            steps[i].append(_no_match_step(len(rules)))
+            results[i] = (None, None, steps[i])
+
+    return results
@@ -1,49 +1,96 @@
 """
 Scheduler — background worker that processes deferred notifications.
-Runs on a configurable poll interval, picks up due DigestBatches,
-and moves them to the send_now_queue.
+Wakes when a DigestBatch is inserted (Postgres NOTIFY) or the earliest
+pending batch falls due, with the poll interval as an upper bound, and
+moves due batches to the send_now_queue. Also keeps the monthly log
+partitions rolling forward.
 """
 import asyncio
 from datetime import datetime
+from itertools import chain
 
+import asyncpg
 import structlog
-from sqlalchemy import select, update
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+from sqlalchemy import exists, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import load_only
 
 from app.config import get_settings
-from app.models.tables import Base, DigestBatch, NotificationEvent
-from app.utils.kafka_client import publish
+from app.models.database import AsyncSessionLocal, DIGEST_NOTIFY_CHANNEL, engine, ensure_log_partitions
+from app.models.tables import DigestBatch, NotificationEvent
+from app.utils.kafka_client import publish_batch
 
 log = structlog.get_logger()
 settings = get_settings()
 
 
-async def process_due_batches(db: AsyncSession):
-    """Find and dispatch all digest batches that are due."""
+_CLAIM_LIMIT = 100
+_PARTITION_CHECK_SECONDS = 6 * 3600
+_MESSAGE_COLUMNS = (
+    NotificationEvent.id, NotificationEvent.user_id, NotificationEvent.event_type,
+    NotificationEvent.title, NotificationEvent.message, NotificationEvent.channel,
+    NotificationEvent.source, NotificationEvent.metadata_, NotificationEvent.expires_at,
+)
+
+
+def _digest_sort_key(event: NotificationEvent) -> int:
+    # sorted() calls this once per event (decorate-sort-undecorate), not per comparison
+    return event.metadata_.get("priority_order", 5)
+
+
+async def process_due_batches(db: AsyncSession) -> int:
+    """Find and dispatch digest batches that are due; returns how many were claimed."""
     now = datetime.utcnow()
 
-    result = await db.execute(
-        select(DigestBatch).where(
+    # Claim due batches in one statement. SKIP LOCKED lets several schedulers
+    # run side by side, each taking rows the others have not locked.
+    due = (
+        select(DigestBatch.id)
+        .where(
             DigestBatch.status == "pending",
             DigestBatch.scheduled_at <= now,
-        ).limit(100)
+        )
+        .order_by(DigestBatch.scheduled_at)
+        .limit(_CLAIM_LIMIT)
+        .with_for_update(skip_locked=True)
+    )
+    result = await db.execute(
+        update(DigestBatch)
+        .where(DigestBatch.id.in_(due))
+        .values(status="processing")
+        .returning(DigestBatch),
+        execution_options={"synchronize_session": False},
     )
     batches = result.scalars().all()
 
     if not batches:
-        return
+        await db.commit()
+        return 0
 
     log.info("scheduler.processing_batches", count=len(batches))
 
+    # Fetch event details for every batch in one query. A claim can cover
+    # thousands of events, so stream them in chunks and load only the
+    # columns a message needs (not the decision_reason JSONB).
+    all_ids = set(chain.from_iterable(b.event_ids or [] for b in batches))
+    events = await db.stream_scalars(
+        select(NotificationEvent)
+        .where(NotificationEvent.id.in_(all_ids))
+        .options(load_only(*_MESSAGE_COLUMNS))
+        .execution_options(yield_per=200)
+    )
+    events_by_id = {e.id: e async for e in events}
+
+    # Final status per batch, written back in one UPDATE per status.
+    # Failed batches go back to pending for the next poll.
+    outcome: dict[str, list[str]] = {"sent": [], "cancelled": [], "pending": []}
+    # One message per entry in `sending`, all published after the loop
+    messages: list[tuple[str, dict, str | None]] = []
+    sending: list[tuple[DigestBatch, int]] = []
+
     for batch in batches:
         try:
-            # Fetch event details for all events in batch
-            event_result = await db.execute(
-                select(NotificationEvent).where(
-                    NotificationEvent.id.in_(batch.event_ids or [])
-                )
-            )
-            events = event_result.scalars().all()
+            events = [events_by_id[i] for i in batch.event_ids or [] if i in events_by_id]
 
             # Filter out expired events
             valid_events = [
@@ -53,15 +100,14 @@ async def process_due_batches(db: AsyncSession):
 
             if not valid_events:
                 log.info("scheduler.batch_all_expired", batch_id=batch.id)
-                batch.status = "cancelled"
-                batch.sent_at = now
+                outcome["cancelled"].append(batch.id)
                 continue
 
-            # Publish digest to send_now_queue
+            # Queue for send_now_queue
             if len(valid_events) == 1:
                 # Single event — send directly
                 e = valid_events[0]
-                await publish(
+                messages.append((
                     settings.kafka_topic_send_now,
                     {
                         "event_id": e.id,
@@ -75,8 +121,8 @@ async def process_due_batches(db: AsyncSession):
                         "dispatched_at": now.isoformat(),
                         "scheduled_send": True,
                     },
-                    key=e.user_id,
-                )
+                    e.user_id,
+                ))
             else:
                 # Multiple events — send as digest
                 digest_items = [
@@ -87,9 +133,9 @@ async def process_due_batches(db: AsyncSession):
                         "message": e.message,
                         "source": e.source,
                     }
-                    for e in sorted(valid_events, key=lambda x: x.metadata_.get("priority_order", 5))
+                    for e in sorted(valid_events, key=_digest_sort_key)
                 ]
-                await publish(
+                messages.append((
                     settings.kafka_topic_send_now,
                     {
                         "batch_id": batch.id,
@@ -100,42 +146,128 @@ async def process_due_batches(db: AsyncSession):
                         "item_count": len(digest_items),
                         "dispatched_at": now.isoformat(),
                     },
-                    key=batch.user_id,
-                )
-
-            batch.status = "sent"
-            batch.sent_at = now
-            log.info(
-                "scheduler.batch_sent",
-                batch_id=batch.id,
-                user_id=batch.user_id,
-                event_count=len(valid_events),
-            )
+                    batch.user_id,
+                ))
+            sending.append((batch, len(valid_events)))
 
         except Exception as e:
             log.error("scheduler.batch_error", batch_id=batch.id, error=str(e))
+            outcome["pending"].append(batch.id)
 
+    for (batch, event_count), ok in zip(sending, await publish_batch(messages)):
+        if not ok:
+            outcome["pending"].append(batch.id)
+            continue
+        outcome["sent"].append(batch.id)
+        log.info(
+            "scheduler.batch_sent",
+            batch_id=batch.id,
+            user_id=batch.user_id,
+            event_count=event_count,
+        )
+
+    for status, ids in outcome.items():
+        if ids:
+            await db.execute(
+                update(DigestBatch)
+                .where(DigestBatch.id.in_(ids))
+                .values(status=status, sent_at=None if status == "pending" else now),
+                execution_options={"synchronize_session": False},
+            )
     await db.commit()
+    return len(batches)
 
 
-async def run_scheduler():
-    """Main scheduler loop."""
-    log.info("scheduler.starting", poll_interval=settings.scheduler_poll_interval_seconds)
+async def _has_due_batches() -> bool:
+    """Cheap EXISTS probe on a pooled connection; no session or ORM state."""
+    probe = select(exists().where(
+        DigestBatch.status == "pending",
+        DigestBatch.scheduled_at <= datetime.utcnow(),
+    ))
+    async with engine.connect() as conn:
+        return bool(await conn.scalar(probe))
+
 
-    engine = create_async_engine(settings.database_url, echo=False)
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+async def _seconds_until_next_batch() -> float:
+    """Time until the earliest pending batch that is not yet due, capped at the poll interval."""
+    now = datetime.utcnow()
+    async with engine.connect() as conn:
+        next_at = await conn.scalar(
+            select(func.min(DigestBatch.scheduled_at)).where(
+                DigestBatch.status == "pending",
+                DigestBatch.scheduled_at > now,
+            )
+        )
+    poll = settings.scheduler_poll_interval_seconds
+    if next_at is None:
+        return poll
+    return min(max((next_at - now).total_seconds(), 0.0), poll)
+
+
+async def _listen_for_new_batches(wake: asyncio.Event):
+    """Set `wake` on every digest insert; reconnects if the connection drops."""
+    dsn = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(dsn)
+            closed = asyncio.Event()
+            conn.add_termination_listener(lambda _: closed.set())
+            await conn.add_listener(DIGEST_NOTIFY_CHANNEL, lambda *_: wake.set())
+            wake.set()  # Inserts while we were not listening were missed
+            await closed.wait()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("scheduler.listen_failed", error=str(e))
+        finally:
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        await asyncio.sleep(1)
 
-    SessionLocal = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+async def _maintain_log_partitions():
+    """Create upcoming monthly partitions while the process runs, so a new
+    month never starts out in the DEFAULT partition."""
     while True:
         try:
-            async with SessionLocal() as db:
-                await process_due_batches(db)
+            await ensure_log_partitions()
         except Exception as e:
-            log.error("scheduler.loop_error", error=str(e))
+            log.error("scheduler.partition_maintenance_failed", error=str(e))
+        await asyncio.sleep(_PARTITION_CHECK_SECONDS)
+
+
+async def run_scheduler():
+    """
+    Main scheduler loop. Tables (and the NOTIFY trigger) are created by the
+    API on startup (create_tables), which docker-compose starts first.
+    """
+    log.info("scheduler.starting", poll_interval=settings.scheduler_poll_interval_seconds)
+
+    wake = asyncio.Event()
+    listener = asyncio.create_task(_listen_for_new_batches(wake))
+    partitions = asyncio.create_task(_maintain_log_partitions())
+    try:
+        while True:
+            wake.clear()
+            delay = settings.scheduler_poll_interval_seconds
+            try:
+                claimed = 0
+                if await _has_due_batches():
+                    async with AsyncSessionLocal() as db:
+                        claimed = await process_due_batches(db)
+                # A full claim means more may already be due
+                delay = 0 if claimed == _CLAIM_LIMIT else await _seconds_until_next_batch()
+            except Exception as e:
+                log.error("scheduler.loop_error", error=str(e))
 
-        await asyncio.sleep(settings.scheduler_poll_interval_seconds)
+            try:
+                await asyncio.wait_for(wake.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        listener.cancel()
+        partitions.cancel()
 
 
 if __name__ == "__main__":
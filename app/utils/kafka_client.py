@@ -1,7 +1,10 @@
+import asyncio
+
 from aiokafka import AIOKafkaProducer, AIOKafkaConsumer
+from circuitbreaker import CircuitBreaker, CircuitBreakerError
 from app.config import get_settings
+import orjson
 import structlog
-import json
 
 log = structlog.get_logger()
 settings = get_settings()
@@ -14,7 +17,8 @@ async def get_producer() -> AIOKafkaProducer:
     if _producer is None:
         _producer = AIOKafkaProducer(
             bootstrap_servers=settings.kafka_bootstrap_servers,
-            value_serializer=lambda v: json.dumps(v).encode("utf-8"),
+            # orjson emits bytes directly (and handles datetimes)
+            value_serializer=orjson.dumps,
             key_serializer=lambda k: k.encode("utf-8") if k else None,
             acks="all",
             enable_idempotence=True,
@@ -33,21 +37,87 @@ async def close_producer():
         _producer = None
 
 
+# One breaker for every publish path: after 5 consecutive failures, sends are
+# dropped (logged) for 30s instead of each waiting out request_timeout_ms
+_kafka_breaker = CircuitBreaker(
+    failure_threshold=5,
+    recovery_timeout=30,
+    expected_exception=Exception,
+    name="kafka_publish",
+)
+
+
+@_kafka_breaker
+async def _send_and_wait(topic: str, payload: dict, key: str | None):
+    producer = await get_producer()
+    await producer.send_and_wait(topic, value=payload, key=key)
+
+
+@_kafka_breaker
+async def _send_batch(messages: list[tuple[str, dict, str | None]]) -> list:
+    """Send and flush; returns each delivery's result or exception. Raises if none were delivered."""
+    producer = await get_producer()
+    # send() only enqueues; it awaits just when the producer's buffer is
+    # full, which is the back-pressure a semaphore would otherwise add.
+    # A message rejected up front (e.g. too large) fails alone: the ones
+    # already queued are delivered and must be reported as such.
+    results: list = []
+    for topic, payload, key in messages:
+        try:
+            results.append(await producer.send(topic, value=payload, key=key))
+        except Exception as e:
+            results.append(e)
+    await producer.flush()
+    queued = [i for i, res in enumerate(results) if not isinstance(res, Exception)]
+    delivered = await asyncio.gather(*(results[i] for i in queued), return_exceptions=True)
+    for i, res in zip(queued, delivered):
+        results[i] = res
+    if all(isinstance(res, Exception) for res in results):
+        raise results[0]
+    return results
+
+
 async def publish(topic: str, payload: dict, key: str | None = None):
     """Publish a message to a Kafka topic. Fails silently (logged) to not block API."""
     try:
-        producer = await get_producer()
-        await producer.send_and_wait(topic, value=payload, key=key)
+        await _send_and_wait(topic, payload, key)
+    except CircuitBreakerError:
+        log.warning("kafka.circuit_open_dropped", topic=topic)
     except Exception as e:
         log.warning("kafka.publish_failed", topic=topic, error=str(e))
 
 
+async def publish_batch(messages: list[tuple[str, dict, str | None]]) -> list[bool]:
+    """
+    Publish (topic, payload, key) messages with one flush instead of one
+    acked round-trip each, so the producer can coalesce them into batches.
+    Returns per-message success; failures are logged, never raised.
+    """
+    if not messages:
+        return []
+    try:
+        results = await _send_batch(messages)
+    except CircuitBreakerError:
+        log.warning("kafka.circuit_open_dropped", count=len(messages))
+        return [False] * len(messages)
+    except Exception as e:
+        log.warning("kafka.publish_batch_failed", count=len(messages), error=str(e))
+        return [False] * len(messages)
+
+    ok = []
+    for (topic, _, _), res in zip(messages, results):
+        if isinstance(res, Exception):
+            log.warning("kafka.publish_failed", topic=topic, error=str(res))
+        ok.append(not isinstance(res, Exception))
+    return ok
+
+
 def make_consumer(topic: str, group_id: str) -> AIOKafkaConsumer:
     return AIOKafkaConsumer(
         topic,
         bootstrap_servers=settings.kafka_bootstrap_servers,
         group_id=group_id,
-        value_deserializer=lambda m: json.loads(m.decode("utf-8")),
+        value_deserializer=orjson.loads,
         auto_offset_reset="earliest",
         enable_auto_commit=True,
     )
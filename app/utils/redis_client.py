@@ -1,4 +1,7 @@
+import asyncio
+
 import redis.asyncio as aioredis
+from redis.utils import HIREDIS_AVAILABLE
 from app.config import get_settings
 import structlog
 
@@ -11,25 +14,64 @@ _redis: aioredis.Redis | None = None
 async def get_redis() -> aioredis.Redis:
     global _redis
     if _redis is None:
-        _redis = aioredis.from_url(
+        # One process-wide pool. The blocking variant makes a burst wait for
+        # a free connection instead of failing with "Too many connections".
+        pool = aioredis.BlockingConnectionPool.from_url(
             settings.redis_url,
+            max_connections=settings.redis_max_connections,
+            timeout=2,
+            health_check_interval=30,
             encoding="utf-8",
-            decode_responses=True,
+            # Raw bytes: int()/float()/json.loads() all accept them directly,
+            # so skip the per-reply UTF-8 decode
+            decode_responses=False,
             socket_connect_timeout=2,
             socket_timeout=2,
             retry_on_timeout=True,
-            max_connections=50,
         )
+        _redis = aioredis.Redis(connection_pool=pool)
     return _redis
 
 
+async def warm_redis_pool(size: int | None = None):
+    """
+    Open `size` pooled connections (default: the whole pool) up front so
+    early requests skip TCP connect. Replies are parsed by hiredis, which
+    redis-py picks up automatically when installed (redis[hiredis]).
+    """
+    r = await get_redis()
+    size = size or settings.redis_max_connections
+    await asyncio.gather(*(r.ping() for _ in range(size)))
+    log.info("redis.pool_warmed", connections=size, hiredis=HIREDIS_AVAILABLE)
+
+
 async def close_redis():
     global _redis
     if _redis:
         await _redis.close()
+        await _redis.connection_pool.disconnect()
         _redis = None
 
 
+# ── Cache Writes ──────────────────────────────────────────────────────────────
+
+# Expiry for cache-aside copies, by key prefix. Under maxmemory, keys without
+# a TTL are never evicted by volatile-* policies and crowd out the dedup and
+# counter keys that carry their own TTLs, so every cache write sets one.
+CACHE_TTLS: dict[str, int] = {
+    "user:profile:": 300,
+    "rules:": 30,
+}
+DEFAULT_CACHE_TTL = 300
+
+
+async def cache_set(r: aioredis.Redis, key: str, value: bytes | str, ttl: int | None = None):
+    """SET key value EX ttl, with ttl taken from CACHE_TTLS unless given."""
+    if ttl is None:
+        ttl = next((t for prefix, t in CACHE_TTLS.items() if key.startswith(prefix)), DEFAULT_CACHE_TTL)
+    await r.set(key, value, ex=ttl)
+
+
 # ── Key Builders ──────────────────────────────────────────────────────────────
 
 def key_exact_dedup(fingerprint: str) -> str:
@@ -38,6 +80,10 @@ def key_exact_dedup(fingerprint: str) -> str:
 def key_near_dedup_minhash(user_id: str, fingerprint: str) -> str:
     return f"dedup:lsh:{user_id}:{fingerprint}"
 
+def key_lsh_band(user_id: str, band: int, band_hash: str) -> str:
+    # ZSET of fingerprint -> insert time (was a plain SET under dedup:band:)
+    return f"dedup:bandz:{user_id}:{band}:{band_hash}"
+
 def key_count_1h(user_id: str) -> str:
     return f"notif:count:{user_id}:1h"
 
@@ -53,6 +99,9 @@ def key_cooldown(user_id: str, event_type: str) -> str:
 def key_rules_cache() -> str:
     return "rules:active"
 
+def key_rules_list(active_only: bool) -> str:
+    return f"rules:all:{active_only}"
+
 def key_rules_invalidate() -> str:
     return "rules:invalidate"
 
@@ -8,6 +8,7 @@ import os
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
 
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from app.models.tables import Base, RuleConfig, UserProfile
 from app.config import get_settings
@@ -83,31 +84,34 @@ SAMPLE_USERS = [
 
 
 async def seed():
-    engine = create_async_engine(settings.database_url, echo=True)
+    engine = create_async_engine(settings.database_url, echo=False)
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
 
     Session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
     async with Session() as db:
-        # Seed rules
-        for r in SAMPLE_RULES:
-            from sqlalchemy import select
-            existing = await db.execute(
-                select(RuleConfig).where(RuleConfig.rule_name == r["rule_name"])
-            )
-            if not existing.scalar_one_or_none():
-                db.add(RuleConfig(**r, is_active=True))
-                print(f"[+] Rule: {r['rule_name']}")
+        # Seed rules — one statement; existing names are left untouched
+        result = await db.execute(
+            pg_insert(RuleConfig)
+            .values([{**r, "is_active": True} for r in SAMPLE_RULES])
+            .on_conflict_do_nothing(index_elements=["rule_name"])
+            .returning(RuleConfig.rule_name)
+        )
+        for name in result.scalars():
+            print(f"[+] Rule: {name}")
 
-        # Seed users
-        for u in SAMPLE_USERS:
-            from sqlalchemy import select
-            existing = await db.execute(
-                select(UserProfile).where(UserProfile.user_id == u["user_id"])
-            )
-            if not existing.scalar_one_or_none():
-                db.add(UserProfile(**u))
-                print(f"[+] User: {u['user_id']}")
+        # Seed users — every row needs the same keys for a multi-row VALUES
+        result = await db.execute(
+            pg_insert(UserProfile)
+            .values([
+                {"hourly_cap_override": None, "daily_cap_override": None, **u}
+                for u in SAMPLE_USERS
+            ])
+            .on_conflict_do_nothing(index_elements=["user_id"])
+            .returning(UserProfile.user_id)
+        )
+        for user_id in result.scalars():
+            print(f"[+] User: {user_id}")
 
         await db.commit()
     print("\n✅ Seeding complete!")
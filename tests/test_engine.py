@@ -4,17 +4,65 @@ Run: pytest tests/ -v
 """
 import pytest
 import asyncio
-from datetime import datetime, timedelta
+import json
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
 from unittest.mock import AsyncMock, MagicMock, patch
 
+import orjson
+import pydantic
+from sqlalchemy import DateTime, String, Uuid
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql.asyncpg import PGDialect_asyncpg
+
+from app.api import notifications as notifications_api
+from app.api import rules as rules_api
+from app.api import users as users_api
+from app.config import Settings
+from app.models import database
+from app.models.schemas import DecisionEnum, NotificationEventIn, ReasonStep
+from app.services import ai_scorer, dispatcher, pipeline, rules_engine, scheduler
+from app.services import context_enricher as ce
+from app.services.ai_scorer import ScoringResult, _event_type_urgency, _heuristic_score
+from app.services.arbiter import _compute_optimal_send_time, _peak_hours, arbitrate, score_can_change_decision
+from app.services.context_enricher import UserContext, _dnd_bits, _is_dnd_active
+from app.services.dedup import (
+    _NUM_BANDS,
+    _compute_fingerprint,
+    _compute_minhash,
+    _jaccard_from_lists,
+    _lsh_bands,
+    _minhash_to_list,
+    _normalize_text,
+)
+from app.services.dispatcher import _digest_bucket, _digest_upsert
+from app.services.rules_engine import (
+    _build_rules_index,
+    _compile_conditions,
+    _compile_rule,
+    _event_fields,
+    _is_quiet_hours,
+    _matcher_for,
+    _matches_conditions,
+    _quiet_mask,
+)
+from app.utils import kafka_client
+
 
 # ─────────────────────────────────────────────────────────────────────────────
-# Fixtures
+# Fixtures — built once per session; tests must not mutate them (use
+# model_copy(update=...) for variants)
 # ─────────────────────────────────────────────────────────────────────────────
 
-@pytest.fixture
+# Fixed reference instant; anything derived from it is safely in the past.
+_NOW = datetime(2024, 1, 15, 12, 0, tzinfo=timezone.utc)
+_EXPIRED_TS = _NOW - timedelta(hours=1)
+
+
+@pytest.fixture(scope="session")
 def sample_event_critical():
-    from app.models.schemas import NotificationEventIn
     return NotificationEventIn(
         user_id="user_test_001",
         event_type="payment_failed",
@@ -27,9 +75,8 @@ def sample_event_critical():
     )
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def sample_event_promo():
-    from app.models.schemas import NotificationEventIn
     return NotificationEventIn(
         user_id="user_test_002",
         event_type="promo_offer",
@@ -41,9 +88,8 @@ def sample_event_promo():
     )
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def sample_event_message():
-    from app.models.schemas import NotificationEventIn
     return NotificationEventIn(
         user_id="user_test_003",
         event_type="new_message",
@@ -55,10 +101,8 @@ def sample_event_message():
     )
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def sample_event_expired():
-    from app.models.schemas import NotificationEventIn
-    from datetime import timezone
     return NotificationEventIn(
         user_id="user_test_004",
         event_type="flash_sale",
@@ -67,7 +111,7 @@ def sample_event_expired():
         source="promotions",
         channel="push",
         priority_hint="medium",
-        expires_at=datetime.now(timezone.utc) - timedelta(hours=1),  # Already expired
+        expires_at=_EXPIRED_TS,  # Already expired
     )
 
 
@@ -78,22 +122,17 @@ def sample_event_expired():
 class TestDeduplication:
 
     def test_fingerprint_deterministic(self, sample_event_critical):
-        from app.services.dedup import _compute_fingerprint
         fp1 = _compute_fingerprint(sample_event_critical)
         fp2 = _compute_fingerprint(sample_event_critical)
         assert fp1 == fp2, "Fingerprint must be deterministic"
 
     def test_fingerprint_different_users(self, sample_event_critical):
-        from app.services.dedup import _compute_fingerprint
-        from app.models.schemas import NotificationEventIn
         event2 = sample_event_critical.model_copy(update={"user_id": "different_user"})
         fp1 = _compute_fingerprint(sample_event_critical)
         fp2 = _compute_fingerprint(event2)
         assert fp1 != fp2, "Different users must produce different fingerprints"
 
     def test_fingerprint_uses_dedupe_key(self):
-        from app.services.dedup import _compute_fingerprint
-        from app.models.schemas import NotificationEventIn
         event = NotificationEventIn(
             user_id="u1", event_type="test", title="Title A", message="msg",
             source="svc", dedupe_key="stable-key-123"
@@ -106,7 +145,6 @@ class TestDeduplication:
             "Same dedupe_key must produce same fingerprint"
 
     def test_minhash_similar_texts(self):
-        from app.services.dedup import _compute_minhash, _jaccard_from_lists, _minhash_to_list
         text1 = "Your payment of $49 failed. Please update billing details."
         text2 = "Your payment of $49 has failed. Please update your billing details."
         mh1 = _minhash_to_list(_compute_minhash(text1))
@@ -115,7 +153,6 @@ class TestDeduplication:
         assert similarity > 0.7, f"Similar texts should have high Jaccard: {similarity}"
 
     def test_minhash_different_texts(self):
-        from app.services.dedup import _compute_minhash, _jaccard_from_lists, _minhash_to_list
         text1 = "Payment failed update billing"
         text2 = "New message from your friend Alice about the weekend"
         mh1 = _minhash_to_list(_compute_minhash(text1))
@@ -123,8 +160,22 @@ class TestDeduplication:
         similarity = _jaccard_from_lists(mh1, mh2)
         assert similarity < 0.5, f"Different texts should have low Jaccard: {similarity}"
 
+    def test_lsh_candidate_recall(self):
+        similar = [
+            "Your payment of $49 failed. Please update billing details.",
+            "Your payment of $49 has failed. Please update your billing details.",
+        ]
+        other = "New message from your friend Alice about the weekend"
+        bands = [set(_lsh_bands(_compute_minhash(t), _NUM_BANDS)) for t in similar + [other]]
+        assert bands[0] & bands[1], "Similar texts must share at least one band"
+        assert not bands[0] & bands[2]
+
+    def test_lsh_bands_must_divide_num_perm(self):
+        with pytest.raises(pydantic.ValidationError, match="multiple of lsh_bands"):
+            Settings(lsh_num_perm=128, lsh_bands=12)
+        assert Settings(lsh_num_perm=120, lsh_bands=12).lsh_bands == 12
+
     def test_normalize_text(self):
-        from app.services.dedup import _normalize_text
         assert _normalize_text("Hello, World!") == "hello world"
         assert _normalize_text("  Extra   Spaces  ") == "extra spaces"
 
@@ -136,39 +187,132 @@ class TestDeduplication:
 class TestRulesEngine:
 
     def test_match_list_condition(self, sample_event_critical):
-        from app.services.rules_engine import _matches_conditions
         conditions = {"event_type": ["payment_failed", "payment_declined"]}
         assert _matches_conditions(sample_event_critical, conditions) is True
 
     def test_no_match_list_condition(self, sample_event_promo):
-        from app.services.rules_engine import _matches_conditions
         conditions = {"event_type": ["payment_failed", "payment_declined"]}
         assert _matches_conditions(sample_event_promo, conditions) is False
 
     def test_match_exact_condition(self, sample_event_promo):
-        from app.services.rules_engine import _matches_conditions
         conditions = {"channel": "push", "priority_hint": "low"}
         assert _matches_conditions(sample_event_promo, conditions) is True
 
     def test_match_contains_operator(self, sample_event_critical):
-        from app.services.rules_engine import _matches_conditions
         conditions = {"event_type": {"contains": "payment"}}
         assert _matches_conditions(sample_event_critical, conditions) is True
 
+    def test_compiled_matcher_reused_across_events(self, sample_event_critical, sample_event_promo):
+        matcher = _compile_conditions({
+            "event_type": {"contains": "PAY", "not_in": ["payment_declined"]},
+            "meta.amount": {"gte": 10},
+        })
+        assert matcher(_event_fields(sample_event_critical)) is True
+        assert matcher(_event_fields(sample_event_promo)) is False
+        # Unhashable metadata values still fall back to list membership
+        tags = _compile_conditions({"meta.tags": [["a", "b"]]})
+        event = sample_event_promo.model_copy(update={"metadata": {"tags": ["a", "b"]}})
+        assert tags(_event_fields(event)) is True
+
+    def test_matcher_cached_by_condition_content(self, sample_event_critical):
+        first = _matcher_for({"event_type": ["payment_failed"], "meta.amount": {"gte": 10}})
+        same = _matcher_for({"meta.amount": {"gte": 10}, "event_type": ["payment_failed"]})
+        assert first is same
+        assert _matches_conditions(sample_event_critical, {"meta.amount": {"gte": 10}}) is True
+        assert _matches_conditions(sample_event_critical, {"meta.amount": {"gte": 100}}) is False
+
+    def test_rules_index_keeps_priority_order(self):
+        conditions = [
+            {"event_type": ["otp", "login"]},
+            {"channel": "push"},
+            {"event_type": "otp", "channel": "sms"},
+            {"event_type": {"contains": "pay"}},
+        ]
+        rules = tuple(
+            _compile_rule({"id": i, "rule_name": f"r{i}", "rule_type": "force_now",
+                           "conditions": c, "action_params": {}})
+            for i, c in enumerate(conditions, 1)
+        )
+        by_type, unpinned = _build_rules_index(rules)
+        assert [r.id for r in by_type["otp"]] == [1, 2, 3, 4]
+        assert [r.id for r in by_type["login"]] == [1, 2, 4]
+        assert [r.id for r in unpinned] == [2, 4]
+        # Pinned rules only check what is left after event_type
+        assert rules[2].matcher({"channel": "sms"}) is True
+        assert rules[0].always_match and not rules[2].always_match
+
+    def test_batch_evaluation_matches_single(self, sample_event_critical, sample_event_promo, sample_event_message):
+        rules = tuple(rules_engine._compile_rule(r) for r in [
+            {"id": "1", "rule_name": "pay", "rule_type": "force_now",
+             "conditions": {"event_type": ["payment_failed"]}, "action_params": {}},
+            {"id": "2", "rule_name": "hint", "rule_type": "quiet_hours",
+             "conditions": {"priority_hint": "low"}, "action_params": {"start_hour": 0, "end_hour": 0}},
+            {"id": "3", "rule_name": "sms", "rule_type": "channel_override",
+             "conditions": {"event_type": ["promo_offer"]}, "action_params": {"allowed_channels": ["email"]}},
+        ])
+        events = [sample_event_promo, sample_event_critical, sample_event_message, sample_event_promo]
+
+        async def run():
+            with patch.object(rules_engine, "_rules_index", rules_engine._build_rules_index(rules)):
+                single = [await rules_engine.evaluate_rules(e) for e in events]
+                batch = await rules_engine.evaluate_rules_batch(events)
+            return single, batch
+
+        single, batch = asyncio.run(run())
+        assert batch == single
+        assert [d for d, _, _ in batch] == ["never", "now", None, "never"]
+        assert [s.result for s in batch[0][2]] == ["MATCHED_NO_FORCE", "FORCE_NEVER"]
+
     def test_quiet_hours_overnight(self):
-        from app.services.rules_engine import _is_quiet_hours
         # 22:00 - 08:00, check at 23:00 → should be quiet
         params = {"start_hour": 22, "end_hour": 8}
-        with patch("app.services.rules_engine.datetime") as mock_dt:
-            mock_dt.utcnow.return_value = datetime(2024, 1, 1, 23, 0)
-            assert _is_quiet_hours(params) is True
+        assert _is_quiet_hours(params, now=datetime(2024, 1, 1, 23, 0)) is True
 
     def test_quiet_hours_not_active(self):
-        from app.services.rules_engine import _is_quiet_hours
         params = {"start_hour": 22, "end_hour": 8}
-        with patch("app.services.rules_engine.datetime") as mock_dt:
-            mock_dt.utcnow.return_value = datetime(2024, 1, 1, 14, 0)
-            assert _is_quiet_hours(params) is False
+        assert _is_quiet_hours(params, now=datetime(2024, 1, 1, 14, 0)) is False
+
+    def test_quiet_mask_daytime_and_overnight(self):
+        overnight = _quiet_mask({"start_hour": 22, "end_hour": 8})
+        assert [h for h in range(24) if overnight >> h & 1] == [0, 1, 2, 3, 4, 5, 6, 7, 22, 23]
+        daytime = _quiet_mask({"start_hour": 9, "end_hour": 12})
+        assert [h for h in range(24) if daytime >> h & 1] == [9, 10, 11]
+        assert _quiet_mask({"start_hour": 5, "end_hour": 5}) == 0
+
+    def test_concurrent_refresh_loads_rules_once(self):
+        async def slow_load(db):
+            await asyncio.sleep(0.01)
+            return [{"id": 1, "rule_name": "r", "rule_type": "force_now",
+                     "conditions": {}, "action_params": {}, "priority_order": 1}]
+
+        async def run():
+            # The refresh lock must belong to this test's event loop
+            rules_engine._refresh_lock = asyncio.Lock()
+            rules_engine._rules_loaded_at = None
+            redis = MagicMock(get=AsyncMock(return_value=None), set=AsyncMock())
+            with patch.object(rules_engine, "get_redis", AsyncMock(return_value=redis)), \
+                 patch.object(rules_engine, "_load_rules_from_db", AsyncMock(side_effect=slow_load)) as load:
+                results = await asyncio.gather(*(rules_engine.get_active_rules(db=object()) for _ in range(5)))
+            assert load.await_count == 1
+            # Postgres result is shared through Redis, without the compiled matcher
+            blob = redis.set.await_args.args[1]
+            assert b"matcher" not in blob and orjson.loads(blob)[0]["id"] == 1
+            assert redis.set.await_args.kwargs["ex"] == 30  # CACHE_TTLS["rules:"]
+            assert all(len(r) == 1 for r in results)
+            assert rules_engine._CACHE_TTL_SECONDS <= rules_engine._rules_ttl < 35
+            rules_engine._rules_loaded_at = None
+
+        asyncio.run(run())
+
+    def test_rule_write_commits_before_invalidating(self):
+        calls = []
+        db = MagicMock()
+        db.execute = AsyncMock(return_value=MagicMock(**{"scalar_one_or_none.return_value": True}))
+        db.commit = AsyncMock(side_effect=lambda: calls.append("commit"))
+        invalidate = AsyncMock(side_effect=lambda: calls.append("invalidate"))
+        with patch.object(rules_api, "invalidate_rules_cache", invalidate):
+            asyncio.run(rules_api.toggle_rule("r1", db=db))
+        assert calls == ["commit", "invalidate"]
 
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -178,34 +322,71 @@ class TestRulesEngine:
 class TestContextEnricher:
 
     def test_dnd_active_overnight(self):
-        from app.services.context_enricher import _is_dnd_active
         assert _is_dnd_active(22, 8, 23) is True  # 23:00 in 22-08 window
         assert _is_dnd_active(22, 8, 7) is True   # 07:00 in 22-08 window
         assert _is_dnd_active(22, 8, 14) is False  # 14:00 outside window
 
     def test_dnd_not_active_daytime(self):
-        from app.services.context_enricher import _is_dnd_active
         assert _is_dnd_active(22, 8, 10) is False
         assert _is_dnd_active(22, 8, 20) is False
 
+    def test_dnd_bits_mask(self):
+        overnight = {22, 23, 0, 1, 2, 3, 4, 5, 6, 7}
+        assert _dnd_bits(22, 8) == sum(1 << h for h in overnight)
+        assert _dnd_bits(13, 15) == (1 << 13) | (1 << 14)
+        assert _dnd_bits(9, 9) == 0
+        assert UserContext(user_id="u1", dnd_start_hour=13, dnd_end_hour=15).dnd_bits == _dnd_bits(13, 15)
+
+    def test_local_hour_follows_dst(self):
+        # 2024-07-01 12:00 UTC is 08:00 EDT; 2024-01-01 12:00 UTC is 07:00 EST
+        with patch.object(ce.time, "time", return_value=1719835200.0):
+            assert ce._local_hour("America/New_York") == 8
+        with patch.object(ce.time, "time", return_value=1704110400.0):
+            assert ce._local_hour("America/New_York") == 7
+            assert ce._local_hour("Asia/Kolkata") == 17
+
+    def test_redis_context_single_mget(self):
+        redis = AsyncMock()
+        last = str(time.time() - 30).encode()
+        redis.mget.return_value = [b"3", None, last]
+        with patch.object(ce, "get_redis", AsyncMock(return_value=redis)):
+            count_1h, count_24h, since_last = asyncio.run(ce._fetch_redis_context("u1", "promo"))
+        assert (count_1h, count_24h) == (3, 0)
+        assert since_last == pytest.approx(30, abs=5)
+        redis.mget.assert_awaited_once()
+        redis.get.assert_not_called()
+
+    def test_profile_cache_skips_redis_until_busted(self):
+        redis = AsyncMock()
+        redis.get.return_value = json.dumps({"timezone": "Asia/Kolkata"}).encode()
+
+        async def run():
+            with patch.object(ce, "get_redis", AsyncMock(return_value=redis)):
+                first = await asyncio.gather(*(ce._fetch_user_profile("u-cache", None) for _ in range(5)))
+                await ce.bust_profile_cache("u-cache")
+                await ce._fetch_user_profile("u-cache", None)
+            return first
+
+        first = asyncio.run(run())
+        assert all(p == {"timezone": "Asia/Kolkata"} for p in first)
+        assert redis.get.await_count == 2
+        redis.delete.assert_awaited_once()
+        ce._profile_cache.clear()
+
     def test_user_context_fatigue_ratio(self):
-        from app.services.context_enricher import UserContext
         ctx = UserContext(user_id="u1", notifications_last_1h=4, hourly_cap=5)
         assert ctx.fatigue_ratio_1h == pytest.approx(0.8)
         assert ctx.hourly_cap_hit is False
 
     def test_user_context_cap_hit(self):
-        from app.services.context_enricher import UserContext
         ctx = UserContext(user_id="u1", notifications_last_1h=5, hourly_cap=5)
         assert ctx.hourly_cap_hit is True
 
     def test_recency_bonus_never_sent(self):
-        from app.services.context_enricher import UserContext
         ctx = UserContext(user_id="u1", seconds_since_last_same_type=None)
         assert ctx.recency_bonus == 1.0
 
     def test_recency_bonus_just_sent(self):
-        from app.services.context_enricher import UserContext
         ctx = UserContext(user_id="u1", seconds_since_last_same_type=0)
         assert ctx.recency_bonus == pytest.approx(0.0, abs=0.01)
 
@@ -217,31 +398,68 @@ class TestContextEnricher:
 class TestHeuristicScorer:
 
     def test_critical_event_scores_high(self, sample_event_critical):
-        from app.services.ai_scorer import _heuristic_score
-        from app.services.context_enricher import UserContext
         ctx = UserContext(user_id="u1")
         result = _heuristic_score(sample_event_critical, ctx)
         assert result.score >= 0.70, f"Critical event should score >= 0.70, got {result.score}"
         assert result.decision_hint in ("now", "later")
 
     def test_promo_event_scores_low(self, sample_event_promo):
-        from app.services.ai_scorer import _heuristic_score
-        from app.services.context_enricher import UserContext
         ctx = UserContext(user_id="u1", notifications_last_1h=4, hourly_cap=5)
         result = _heuristic_score(sample_event_promo, ctx)
         assert result.score <= 0.50, f"Promo should score <= 0.50, got {result.score}"
 
     def test_fallback_flag_set(self, sample_event_promo):
-        from app.services.ai_scorer import _heuristic_score
-        from app.services.context_enricher import UserContext
         ctx = UserContext(user_id="u1")
         result = _heuristic_score(sample_event_promo, ctx, fallback_reason="test")
         assert result.fallback_used is True
         assert result.ai_used is False
 
+    def test_event_type_urgency_takes_highest_keyword(self):
+        assert _event_type_urgency("payment_failed") == 1.0
+        assert _event_type_urgency("message_alert") == 0.8  # not the first-listed match (message=0.7)
+        assert _event_type_urgency("PROMO_Offer") == 0.2
+        assert _event_type_urgency("something_else") == 0.4
+
+    def test_groq_batcher_coalesces_concurrent_requests(self):
+        async def fake_groq(prompt, system=None, max_tokens=256, timeout=None):
+            # Answer every line but the last
+            ids = [json.loads(line)["id"] for line in prompt.splitlines()]
+            return {"items": [{"id": i, "score": i / 10} for i in ids[:-1]]}
+
+        async def run():
+            batcher = ai_scorer._GroqBatcher()
+            futs = [batcher.submit(f"p{i}", {"event": {}}) for i in range(3)]
+            return await asyncio.gather(*futs, return_exceptions=True)
+
+        with patch.object(ai_scorer, "_call_groq", AsyncMock(side_effect=fake_groq)) as call:
+            results = asyncio.run(run())
+        assert call.await_count == 1
+        assert "timeout" not in call.await_args.kwargs  # Same bound as a single call
+        assert [data["score"] for _, data in results[:2]] == [0.0, 0.1]
+        assert isinstance(results[2], ValueError)
+        # Each caller gets the payload Groq actually received, not its own prompt
+        sent = results[0][0]
+        assert sent.startswith(ai_scorer._BATCH_SYSTEM_PROMPT) and sent.endswith(call.await_args.args[0])
+
+    def test_identical_prompts_share_one_groq_call(self):
+        async def run():
+            loop = asyncio.get_running_loop()
+            fut = loop.create_future()
+            loop.call_later(0.01, fut.set_result, ("sent", {"score": 0.9}))
+            with patch.object(ai_scorer._batcher, "submit", MagicMock(return_value=fut)) as submit:
+                # Concurrent twins join the in-flight call; a later one hits the cache
+                first = await asyncio.gather(*(ai_scorer._score_cached("same", {}) for _ in range(3)))
+                with patch.object(ai_scorer.random, "random", return_value=1.0):
+                    later = await ai_scorer._score_cached("same", {})
+            return submit.call_count, first, later
+
+        ai_scorer._response_cache.clear()
+        calls, first, later = asyncio.run(run())
+        assert calls == 1
+        assert [(sent, data) for sent, data, _ in first] == [("sent", {"score": 0.9})] * 3
+        assert later[:2] == ("sent", {"score": 0.9}) and later[2].score == 0.9
+
     def test_score_bounded(self, sample_event_critical):
-        from app.services.ai_scorer import _heuristic_score
-        from app.services.context_enricher import UserContext
         # Max fatigue
         ctx = UserContext(
             user_id="u1", notifications_last_1h=10, hourly_cap=5,
@@ -257,92 +475,385 @@ class TestHeuristicScorer:
 
 class TestArbiter:
 
-    def _make_ai_result(self, score: float, decision: str = "later"):
-        from app.services.ai_scorer import ScoringResult
-        return ScoringResult(
-            score=score, decision_hint=decision,
-            urgency=0.5, engagement=0.5, fatigue_penalty=0.0, recency_bonus=0.5,
-            reasoning="test", ai_used=True, fallback_used=False,
-        )
+    # arbitrate() only reads these, so one instance of each is shared
+    _STEPS = [ReasonStep(layer="test", check="test", result="PASS")]
+    _AI_CACHE: dict[tuple[float, str], ScoringResult] = {}
 
-    def _dummy_steps(self):
-        from app.models.schemas import ReasonStep
-        return [ReasonStep(layer="test", check="test", result="PASS")]
+    def _make_ai_result(self, score: float, decision: str = "later"):
+        key = (score, decision)
+        if key not in self._AI_CACHE:
+            self._AI_CACHE[key] = ScoringResult(
+                score=score, decision_hint=decision,
+                urgency=0.5, engagement=0.5, fatigue_penalty=0.0, recency_bonus=0.5,
+                reasoning="test", ai_used=True, fallback_used=False,
+            )
+        return self._AI_CACHE[key]
 
     def test_rule_force_now_wins(self, sample_event_critical):
-        from app.services.arbiter import arbitrate
-        from app.services.context_enricher import UserContext
         ctx = UserContext(user_id="u1")
         ai = self._make_ai_result(0.1)  # Even low score
         decision, scheduled_at, _, _ = arbitrate(
             sample_event_critical, "now", "test_rule", ai, ctx,
-            self._dummy_steps(), self._dummy_steps(), self._dummy_steps()[0]
+            self._STEPS, self._STEPS, self._STEPS[0]
         )
-        from app.models.schemas import DecisionEnum
         assert decision == DecisionEnum.now
 
     def test_rule_force_never_wins(self, sample_event_promo):
-        from app.services.arbiter import arbitrate
-        from app.services.context_enricher import UserContext
         ctx = UserContext(user_id="u1")
         ai = self._make_ai_result(0.9)  # Even high score
         decision, _, _, _ = arbitrate(
             sample_event_promo, "never", "suppress_promos", ai, ctx,
-            self._dummy_steps(), self._dummy_steps(), self._dummy_steps()[0]
+            self._STEPS, self._STEPS, self._STEPS[0]
         )
-        from app.models.schemas import DecisionEnum
         assert decision == DecisionEnum.never
 
     def test_high_score_sends_now(self, sample_event_message):
-        from app.services.arbiter import arbitrate
-        from app.services.context_enricher import UserContext
         ctx = UserContext(user_id="u1", dnd_active=False)
         ai = self._make_ai_result(0.90, "now")
         decision, _, _, _ = arbitrate(
             sample_event_message, None, None, ai, ctx,
-            [], [], self._dummy_steps()[0]
+            [], [], self._STEPS[0]
         )
-        from app.models.schemas import DecisionEnum
         assert decision == DecisionEnum.now
 
     def test_low_score_never(self, sample_event_promo):
-        from app.services.arbiter import arbitrate
-        from app.services.context_enricher import UserContext
         ctx = UserContext(user_id="u1")
         ai = self._make_ai_result(0.10, "never")
         decision, _, _, _ = arbitrate(
             sample_event_promo, None, None, ai, ctx,
-            [], [], self._dummy_steps()[0]
+            [], [], self._STEPS[0]
         )
-        from app.models.schemas import DecisionEnum
         assert decision == DecisionEnum.never
 
     def test_dnd_defers_non_critical(self, sample_event_message):
-        from app.services.arbiter import arbitrate
-        from app.services.context_enricher import UserContext
         ctx = UserContext(user_id="u1", dnd_active=True)
         ai = self._make_ai_result(0.80, "now")
         decision, scheduled_at, _, _ = arbitrate(
             sample_event_message, None, None, ai, ctx,
-            [], [], self._dummy_steps()[0]
+            [], [], self._STEPS[0]
         )
-        from app.models.schemas import DecisionEnum
         assert decision == DecisionEnum.later
         assert scheduled_at is not None
 
+    def test_optimal_send_time_picks_best_non_dnd_hour(self):
+        heatmap = [0.1] * 24
+        heatmap[15] = 0.9
+        heatmap[23] = 1.0  # Better score, but inside DND
+        ctx = UserContext(user_id="u1", dnd_start_hour=22, dnd_end_hour=8, engagement_heatmap=heatmap)
+        scheduled = _compute_optimal_send_time(ctx, None)
+        assert scheduled.hour == 15
+        assert scheduled.minute % 15 == 0
+
+    def test_peak_hours_skip_dnd_and_keep_ties(self):
+        heatmap = [0.1] * 24
+        heatmap[9] = heatmap[18] = 0.9
+        heatmap[23] = 1.0  # Inside DND
+        assert _peak_hours(tuple(heatmap), _dnd_bits(22, 8)) == (9, 18)
+        assert _peak_hours(tuple(heatmap), _dnd_bits(0, 0)) == (23,)
+        assert _peak_hours(tuple(heatmap), _dnd_bits(0, 24)) == ()
+
+    def test_score_gating_only_when_decision_is_fixed(self, sample_event_message, sample_event_critical):
+        assert score_can_change_decision(sample_event_message, UserContext(user_id="u1")) is True
+        assert score_can_change_decision(sample_event_message, UserContext(user_id="u1", dnd_active=True)) is False
+        assert score_can_change_decision(sample_event_critical, UserContext(user_id="u1", dnd_active=True)) is True
+        daily = UserContext(user_id="u1", notifications_last_24h=20)
+        assert score_can_change_decision(sample_event_message, daily) is False
+        # Hourly cap's high-score bypass decides between LATER and the daily-cap NEVER
+        both = UserContext(user_id="u1", notifications_last_1h=5, notifications_last_24h=20)
+        assert score_can_change_decision(sample_event_message, both) is True
+        opted_out = UserContext(user_id="u1", opted_out_topics=["payment_failed"])
+        assert score_can_change_decision(sample_event_critical, opted_out) is False
+
     def test_critical_bypasses_dnd(self, sample_event_critical):
-        from app.services.arbiter import arbitrate
-        from app.services.context_enricher import UserContext
         ctx = UserContext(user_id="u1", dnd_active=True)
         ai = self._make_ai_result(0.95, "now")
         decision, _, _, _ = arbitrate(
             sample_event_critical, None, None, ai, ctx,
-            [], [], self._dummy_steps()[0]
+            [], [], self._STEPS[0]
         )
-        from app.models.schemas import DecisionEnum
         assert decision == DecisionEnum.now
 
 
+# ─────────────────────────────────────────────────────────────────────────────
+# Dispatcher Tests
+# ─────────────────────────────────────────────────────────────────────────────
+
+class TestDispatcher:
+
+    def test_fatigue_counters_use_one_pipeline_round_trip(self, sample_event_message):
+        pipe = MagicMock()  # Queued commands are sync; only execute() is awaited
+        pipe.execute = AsyncMock()
+        redis = MagicMock()
+        redis.pipeline.return_value = pipe
+        with patch.object(dispatcher, "get_redis", AsyncMock(return_value=redis)):
+            asyncio.run(dispatcher._increment_fatigue_counters(sample_event_message))
+        redis.pipeline.assert_called_once_with(transaction=False)
+        assert pipe.incr.call_count == 2
+        assert pipe.set.call_count == 2  # last-send + cooldown
+        pipe.execute.assert_awaited_once()
+
+    def test_digest_upsert_targets_pending_bucket(self, sample_event_promo):
+        assert _digest_bucket(datetime(2024, 1, 1, 13, 47, 12)) == datetime(2024, 1, 1, 13, 30)
+        assert _digest_bucket(datetime(2024, 1, 1, 13, 0)) == datetime(2024, 1, 1, 13, 0)
+        sql = str(_digest_upsert("e1", sample_event_promo, datetime(2024, 1, 1, 13, 47)).compile(
+            dialect=postgresql.dialect()))
+        assert "ON CONFLICT (user_id, channel, bucket_ts) WHERE status = 'pending'" in sql
+        assert "digest_batches.event_ids || excluded.event_ids" in sql
+
+    def test_persist_failure_skips_publish(self, sample_event_message):
+        db = MagicMock()
+        db.execute = AsyncMock(side_effect=RuntimeError("current transaction is aborted"))
+        score = _heuristic_score(sample_event_message, UserContext(user_id="u1"))
+        with patch.object(dispatcher, "publish", AsyncMock()) as publish, \
+             patch.object(dispatcher, "_increment_fatigue_counters", AsyncMock()) as counters:
+            with pytest.raises(RuntimeError):
+                asyncio.run(dispatcher.dispatch(
+                    "e1", sample_event_message, "fp", DecisionEnum.now, 0.9, None, [],
+                    score, None, UserContext(user_id="u1"), db,
+                ))
+        publish.assert_not_called()
+        counters.assert_not_called()
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Pipeline Tests
+# ─────────────────────────────────────────────────────────────────────────────
+
+class TestPipeline:
+
+    def test_dedup_suppression_skips_context(self, sample_event_message):
+        started = []
+
+        async def dedup(event):
+            started.append("dedup")
+            await asyncio.sleep(0.01)
+            steps = [ReasonStep(layer="L1-Dedup", check="exact", result="NEVER")]
+            return "exact_duplicate", "fp", steps
+
+        async def rules(event, db):
+            started.append("rules")
+            return None, None, []
+
+        async def context(event, db):
+            started.append("ctx")
+
+        with patch.object(pipeline, "run_dedup_pipeline", dedup), \
+             patch.object(pipeline, "evaluate_rules", rules), \
+             patch.object(pipeline, "enrich_context", context):
+            result = asyncio.run(pipeline.evaluate_notification(sample_event_message, db=None))
+        # Dedup and rules overlap; a suppressed event never checks out context
+        assert sorted(started) == ["dedup", "rules"]
+        assert result.decision == DecisionEnum.never
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Scheduler Tests
+# ─────────────────────────────────────────────────────────────────────────────
+
+class TestScheduler:
+
+    def test_due_batches_share_one_event_query(self):
+        def event(eid):
+            return SimpleNamespace(id=eid, user_id="u", event_type="t", title="", message="",
+                                   channel="push", source="s", metadata_={}, expires_at=None)
+
+        batches = [
+            SimpleNamespace(id="b1", user_id="u1", channel="push", event_ids=["a", "b"], status="pending"),
+            SimpleNamespace(id="b2", user_id="u2", channel="push", event_ids=["c", "gone"], status="pending"),
+        ]
+        db = MagicMock()
+        async def stream(*events):
+            for e in events:
+                yield e
+
+        db.execute = AsyncMock(side_effect=[
+            MagicMock(**{"scalars.return_value.all.return_value": batches}),
+            MagicMock(),
+        ])
+        db.stream_scalars = AsyncMock(return_value=stream(event("a"), event("b"), event("c")))
+        db.commit = AsyncMock()
+
+        with patch.object(scheduler, "publish_batch", AsyncMock(return_value=[True, True])) as publish:
+            asyncio.run(scheduler.process_due_batches(db))
+
+        # Claim, one streamed event fetch, one status write-back
+        assert db.execute.await_count == 2
+        db.stream_scalars.assert_awaited_once()
+        claim = str(db.execute.await_args_list[0].args[0].compile(dialect=postgresql.dialect()))
+        assert "FOR UPDATE SKIP LOCKED" in claim and "RETURNING" in claim
+        publish.assert_awaited_once()
+        digest, single = (payload for _, payload, _ in publish.await_args.args[0])
+        assert [i["event_id"] for i in digest["items"]] == ["a", "b"]
+        assert single["event_id"] == "c"
+        write_back = db.execute.await_args_list[1].args[0].compile()
+        assert write_back.params["status"] == "sent"
+        assert sorted(write_back.params["id_1"]) == ["b1", "b2"]
+
+    def test_partition_moves_rows_stranded_in_default(self):
+        executed = []
+
+        async def execute(stmt, params=None):
+            executed.append(str(stmt))
+            # to_regclass: partition missing; EXISTS: default holds rows for the month
+            return MagicMock(**{"scalar.return_value": None if "to_regclass" in str(stmt) else True})
+
+        conn = MagicMock(execute=execute)
+        begin = MagicMock()
+        begin.return_value.__aenter__ = AsyncMock(return_value=conn)
+        begin.return_value.__aexit__ = AsyncMock(return_value=False)
+        with patch.object(database, "engine", MagicMock(begin=begin)):
+            asyncio.run(database._create_month_partition(
+                "audit_log", datetime(2024, 2, 1), datetime(2024, 3, 1)))
+
+        ddl = [sql.split(" audit_log")[0] for sql in executed[3:]]
+        assert ddl == ["ALTER TABLE", "CREATE TABLE", "INSERT INTO", "DELETE FROM", "ALTER TABLE"]
+        assert "DETACH PARTITION audit_log_default" in executed[3]
+        assert "audit_log_202402 PARTITION OF audit_log FOR VALUES FROM ('2024-02-01') TO ('2024-03-01')" in executed[4]
+        assert executed[-1].endswith("ATTACH PARTITION audit_log_default DEFAULT")
+
+    def test_kafka_batch_reports_only_the_rejected_message(self):
+        async def send(topic, value=None, key=None):
+            if value.get("big"):
+                raise ValueError("MessageSizeTooLarge")
+            fut = asyncio.get_running_loop().create_future()
+            fut.set_result("meta")
+            return fut
+
+        producer = MagicMock(send=send, flush=AsyncMock())
+        with patch.object(kafka_client, "get_producer", AsyncMock(return_value=producer)):
+            ok = asyncio.run(kafka_client.publish_batch([("t", {}, None), ("t", {"big": 1}, None), ("t", {}, "k")]))
+        assert ok == [True, False, True]
+
+    def test_kafka_breaker_drops_publishes_while_open(self):
+        get_producer = AsyncMock(side_effect=ConnectionError("broker down"))
+
+        async def run():
+            for _ in range(5):
+                await kafka_client.publish("t", {})
+            return await kafka_client.publish_batch([("t", {}, None), ("t", {}, "k")])
+
+        with patch.object(kafka_client, "get_producer", get_producer):
+            try:
+                assert asyncio.run(run()) == [False, False]
+                assert kafka_client._kafka_breaker.opened
+                # The batch was short-circuited without touching the producer
+                assert get_producer.await_count == 5
+            finally:
+                kafka_client._kafka_breaker._state = "closed"
+                kafka_client._kafka_breaker._failure_count = 0
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Database Migration Tests
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _recording_conn(scalar=None):
+    """AsyncConnection stand-in that records SQL; `scalar(sql)` answers .scalar()."""
+    executed = []
+
+    async def execute(stmt, params=None):
+        executed.append(str(stmt))
+        return MagicMock(**{"scalar.return_value": scalar(str(stmt)) if scalar else None})
+
+    return MagicMock(execute=execute), executed
+
+
+class TestDatabaseMigrations:
+
+    def test_varchar_ids_converted_to_uuid(self):
+        answers = iter(["character varying", "uuid"])  # digest_batches, suppression_records
+        conn, executed = _recording_conn(lambda sql: next(answers) if "information_schema" in sql else None)
+        asyncio.run(database._migrate_uuid_ids(conn))
+        alters = [sql for sql in executed if sql.startswith("ALTER")]
+        assert alters == [
+            "ALTER TABLE digest_batches ALTER COLUMN id TYPE uuid USING id::uuid, "
+            "ALTER COLUMN id SET DEFAULT gen_random_uuid()"
+        ]
+
+
+    def test_pending_digest_twins_merged_before_unique_index(self):
+        conn, executed = _recording_conn()  # to_regclass -> None: index missing
+        conn.run_sync = AsyncMock(side_effect=lambda fn: executed.append("create_indexes")
+                                  if fn.__name__ == "_create_indexes" else {"id", "bucket_ts"})
+        asyncio.run(database._migrate_digest_buckets(conn))
+        assert executed[-2] == database._MERGE_PENDING_DIGEST_TWINS
+        assert executed[-1] == "create_indexes"
+        sql = database._MERGE_PENDING_DIGEST_TWINS
+        assert "GROUP BY user_id, channel, bucket_ts" in sql and "max(b.scheduled_at)" in sql
+
+    def test_legacy_log_rows_cast_to_uuid_ids(self):
+        legacy = {"id": String(36), "event_id": String(36), "raw_event": JSONB(), "created_at": DateTime()}
+        assert database._legacy_copy_sql("audit_log", "audit_log_unpartitioned", legacy) == (
+            "INSERT INTO audit_log (id, event_id, raw_event, created_at) "
+            "SELECT id::uuid, event_id, raw_event, COALESCE(created_at, now() AT TIME ZONE 'utc') "
+            "FROM audit_log_unpartitioned"
+        )
+        # Already-uuid ids are copied as they are
+        legacy["id"] = Uuid()
+        assert "SELECT id, event_id" in database._legacy_copy_sql("audit_log", "audit_log_unpartitioned", legacy)
+
+
+    def test_history_index_rebuilt_without_include(self):
+        # The index exists from before it became covering: pg_index check is false
+        conn, executed = _recording_conn(lambda sql: False if "pg_index" in sql else None)
+        outer = MagicMock(execution_options=AsyncMock(return_value=conn))
+        connect = MagicMock()
+        connect.return_value.__aenter__ = AsyncMock(return_value=outer)
+        connect.return_value.__aexit__ = AsyncMock(return_value=False)
+        with patch.object(database, "engine", MagicMock(connect=connect)):
+            asyncio.run(database._ensure_history_index())
+        outer.execution_options.assert_awaited_once_with(isolation_level="AUTOCOMMIT")
+        assert executed[1:] == [
+            "DROP INDEX CONCURRENTLY IF EXISTS ix_nev_user_created",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_nev_user_created ON notification_events "
+            "(user_id, created_at, id) INCLUDE (decision, event_type, score)",
+            "DROP INDEX CONCURRENTLY IF EXISTS ix_nev_user_decision",
+        ]
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# API Tests
+# ─────────────────────────────────────────────────────────────────────────────
+
+class TestNotificationsApi:
+
+    def test_cursor_binds_id_with_column_type(self):
+        db = MagicMock()
+        db.execute = AsyncMock(return_value=MagicMock(**{"all.return_value": []}))
+        cursor = "2024-01-15T12:00:00,0b6c7c3e-6f2c-4bb5-9f00-000000000001"
+        asyncio.run(notifications_api.get_ai_logs(user_id=None, limit=20, cursor=cursor, db=db))
+        asyncio.run(notifications_api.get_user_history("u1", limit=20, cursor=cursor, db=db))
+        ai_logs, history = (
+            str(call.args[0].compile(dialect=PGDialect_asyncpg()))
+            for call in db.execute.await_args_list
+        )
+        assert "< ($1::TIMESTAMP WITHOUT TIME ZONE, $2::UUID)" in ai_logs
+        assert "< ($2::TIMESTAMP WITHOUT TIME ZONE, $3::VARCHAR)" in history
+
+
+class TestUsersApi:
+
+    def test_opt_out_commits_before_busting_profile(self):
+        calls = []
+        db = MagicMock(commit=AsyncMock(side_effect=lambda: calls.append("commit")))
+        profile = SimpleNamespace(opted_out_topics=[], updated_at=None)
+        with patch.object(users_api, "_get_or_create_profile", AsyncMock(return_value=profile)), \
+             patch.object(users_api, "bust_profile_cache", AsyncMock(side_effect=lambda uid: calls.append("bust"))):
+            asyncio.run(users_api.opt_out_topic("u1", "promo", db=db))
+        assert calls == ["commit", "bust"]
+
+    def test_profile_read_skips_process_cache(self):
+        # Another worker busted Redis after a write; this worker's local copy is stale
+        ce._profile_cache_put("u_stale", {"segment": "old"})
+        redis = MagicMock(get=AsyncMock(return_value=json.dumps({"segment": "new"})))
+        try:
+            with patch.object(ce, "get_redis", AsyncMock(return_value=redis)):
+                profile = asyncio.run(users_api._get_profile_cached("u_stale", db=None))
+        finally:
+            ce._profile_cache.pop("u_stale", None)
+        assert profile == {"segment": "new"}
+
+
 # ─────────────────────────────────────────────────────────────────────────────
 # Schema Validation Tests
 # ─────────────────────────────────────────────────────────────────────────────
@@ -350,9 +861,6 @@ class TestArbiter:
 class TestSchemaValidation:
 
     def test_invalid_expires_at_raises(self):
-        from app.models.schemas import NotificationEventIn
-        from datetime import timezone
-        import pydantic
         with pytest.raises(pydantic.ValidationError):
             NotificationEventIn(
                 user_id="u1",
@@ -360,7 +868,7 @@ class TestSchemaValidation:
                 title="T",
                 message="M",
                 source="s",
-                expires_at=datetime.now(timezone.utc) - timedelta(hours=2),
+                expires_at=_NOW - timedelta(hours=2),
             )
 
     def test_valid_event_passes(self, sample_event_critical):